@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##     Microbenchmarks for the field calculations in magnetcircuitlib
+##
+##     Run from the top directory:  python benchmarks/bench_magnetcircuitlib.py
+##
+###############################################################################
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+from magnetcircuitlib import calculate_fields, calculate_setpoint, ExcitationCurve, FieldSum
+from processcalibrationlib import process_calibration_data
+
+_number = 20000
+
+#Sextupole like calibration with dipole, quadrupole and sextupole components, 11 points each
+_setpoints = ["[0.0, 20.0, 40.0, 60.0, 80.0, 100.0, 120.0, 140.0, 160.0, 180.0, 200.0]"] * 3
+_fields = ["[0.0, 0.001, 0.002, 0.003, 0.004, 0.005, 0.006, 0.007, 0.008, 0.009, 0.0095]",
+           "[0.0, 0.01, 0.02, 0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.095]",
+           "[0.0, 10.0, 20.0, 30.0, 40.0, 50.0, 60.0, 70.0, 80.0, 90.0, 95.0]"]
+
+
+def time_per_call(func):
+    return min(timeit.repeat(func, number=_number, repeat=3)) / _number
+
+
+def bench_calculate_fields():
+
+    (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(_setpoints, _fields, 2)
+    brho = 10.0
+    curve = ExcitationCurve(2, setpointsmatrix, fieldsmatrix, 1, 0, "ksext", 0.2)
+
+    t_function = time_per_call(lambda: calculate_fields(2, setpointsmatrix, fieldsmatrix, brho, 1, 0, "ksext", 0.2,
+                                                        123.4, 120.0))
+    t_curve = time_per_call(lambda: curve.calculate_fields(brho, 123.4, 120.0))
+
+    print("calculate_fields (read and set value)")
+    print("    function:        %8.2f us/call" % (t_function * 1e6))
+    print("    ExcitationCurve: %8.2f us/call  (x%.1f)" % (t_curve * 1e6, t_function / t_curve))
+
+
+def bench_calculate_setpoint():
+
+    (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(_setpoints, _fields, 2)
+    brho = 10.0
+    curve = ExcitationCurve(2, setpointsmatrix, fieldsmatrix, 1, 0, "ksext", 0.2)
+    fieldB = curve.calculate_fields(brho, 123.4)[5].copy()
+
+    t_function = time_per_call(lambda: calculate_setpoint(2, setpointsmatrix, fieldsmatrix, brho, 1, 0, "ksext", 0.2,
+                                                          None, fieldB))
+    t_curve = time_per_call(lambda: curve.calculate_setpoint(brho, None, fieldB))
+
+    print("calculate_setpoint")
+    print("    function:        %8.2f us/call" % (t_function * 1e6))
+    print("    ExcitationCurve: %8.2f us/call  (x%.1f)" % (t_curve * 1e6, t_function / t_curve))
+
+
+def bench_calculate_fields_array(npoints=10000):
+
+    (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(_setpoints, _fields, 2)
+    brho = 10.0
+    curve = ExcitationCurve(2, setpointsmatrix, fieldsmatrix, 1, 0, "ksext", 0.2)
+    values = np.linspace(-200.0, 200.0, npoints)
+
+    def scalar_loop():
+        for value in values:
+            calculate_fields(2, setpointsmatrix, fieldsmatrix, brho, 1, 0, "ksext", 0.2, value)
+
+    number = max(1, _number // npoints)
+    t_loop = min(timeit.repeat(scalar_loop, number=number, repeat=3)) / number
+    number = max(1, 100 * _number // npoints)
+    t_array = min(timeit.repeat(lambda: curve.calculate_fields_array(brho, values), number=number, repeat=3)) / number
+
+    print("calculate_fields_array (%d points)" % npoints)
+    print("    function loop:   %8.2f ms" % (t_loop * 1e3))
+    print("    array:           %8.2f ms  (x%.0f, %.0f points/ms)" % (t_array * 1e3, t_loop / t_array,
+                                                                      npoints / (t_array * 1e3)))
+
+
+def sum_field_copies(main_field, trim_field):
+
+    #Reference: the summation as done before FieldSum
+    flags = np.isnan(main_field) & np.isnan(trim_field)
+    fM = main_field.copy()
+    fT = trim_field.copy()
+    fM[np.isnan(fM)] = 0.0
+    fT[np.isnan(fT)] = 0.0
+    out = fM + fT
+    out[flags] = np.NaN
+    return out
+
+
+def bench_field_sum():
+
+    main_field = np.array([np.NAN, 0.1, 2.0] + [np.NAN] * 7)
+    trim_field = np.array([np.NAN, 0.01, np.NAN, 0.3] + [np.NAN] * 6)
+    field_sum = FieldSum(10)
+
+    t_copies = time_per_call(lambda: sum_field_copies(main_field, trim_field))
+    t_field_sum = time_per_call(lambda: field_sum(main_field, trim_field))
+
+    print("sum of main and trim field")
+    print("    copies:          %8.2f us/call" % (t_copies * 1e6))
+    print("    FieldSum:        %8.2f us/call  (x%.1f)" % (t_field_sum * 1e6, t_copies / t_field_sum))
+
+
+if __name__ == '__main__':
+    bench_calculate_fields()
+    bench_calculate_setpoint()
+    bench_calculate_fields_array()
+    bench_field_sum()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##     Startup benchmark for the processing of calibration properties
+##
+##     Run from the top directory:  python benchmarks/bench_processcalibrationlib.py
+##
+###############################################################################
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import numpy as np
+import processcalibrationlib
+from processcalibrationlib import process_calibration_data, parse_excitation_curve
+
+_nmagnets = 1000
+_npoints = 21
+
+#Multipole components for each family in the synthetic ring
+_families = [("quadrupole", 1, 2), ("sextupole", 2, 3), ("octupole", 3, 4), ("dipole", 0, 1)]
+
+
+def ring_config(nmagnets=_nmagnets, npoints=_npoints):
+
+    #Every magnet has its own (measured) calibration, like a real ring with individual excitation curves
+    rng = random.Random(1)
+    config = []
+    for n in range(nmagnets):
+        (family, allowedcomp, nmultipoles) = _families[n % len(_families)]
+        setpoints = []
+        fields = []
+        for i in range(nmultipoles):
+            currents = np.linspace(0.0, 200.0, npoints)
+            gain = rng.uniform(0.9, 1.1) * (10.0 if i == allowedcomp else 0.01)
+            setpoints.append("[" + ", ".join(repr(x) for x in currents) + "]")
+            fields.append("[" + ", ".join(repr(x) for x in gain * currents * (1.0 - 1e-4 * currents)) + "]")
+        config.append((setpoints, fields, allowedcomp))
+    return config
+
+
+def parse_per_token(ExcitationCurve):
+
+    #Reference: a float() call per value, as done before the bulk parser
+    return np.array([[float(x) for x in "".join(s[1:-1]).split(",")] for s in ExcitationCurve])
+
+
+def bench_parse(config):
+
+    strings = [setpoints for (setpoints, fields, allowedcomp) in config]
+
+    t_token = min(timeit.repeat(lambda: [parse_per_token(s) for s in strings], number=1, repeat=5))
+    t_bulk = min(timeit.repeat(lambda: [parse_excitation_curve(s) for s in strings], number=1, repeat=5))
+
+    print("parse set point strings (%d magnets)" % len(config))
+    print("    per token:       %8.2f ms" % (t_token * 1e3))
+    print("    bulk:            %8.2f ms  (x%.1f)" % (t_bulk * 1e3, t_token / t_bulk))
+
+
+def bench_process(config):
+
+    def process_all():
+        for (setpoints, fields, allowedcomp) in config:
+            process_calibration_data(setpoints, fields, allowedcomp)
+
+    def cold():
+        processcalibrationlib.clear_calibration_cache()
+        process_all()
+
+    t_cold = min(timeit.repeat(cold, number=1, repeat=5))
+    t_warm = min(timeit.repeat(process_all, number=1, repeat=5))
+
+    print("process_calibration_data (%d magnets, %d points)" % (len(config), _npoints))
+    print("    uncached:        %8.2f ms  (%.1f us/magnet)" % (t_cold * 1e3, t_cold * 1e6 / len(config)))
+    print("    cached:          %8.2f ms  (%.1f us/magnet)" % (t_warm * 1e3, t_warm * 1e6 / len(config)))
+
+
+if __name__ == '__main__':
+    config = ring_config()
+    bench_parse(config)
+    bench_process(config)
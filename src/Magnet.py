@@ -28,11 +28,18 @@ import PyTango
 import os
 import numpy as np
 import sys
+import time
 from math import sqrt
 from MagnetCircuit import MagnetCircuitClass, MagnetCircuit
 from TrimCircuit import TrimCircuitClass, TrimCircuit
-from magnetcircuitlib import calculate_fields  # do not need calculate_current
+from MagnetServer import MagnetServerClass, MagnetServer
+from magnetcircuitlib import ExcitationCurve, FieldSum  # do not need calculate_current
 from processcalibrationlib import process_calibration_data
+from magnetpropertylib import prefetch_server_properties, clear_snapshot
+from interlocklib import interlock_registry
+from localdevicelib import get_device_proxy
+from proxymanagerlib import ManagedProxy
+from initpoollib import start_init_pool, join_init_pool
 
 
 class Magnet(PyTango.Device_4Impl):
@@ -47,6 +54,11 @@ class Magnet(PyTango.Device_4Impl):
 
     def delete_device(self):
         self.debug_stream("In delete_device()")
+        for ilock_att in self.interlock_descs:
+            interlock_registry.unregister(ilock_att, self.interlock_updated)
+        for circuit_device in (self._main_circuit_device, self._trim_circuit_device):
+            if circuit_device is not None:
+                circuit_device.stop()
 
     def init_device(self):
         self.debug_stream("In init_device()")
@@ -62,6 +74,9 @@ class Magnet(PyTango.Device_4Impl):
         self.fieldANormalised_trim = np.zeros(shape=(self._maxdim), dtype=float)
         self.fieldB_trim = np.zeros(shape=(self._maxdim), dtype=float)
         self.fieldBNormalised_trim = np.zeros(shape=(self._maxdim), dtype=float)
+        # summing of the main and trim fields, one per attribute
+        self.field_sums = dict((name, FieldSum(self._maxdim))
+                               for name in ["fieldA", "fieldANormalised", "fieldB", "fieldBNormalised"])
 
         # this will get length, polarity, orientation and the raw calibration data
         self.get_device_properties(self.get_device_class())
@@ -76,6 +91,9 @@ class Magnet(PyTango.Device_4Impl):
         # get trim and main coil proxies
         self._main_circuit_device = None
         self._trim_circuit_device = None
+        self.main_circuit_reading = None  # (read value, BRho) from the main circuit for this request
+        self.trim_fields = None  # trim field vectors by attribute name, for this request (or TrimFieldMaxAge)
+        self.trim_fields_time = 0.0
         self.MainCoil = None
         self.TrimCoil = None
         self.get_coil_proxies()
@@ -90,8 +108,10 @@ class Magnet(PyTango.Device_4Impl):
 
         # interlock config
         self.interlock_descs = {}
-        self.interlock_proxies = {}
         self.bad_Ilock_config = False
+        self.isInterlocked = False
+        self.interlock_pushed = False  # last temperatureInterlock value pushed as an event
+        self.set_change_event("temperatureInterlock", True, False)
         self.get_interlock_config()
 
         # configure magnet type, needed to calculate fields
@@ -107,7 +127,13 @@ class Magnet(PyTango.Device_4Impl):
         # process the calibration data into useful numpy arrays
         (self.hasCalibData, self.status_str_cfg, self.fieldsmatrix, self.ps_setpoint_matrix) \
             = process_calibration_data(self.excitation_curve_setpoints, self.ExcitationCurveFields,
-                                       self.allowed_component)
+                                       self.allowed_component, invertible=False)
+        self.excitation_curve = None
+        self.main_fields_reading = None  # (read value, BRho) the main fields were last calculated for
+        if self.hasCalibData:
+            self.excitation_curve = ExcitationCurve(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix,
+                                                    self.PolTimesOrient, self.Tilt, self.Type, self.Length,
+                                                    is_sole=self.is_sole)
 
         # option to disable use of trim coils
         self.applyTrim = True
@@ -137,25 +163,29 @@ class Magnet(PyTango.Device_4Impl):
     #
     @property
     def main_circuit_device(self):
+        # None straight away while the circuit cannot be reached (it is reconnected in the background)
         if self._main_circuit_device is None:
-            try:
-                self._main_circuit_device = PyTango.DeviceProxy(self.MainCoil)
-            except (PyTango.DevFailed, PyTango.ConnectionFailed) as df:
-                self.debug_stream("Failed to get main circuit proxy\n" + df[0].desc)
-                self.set_state(PyTango.DevState.FAULT)
-        return self._main_circuit_device
+            self._main_circuit_device = ManagedProxy(self.MainCoil, self.make_circuit_proxy)
+        main_circuit_device = self._main_circuit_device.get()
+        if main_circuit_device is None:
+            self.debug_stream("Failed to get main circuit proxy\n" + self._main_circuit_device.error)
+            self.set_state(PyTango.DevState.FAULT)
+        return main_circuit_device
 
     ###############################################################################
     #
     @property
     def trim_circuit_device(self):
         if self._trim_circuit_device is None:
-            try:
-                self._trim_circuit_device = PyTango.DeviceProxy(self.TrimCoil)
-            except (PyTango.DevFailed, PyTango.ConnectionFailed) as df:
-                self.debug_stream("Failed to get trim circuit proxy\n" + df[0].desc)
-                self.set_state(PyTango.DevState.FAULT)
-        return self._trim_circuit_device
+            self._trim_circuit_device = ManagedProxy(self.TrimCoil, self.make_circuit_proxy)
+        trim_circuit_device = self._trim_circuit_device.get()
+        if trim_circuit_device is None:
+            self.debug_stream("Failed to get trim circuit proxy\n" + self._trim_circuit_device.error)
+            self.set_state(PyTango.DevState.FAULT)
+        return trim_circuit_device
+
+    def make_circuit_proxy(self, circuit_name):
+        return get_device_proxy(circuit_name, self.LocalCircuitAccess)
 
     ###############################################################################
     #
@@ -168,14 +198,20 @@ class Magnet(PyTango.Device_4Impl):
                     s_l = s.split(",")
                     ilock_att = s_l[0] + "/" + s_l[1]
                     ilock_desc = s_l[2]
-                    ilock_proxy = PyTango.AttributeProxy(ilock_att)
+                    # the tag is shared with other magnets in the server and read in the background,
+                    # client calls just look at the last reading
+                    interlock_registry.register(ilock_att, self.interlock_updated, self.InterlockPollPeriod)
                     self.interlock_descs[ilock_att] = ilock_desc
-                    self.interlock_proxies[ilock_att] = ilock_proxy
                 except (IndexError, PyTango.DevFailed) as e:
                     self.debug_stream("Exception configuring interlocks %s " % self.TemperatureInterlock)
                     # if we fail to configure one interlock, don't configure any
                     self.bad_Ilock_config = True
 
+            if self.bad_Ilock_config:
+                for ilock_att in self.interlock_descs:
+                    interlock_registry.unregister(ilock_att, self.interlock_updated)
+                self.interlock_descs = {}
+
         else:
             self.debug_stream("No interlock tags specified in properties")
 
@@ -212,34 +248,57 @@ class Magnet(PyTango.Device_4Impl):
             if self.bad_Ilock_config:
                 self.status_str_ilk = "Interlock tag specified but interlock proxies could not be configured"
                 return
-            try:
-                for key in self.interlock_proxies:
-                    TempInterlockValue = self.interlock_proxies[key].read().value
-                    if TempInterlockValue == True:
-                        self.status_str_ilk = self.status_str_ilk + "\nTemperature Interlock Set! " + key + " (" + \
-                                              self.interlock_descs[key] + ")"
-                        self.set_state(PyTango.DevState.ALARM)
-                        self.isInterlocked = True
-
-            except (IndexError, PyTango.DevFailed) as e:
-                self.debug_stream("Exception reading interlock AttributeProxy")
-                self.status_str_ilk = "Cannot read specified interlock tag (s) "
+            now = time.time()
+            for key in self.interlock_descs:
+                # after a failed read the last value read is kept, so a set interlock stays set
+                (TempInterlockValue, read_time, error) = interlock_registry.reading(key)
+                if error is not None:
+                    self.debug_stream("Exception reading interlock AttributeProxy %s: %s" % (key, error))
+                    self.status_str_ilk = self.status_str_ilk + "\nCannot read specified interlock tag " + key
+                if read_time is None:
+                    if error is None:
+                        self.status_str_ilk = self.status_str_ilk + "\nInterlock tag not read yet " + key
+                    continue
+                if now - read_time > self.InterlockMaxAge:
+                    self.status_str_ilk = self.status_str_ilk + "\nInterlock reading is stale (%.0f s old) %s" \
+                                                                % (now - read_time, key)
+                if TempInterlockValue == True:
+                    self.status_str_ilk = self.status_str_ilk + "\nTemperature Interlock Set! " + key + " (" + \
+                                          self.interlock_descs[key] + ")"
+                    self.set_state(PyTango.DevState.ALARM)
+                    self.isInterlocked = True
         else:
             self.status_str_ilk = "No temperature interlock tags specified in properties"
 
+    def interlock_updated(self, tag, reading):
+        # called by the interlock registry when one of our tags changes, so clients can have events
+        interlocked = any(interlock_registry.reading(key)[0] == True for key in self.interlock_descs)
+        if interlocked != self.interlock_pushed:
+            self.interlock_pushed = interlocked
+            self.push_change_event("temperatureInterlock", interlocked)
+
     ###############################################################################
     #
     def get_main_circuit_state(self):
 
+        # State, read value and BRho of the main circuit in one call per request,
+        # the field hooks then use the read value and BRho from here
         self.debug_stream("In get_main_circuit_state()")
+        self.main_circuit_reading = None
         if self.main_circuit_device:
             try:
-                cir_state = self.main_circuit_device.read_attribute("State").value
-                self.status_str_cir = "Connected to main circuit %s in state %s " % (self.MainCoil, cir_state)
+                (state_attr, physical_quantity_attr, brho_attr) = \
+                    self.main_circuit_device.read_attributes(["State", "PowerSupplyReadValue", "BRho"])
             except (AttributeError, PyTango.DevFailed) as e:
+                state_attr = None
+            if state_attr is None or state_attr.has_failed:
                 self.status_str_cir = "Cannot get state of main circuit device " + self.MainCoil
                 self.debug_stream(self.status_str_cir)
                 return PyTango.DevState.FAULT
+            cir_state = state_attr.value
+            self.status_str_cir = "Connected to main circuit %s in state %s " % (self.MainCoil, cir_state)
+            if not (physical_quantity_attr.has_failed or brho_attr.has_failed):
+                self.main_circuit_reading = (physical_quantity_attr.value, brho_attr.value)
         else:
             self.status_str_cir = "Cannot get proxy to main coil " + self.MainCoil
             cir_state = PyTango.DevState.FAULT
@@ -249,36 +308,29 @@ class Magnet(PyTango.Device_4Impl):
     #
     def get_main_physical_quantity_and_field(self):
         self.debug_stream("In get_main_physical_quantity_and_field()")
-        if self.main_circuit_device:
-            try:
-                self.debug_stream("Will read {0} from main circuit".format(self.physical_quantity_controlled))
-                physical_quantity = self.main_circuit_device.PowerSupplyReadValue
-                self.debug_stream("Will read BRho from main circuit")
-                BRho = self.main_circuit_device.BRho
-                self.status_str_b = ""
+        if self.main_circuit_reading is None:
+            self.debug_stream(
+                "Cannot get state or {0} from circuit device {1}".format(self.physical_quantity_controlled,
+                                                                         self.MainCoil))
+            return False
 
-            except (AttributeError, PyTango.DevFailed) as e:
-                self.debug_stream(
-                    "Cannot get state or {0} from circuit device {1}".format(self.physical_quantity_controlled,
-                                                                             self.MainCoil))
-                return False
-            else:
+        # the fields only need calculating again if the read value or BRho changed
+        if self.main_circuit_reading == self.main_fields_reading:
+            return True
 
-                (success, MainFieldComponent_r, MainFieldComponent_w, self.fieldA_main, self.fieldANormalised_main,
-                 self.fieldB_main, self.fieldBNormalised_main) \
-                    = calculate_fields(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix, BRho,
-                                       self.PolTimesOrient, self.Tilt, self.Type, self.Length, physical_quantity, None,
-                                       self.is_sole)
-
-                self.field_out_of_range = False
-                if success == False:
-                    self.status_str_b = "Cannot interpolate read {0} {1}".format(self.physical_quantity_controlled,
-                                                                                 physical_quantity)
-                    self.field_out_of_range = True
-                return True
-        else:
-            self.debug_stream("Cannot get proxy to main coil " + self.MainCoil)
-            return False
+        (physical_quantity, BRho) = self.main_circuit_reading
+        self.status_str_b = ""
+        (success, MainFieldComponent_r, MainFieldComponent_w, self.fieldA_main, self.fieldANormalised_main,
+         self.fieldB_main, self.fieldBNormalised_main) \
+            = self.excitation_curve.calculate_fields(BRho, physical_quantity)
+        self.main_fields_reading = self.main_circuit_reading
+
+        self.field_out_of_range = False
+        if success == False:
+            self.status_str_b = "Cannot interpolate read {0} {1}".format(self.physical_quantity_controlled,
+                                                                         physical_quantity)
+            self.field_out_of_range = True
+        return True
 
     ###############################################################################
     #
@@ -304,18 +356,21 @@ class Magnet(PyTango.Device_4Impl):
 
         self.debug_stream("In always_excuted_hook()")
 
+        # trim fields are read again for a new request, unless allowed to be older
+        if time.time() - self.trim_fields_time > self.TrimFieldMaxAge:
+            self.trim_fields = None
+
         # There should be a main coil
         if self.MainCoil == None:
             self.set_state(PyTango.DevState.FAULT)
             self.status_str_cir = "No main coil defined in properties"
         else:
             # set state according to main circuit state
-            self.set_state(self.get_main_circuit_state())
+            main_state = self.get_main_circuit_state()
+            self.set_state(main_state)
             #
             # maybe also a trim coil
             if self.applyTrim and self.TrimCoil != None:
-                #check the main circuit state
-                main_state = self.get_main_circuit_state()
                 #check the trim circuit state
                 trim_state = self.get_trim_circuit_state()
                 #make use of Tango enum to set whatever is the highest state (On=0, Off=1,... Unknown=13)
@@ -339,40 +394,43 @@ class Magnet(PyTango.Device_4Impl):
     #    Magnet read/write attribute methods
     # -----------------------------------------------------------------------------
 
-    #method to sum the main and trim fields, when some elements will be NAN
-    def sum_field(self, main_field, trim_field):
-        flags = np.isnan(main_field) & np.isnan(trim_field)
-        fM = main_field.copy()
-        fT = trim_field.copy()
-        fM[np.isnan(fM)] = 0.0
-        fT[np.isnan(fT)] = 0.0
-        out = fM + fT
-        out[flags] = np.NaN
-        return out
-
-    #
-
-    def read_fieldA(self, attr):
-        self.debug_stream("In read_fieldA()")
+    #get all the trim field vectors in one call, once per request
+    def get_trim_fields(self):
+        if self.trim_fields is None:
+            names = ["fieldA", "fieldANormalised", "fieldB", "fieldBNormalised"]
+            self.trim_fields = dict.fromkeys(names)
+            try:
+                for (name, field_attr) in zip(names, self.trim_circuit_device.read_attributes(names)):
+                    if not field_attr.has_failed:
+                        self.trim_fields[name] = field_attr.value
+            except PyTango.DevFailed as e:
+                self.debug_stream("Cannot read fields from trim circuit device " + self.TrimCoil)
+            self.trim_fields_time = time.time()
+        return self.trim_fields
+
+    #add the field from the trim to the main field, if there is a trim
+    def add_trim_field(self, name, main_field):
         # look up field from trim
         if self.applyTrim and self.TrimCoil != None:
             if self.trim_circuit_device:
-                try:
-                    self.fieldA_trim = self.trim_circuit_device.fieldA
+                trim_field = self.get_trim_fields()[name]
+                if trim_field is not None:
+                    setattr(self, name + "_trim", trim_field)
                     self.status_str_trmi = ""
                     # do the sum
-                    field = self.sum_field(self.fieldA_main, self.fieldA_trim)
-                    attr.set_value(field)
-                except PyTango.DevFailed as e:
-                    msg = "Cannot add field from trim circuit device " + self.TrimCoil
-                    self.debug_stream(msg)
-                    self.status_str_trmi = msg
-                    attr.set_value(self.fieldA_main)
+                    return self.field_sums[name](main_field, trim_field)
+                msg = "Cannot add field from trim circuit device " + self.TrimCoil
+                self.debug_stream(msg)
+                self.status_str_trmi = msg
             else:
                 self.debug_stream("Cannot get proxy to trim coil " + self.TrimCoil)
-                attr.set_value(self.fieldA_main)
-        else:
-            attr.set_value(self.fieldA_main)
+        return main_field
+
+    #
+
+    def read_fieldA(self, attr):
+        self.debug_stream("In read_fieldA()")
+        attr.set_value(self.add_trim_field("fieldA", self.fieldA_main))
 
     def is_fieldA_allowed(self, attr):
         self.debug_stream("In is_fieldA_allowed()")
@@ -384,25 +442,7 @@ class Magnet(PyTango.Device_4Impl):
 
     def read_fieldANormalised(self, attr):
         self.debug_stream("In read_fieldANormalised()")
-        # look up field from trim
-        if self.applyTrim and self.TrimCoil != None:
-            if self.trim_circuit_device:
-                try:
-                    self.fieldANormalised_trim = self.trim_circuit_device.fieldANormalised
-                    self.status_str_trmi = "" 
-                    # do the sum
-                    field = self.sum_field(self.fieldANormalised_main, self.fieldANormalised_trim)
-                    attr.set_value(field)
-                except PyTango.DevFailed as e:
-                    msg = "Cannot add field from trim circuit device " + self.TrimCoil
-                    self.debug_stream(msg)
-                    self.status_str_trmi = msg
-                    attr.set_value(self.fieldANormalised_main)
-            else:
-                self.debug_stream("Cannot get proxy to trim coil " + self.TrimCoil)
-                attr.set_value(self.fieldANormalised_main)
-        else:
-            attr.set_value(self.fieldANormalised_main)
+        attr.set_value(self.add_trim_field("fieldANormalised", self.fieldANormalised_main))
 
     def is_fieldANormalised_allowed(self, attr):
         self.debug_stream("In is_fieldANormalised_allowed()")
@@ -414,25 +454,7 @@ class Magnet(PyTango.Device_4Impl):
 
     def read_fieldB(self, attr):
         self.debug_stream("In read_fieldB()")
-        # look up field from trim
-        if self.applyTrim and self.TrimCoil != None:
-            if self.trim_circuit_device:
-                try:
-                    self.fieldB_trim = self.trim_circuit_device.fieldB
-                    self.status_str_trmi = ""
-                    # do the sum
-                    field = self.sum_field(self.fieldB_main, self.fieldB_trim)
-                    attr.set_value(field)
-                except PyTango.DevFailed as e:
-                    msg = "Cannot add field from trim circuit device " + self.TrimCoil
-                    self.debug_stream(msg)
-                    self.status_str_trmi = msg
-                    attr.set_value(self.fieldB_main)
-            else:
-                self.debug_stream("Cannot get proxy to trim coil " + self.TrimCoil)
-                attr.set_value(self.fieldB_main)
-        else:
-            attr.set_value(self.fieldB_main)
+        attr.set_value(self.add_trim_field("fieldB", self.fieldB_main))
 
     def is_fieldB_allowed(self, attr):
         self.debug_stream("In is_fieldB_allowed()")
@@ -444,25 +466,7 @@ class Magnet(PyTango.Device_4Impl):
 
     def read_fieldBNormalised(self, attr):
         self.debug_stream("In read_fieldBNormalised()")
-        # look up field from trim
-        if self.applyTrim and self.TrimCoil != None:
-            if self.trim_circuit_device:
-                try:
-                    self.fieldBNormalised_trim = self.trim_circuit_device.fieldBNormalised
-                    self.status_str_trmi = ""
-                    # do the sum
-                    field = self.sum_field(self.fieldBNormalised_main, self.fieldBNormalised_trim)
-                    attr.set_value(field)
-                except PyTango.DevFailed as e:
-                    msg = "Cannot add field from trim circuit device " + self.TrimCoil
-                    self.debug_stream(msg)
-                    self.status_str_trmi = msg
-                    attr.set_value(self.fieldBNormalised_main)
-            else:
-                self.debug_stream("Cannot get proxy to trim coil " + self.TrimCoil)
-                attr.set_value(self.fieldBNormalised_main)
-        else:
-            attr.set_value(self.fieldBNormalised_main)
+        attr.set_value(self.add_trim_field("fieldBNormalised", self.fieldBNormalised_main))
 
     def is_fieldBNormalised_allowed(self, attr):
         self.debug_stream("In is_fieldBNormalised_allowed()")
@@ -542,6 +546,22 @@ class MagnetClass(PyTango.DeviceClass):
             [PyTango.DevVarStringArray,
              "Measured calibration fields for each multipole",
              []],
+        'InterlockPollPeriod':
+            [PyTango.DevDouble,
+             "Seconds between background reads of TemperatureInterlock tags without change events (shared in the server, the shortest is used)",
+             [1.0]],
+        'InterlockMaxAge':
+            [PyTango.DevDouble,
+             "Seconds after which an interlock reading is reported as stale",
+             [5.0]],
+        'LocalCircuitAccess':
+            [PyTango.DevBoolean,
+             "Call circuit devices in the same server directly instead of through a device proxy",
+             [True]],
+        'TrimFieldMaxAge':
+            [PyTango.DevDouble,
+             "Seconds the trim field vectors may be reused for, across requests (0: read once per request)",
+             [0.0]],
     }
 
 
@@ -627,7 +647,26 @@ def main():
         if U.get_ds_name().split("/")[1].startswith("R"):
             py.add_class(TrimCircuitClass, TrimCircuit, 'TrimCircuit')
 
+        #Admin device for access to all magnets and circuits at once (only if one is defined for this server)
+        py.add_class(MagnetServerClass, MagnetServer, 'MagnetServer')
+
+        #Read the magnet properties for the whole server in one go, rather than once per circuit each magnet is on
+        try:
+            prefetch_server_properties(U.get_ds_name(), 'Magnet', ["Length", "Tilt", "Type"])
+        except PyTango.DevFailed, e:
+            print '-------> Could not prefetch magnet properties, circuits will read them:', e
+
+        #Optionally let the circuits talk to their PS and switchboards in parallel during server_init
+        try:
+            threads = PyTango.Database().get_class_property('MagnetServer', ['ParallelInitThreads'])['ParallelInitThreads']
+            start_init_pool(int(threads[0]) if threads else 0)
+        except (PyTango.DevFailed, ValueError), e:
+            print '-------> Could not read ParallelInitThreads, devices will init one after the other:', e
+
         U.server_init()
+        for (task, e) in join_init_pool():
+            print '-------> Init of %s failed:' % task.__self__.get_name(), e
+        clear_snapshot()
         U.server_run()
 
     except PyTango.DevFailed, e:
@@ -27,11 +27,16 @@ __docformat__ = 'restructuredtext'
 import PyTango
 import os
 import sys
+import time
 import numpy as np
 from math import sqrt
-from magnetcircuitlib import calculate_fields, calculate_setpoint
+from magnetcircuitlib import ExcitationCurve
 from cycling_statemachine.magnetcycling import MagnetCycling
 from processcalibrationlib import process_calibration_data
+from magnetpropertylib import get_device_properties
+from fieldeventlib import setup_field_events, convert_dipole_vector
+from initpoollib import run_init_task
+from proxymanagerlib import ManagedProxy
 
 
 
@@ -92,6 +97,8 @@ class MagnetCircuit(PyTango.Device_4Impl):
         self.debug_stream("In delete_device()")
         if self._cycler:
             self._cycler.stop()
+        self.unsubscribe_ps_events()
+        self._ps_device.stop()
 
     def init_device(self):
         self.debug_stream("In init_device()")
@@ -122,6 +129,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
         self.status_str_cyc = ""
         self.status_str_cfg = ""
         self.status_str_fin = ""
+        self.status_str_init = ""  # set if init_power_supply failed; FAULT until it works (see dev_state)
         self.field_out_of_range = False
         self.iscycling = False
         self.cyclingphase = "Cycling not set up"
@@ -131,7 +139,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
         self.is_corr = False  # correctors differ from dipoles (theta vs Theta)
 
         # Proxy to power supply device
-        self._ps_device = None
+        self._ps_device = ManagedProxy(self.PowerSupplyProxy)
         self.actual_measurement = None  # read value from the power supply (can be voltage or current)
         self.set_point = None  # set point for the ps (current or voltage)
         self.is_voltage_controlled = False  # define if magnet are controlled by voltage
@@ -142,6 +150,11 @@ class MagnetCircuit(PyTango.Device_4Impl):
         self.Length = 0
         self.Type = ""
         self.hasCalibData = False
+        self.excitation_curve = None
+        self._ps_event_curve = None  # separate curve for the event thread, since a curve reuses its result arrays
+        self._ps_event_ids = []
+        self._ps_snapshot = None  # (value, w_value, time received, brho, fields) from the last PS event
+        self._ps_read = None  # (time, brho, result) of the PS reading for the current request
         magnet_properties_ok = self.read_magnet_properties()  # this is reading properties from the magnet,
         # not the circuit!
 
@@ -170,17 +183,45 @@ class MagnetCircuit(PyTango.Device_4Impl):
             (self.hasCalibData, self.status_str_cal, self.fieldsmatrix, self.ps_setpoint_matrix) \
                 = process_calibration_data(self.excitation_curve_setpoints, self.ExcitationCurveFields,
                                            self.allowed_component)
+            if self.hasCalibData:
+                self.excitation_curve = self.make_excitation_curve()
 
-        # set limits on set point
-        self.set_point_limits()
-
-        # set alarm levels on MainFieldComponent (etc) corresponding to the PS alarms
-        if self.hasCalibData:
-            self.set_field_limits()
+        # optionally push events on the fields, so clients need not poll them
+        self.field_events = None
+        if self.PushFieldEvents:
+            self.field_events = setup_field_events(self, self.FieldEventAbsChange, self.FieldEventRelChange)
 
-        # from the PS limits, if available, set cycling boundaries
+        # the rest of the init only waits on the PS, so at server startup it can run alongside other devices
+        self.min_setpoint_value = self.max_setpoint_value = None
+        self.ps_limits_read = False  # False until read from the PS; retried by dev_state if the PS was not there
         self._cycler = None
-        self.setup_cycler()
+        run_init_task(self.init_power_supply)
+
+    def init_power_supply(self):
+        # at server startup this runs in an init pool thread, so take the device monitor as a request would
+        with PyTango.AutoTangoMonitor(self):
+            try:
+                # set limits on set point
+                self.set_point_limits()
+
+                # set alarm levels on MainFieldComponent (etc) corresponding to the PS alarms
+                if self.hasCalibData:
+                    self.set_field_limits()
+
+                # from the PS limits, if available, set cycling boundaries
+                self.setup_cycler()
+
+                # optionally keep the PS reading up to date from events, rather than reading the PS for every
+                # attribute, and push field events as the PS changes
+                self.subscribe_ps_events()
+                self.status_str_init = ""
+            except Exception as e:
+                if isinstance(e, PyTango.DevFailed):
+                    e = e[0].desc
+                self.status_str_init = "Init with PS {0} failed: {1}".format(self.PowerSupplyProxy, e)
+                self.error_stream(self.status_str_init)
+                self.set_state(PyTango.DevState.FAULT)
+                self.set_status(self.status_str_init)
 
     ###############################################################################
     #
@@ -189,16 +230,33 @@ class MagnetCircuit(PyTango.Device_4Impl):
         # mega m!) Energy is in eV to start.
         self.BRho = sqrt(self.energy_r / 1000000.0 * (self.energy_r / 1000000.0 + (2 * 0.510998910))) / (299.792458)
 
+    ###############################################################################
+    #
+    def always_executed_hook(self):
+        self.debug_stream("In always_excuted_hook()")
+        # new client request, so the PS is read again (once) for it
+        self._ps_read = None
+
+    def invalidate_ps_reading(self):
+        # after writing a set point, the last PS event and reading no longer have the right one
+        self._ps_snapshot = None
+        self._ps_read = None
+
+    ###############################################################################
+    #
+    def make_excitation_curve(self):
+        return ExcitationCurve(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix,
+                               self.PolTimesOrient, self.Tilt, self.Type, self.Length, is_sole=self.is_sole)
+
     ###############################################################################
     #
     @property
     def ps_device(self):
-        if self._ps_device is None:
-            try:
-                self._ps_device = PyTango.DeviceProxy(self.PowerSupplyProxy)
-            except (PyTango.DevFailed, PyTango.ConnectionFailed) as df:
-                self.debug_stream("Failed to get power supply proxy\n" + df[0].desc)
-        return self._ps_device
+        # None straight away while the PS cannot be reached (it is reconnected in the background)
+        ps_device = self._ps_device.get()
+        if ps_device is None:
+            self.debug_stream("Failed to get power supply proxy\n" + self._ps_device.error)
+        return ps_device
 
     ##############################################################################################################
     #
@@ -209,12 +267,15 @@ class MagnetCircuit(PyTango.Device_4Impl):
         magnet_property_types = {"Length": float, "Tilt": int, "Type": str}
 
         problematic_devices = set()  # let's be optimistic
+        # all magnets are read at once, then checked in order
+        magnet_properties = get_device_properties(self.MagnetProxies, magnet_property_types.keys())
         for (i, magnet_device_name) in enumerate(self.MagnetProxies):
-            magnet_device = PyTango.DeviceProxy(magnet_device_name)
+            if isinstance(magnet_properties[i], PyTango.DevFailed):
+                raise magnet_properties[i]
             for prop, type_ in magnet_property_types.items():
                 try:
-                    prop_value = type_(magnet_device.get_property(prop)[prop][0])
-                except (ValueError, IndexError):
+                    prop_value = type_(magnet_properties[i][prop][0])
+                except (ValueError, IndexError, KeyError):
                     # undefined property gives an empty list as a value
                     print >> self.log_fatal, ("Couldn't read property '%s' from magnet device '%s'; " +
                                               "is it configured properly?") % (prop, magnet_device_name)
@@ -363,6 +424,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
     def set_point_limits(self):
 
         self.min_setpoint_value = self.max_setpoint_value = None
+        self.ps_limits_read = False
         try:
 
             max_setpoint_s = self.ps_device.get_attribute_config(self.ps_attribute).max_value
@@ -377,6 +439,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
             else:
                 self.max_setpoint_value = float(max_setpoint_s)
                 self.min_setpoint_value = float(min_setpoint_s)
+            self.ps_limits_read = True
 
         except (AttributeError, PyTango.DevFailed):
             self.debug_stream("Cannot read {0} limits from PS {1}".format(self.ps_attribute, self.PowerSupplyProxy))
@@ -391,14 +454,9 @@ class MagnetCircuit(PyTango.Device_4Impl):
             att = self.get_device_attr().get_attr_by_name("MainFieldComponent")
             multi_prop = PyTango.MultiAttrProp()
             att.get_properties(multi_prop)
-            minMainFieldComponent = \
-                calculate_fields(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix, self.BRho,
-                                 self.PolTimesOrient, self.Tilt, self.Type, self.Length, self.min_setpoint_value,
-                                 is_sole=self.is_sole, find_limit=True)[1]
-            maxMainFieldComponent = \
-                calculate_fields(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix, self.BRho,
-                                 self.PolTimesOrient, self.Tilt, self.Type, self.Length, self.max_setpoint_value,
-                                 is_sole=self.is_sole, find_limit=True)[1]
+            (minMainFieldComponent, maxMainFieldComponent) = \
+                self.excitation_curve.calculate_fields_array(self.BRho, [self.min_setpoint_value,
+                                                                         self.max_setpoint_value], find_limit=True)[1]
 
             if minMainFieldComponent < maxMainFieldComponent:
                 multi_prop.min_value = minMainFieldComponent
@@ -469,59 +527,148 @@ class MagnetCircuit(PyTango.Device_4Impl):
     def get_main_physical_quantity_and_field(self):
 
         self.debug_stream("In get_main_physical_quantity_and_field()")
+
+        # every attribute of one request uses the same PS reading and fields
+        ps_read = self._ps_read
+        if ps_read is not None and ps_read[1] == self.BRho and time.time() - ps_read[0] <= self.PowerSupplyReadMaxAge:
+            return ps_read[2]
+        result = self.read_main_physical_quantity_and_field()
+        self._ps_read = (time.time(), self.BRho, result)
+        return result
+
+    def read_main_physical_quantity_and_field(self):
+
+        # if subscribed to PS events, use the last one if it is recent enough
+        snapshot = self._ps_snapshot
+        if snapshot is not None and time.time() - snapshot[2] <= self.PowerSupplyEventMaxAge:
+            (value, w_value, received, brho, fields) = snapshot
+            if brho != self.BRho:  # energy changed since the event came in
+                fields = self.calculate_ps_fields(self.excitation_curve, value, w_value)
+            self.set_ps_reading(value, w_value, fields)
+            return True
+
         if self.ps_device:
             try:
                 measurement_attr = self.ps_device.read_attribute(self.ps_attribute)
-                self.actual_measurement = measurement_attr.value
-                self.set_point = measurement_attr.w_value
-                self.status_str_b = ""
                 # Just assume the set point is whatever is written on the ps device (could be written directly there!)
             except:
                 self.debug_stream("Cannot read {0} on PS {1}".format(self.ps_attribute, self.PowerSupplyProxy))
                 return False
             else:
-                # if have calib data calculate the actual and set fields
-                self.field_out_of_range = False
-                if self.hasCalibData:
-                    (success, self.MainFieldComponent_r, self.MainFieldComponent_w, self.fieldA, self.fieldANormalised,
-                     self.fieldB, self.fieldBNormalised) \
-                        = calculate_fields(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix,
-                                           self.BRho,
-                                           self.PolTimesOrient, self.Tilt, self.Type, self.Length,
-                                           self.actual_measurement,
-                                           self.set_point, is_sole=self.is_sole)
-                    if success == False:
-                        self.status_str_b = "Cannot interpolate read/set {0} {1} {2} ".format(self.ps_attribute,
-                                                                                              self.actual_measurement,
-                                                                                              self.set_point)
-                        self.field_out_of_range = True
-                    return True
-                else:  # if not calib data, can read ps value but not field
-                    self.status_str_b = "Circuit device may only read {0}".format(self.ps_attribute)
-                    self.field_out_of_range = True
-                    return True
+                fields = self.calculate_ps_fields(self.excitation_curve, measurement_attr.value,
+                                                  measurement_attr.w_value)
+                self.set_ps_reading(measurement_attr.value, measurement_attr.w_value, fields)
+                self.push_fields(fields)
+                return True
 
         else:
             self.debug_stream("Cannot get proxy to PS " + self.PowerSupplyProxy)
             return False
 
+    def calculate_ps_fields(self, excitation_curve, actual_measurement, set_point):
+        # if have calib data calculate the actual and set fields, otherwise None
+        if self.hasCalibData:
+            return excitation_curve.calculate_fields(self.BRho, actual_measurement, set_point)
+        return None
+
+    def set_ps_reading(self, actual_measurement, set_point, fields):
+        self.actual_measurement = actual_measurement
+        self.set_point = set_point
+        self.status_str_b = ""
+        self.field_out_of_range = False
+        if fields is not None:
+            (success, self.MainFieldComponent_r, self.MainFieldComponent_w, self.fieldA, self.fieldANormalised,
+             self.fieldB, self.fieldBNormalised) = fields
+            if success == False:
+                self.status_str_b = "Cannot interpolate read/set {0} {1} {2} ".format(self.ps_attribute,
+                                                                                      self.actual_measurement,
+                                                                                      self.set_point)
+                self.field_out_of_range = True
+        else:  # if not calib data, can read ps value but not field
+            self.status_str_b = "Circuit device may only read {0}".format(self.ps_attribute)
+            self.field_out_of_range = True
+
+    ##############################################################################################################
+    #
+    def subscribe_ps_events(self):
+
+        # Change events give new values as they happen, periodic events (if configured on the PS) show the
+        # value is still current. Reads fall back to the PS if no event came within PowerSupplyEventMaxAge.
+        # The events are also what pushes the field events when nobody reads the fields.
+        if not (self.UsePowerSupplyEvents or self.PushFieldEvents) or not self.ps_device:
+            return
+        if self.hasCalibData:
+            self._ps_event_curve = self.make_excitation_curve()
+        for event_type in (PyTango.EventType.CHANGE_EVENT, PyTango.EventType.PERIODIC_EVENT):
+            try:
+                # stateless, so keeps trying if the PS is not there yet
+                self._ps_event_ids.append(self.ps_device.subscribe_event(self.ps_attribute, event_type,
+                                                                         self.ps_event_received, [], True))
+            except PyTango.DevFailed as df:
+                self.debug_stream("Cannot subscribe to {0} events on PS {1}: {2}".format(
+                    event_type, self.PowerSupplyProxy, df[0].desc))
+
+    def unsubscribe_ps_events(self):
+        for event_id in self._ps_event_ids:
+            try:
+                self._ps_device.proxy.unsubscribe_event(event_id)
+            except PyTango.DevFailed:
+                pass
+        self._ps_event_ids = []
+        self._ps_snapshot = None
+
+    def ps_event_received(self, event):
+        # called from the event thread; build the whole snapshot, then swap it in
+        if event.err or event.attr_value is None:
+            self._ps_snapshot = None
+            return
+        value = event.attr_value.value
+        w_value = event.attr_value.w_value
+        brho = self.BRho
+        fields = self.calculate_ps_fields(self._ps_event_curve, value, w_value)
+        if fields is not None:
+            # the event curve reuses its arrays for the next event
+            fields = tuple(f.copy() if isinstance(f, np.ndarray) else f for f in fields)
+        if self.UsePowerSupplyEvents:
+            self._ps_snapshot = (value, w_value, time.time(), brho, fields)
+        self.push_fields(fields)
+
+    def push_fields(self, fields):
+        # push the newly calculated fields, as the clients would read them
+        if self.field_events is None or fields is None:
+            return
+        self.field_events.push_fields(fields, dipole=self.allowed_component == 0 and not self.is_corr)
+
     ##############################################################################################################
     #
     def dev_state(self):
         self.debug_stream("In dev_state()")
         result = PyTango.DevState.UNKNOWN
 
+        # init_power_supply failed (e.g. a PS timeout at startup): try it again once the PS can be reached
+        if self.status_str_init and self.ps_device:
+            self.unsubscribe_ps_events()
+            self.init_power_supply()
+        if self.status_str_init:
+            self.set_state(PyTango.DevState.FAULT)
+            return PyTango.DevState.FAULT
+
         # Check state of PS
         ps_state = self.get_ps_state()
 
-        # if state ok but cycler not setup, then set it up
-        if ps_state == PyTango.DevState.ON and self._cycler == None:
-            # set limits on set point
-            self.set_point_limits()
-            # set alarm levels on MainFieldComponent (etc) corresponding to the PS alarms
-            if self.hasCalibData:
-                self.set_field_limits()
-            self.setup_cycler()
+        # the parts of init_power_supply that need the PS are done again once it can be reached (it may have
+        # been down at init, and the proxy does not connect again until then)
+        if self.ps_device:
+            if not self.ps_limits_read:
+                # set limits on set point, and alarm levels on MainFieldComponent (etc) corresponding to the PS alarms
+                self.set_point_limits()
+                if self.hasCalibData:
+                    self.set_field_limits()
+            # if state ok but cycler not setup, then set it up
+            if ps_state == PyTango.DevState.ON and self._cycler == None:
+                self.setup_cycler()
+            if not self._ps_event_ids:
+                self.subscribe_ps_events()
 
         # Generally the circuit should echo the ps state
         # If we are in RUNNING, ie cycling, stay there unless ps goes to fault
@@ -563,7 +710,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
         self.check_cycling_status()
 
         # set status message
-        msg = self.status_str_prop + "\n" + self.status_str_cfg + "\n" + self.status_str_cal + "\n" + \
+        msg = self.status_str_init + "\n" + self.status_str_prop + "\n" + self.status_str_cfg + "\n" + self.status_str_cal + "\n" + \
               self.status_str_ps + "\n" + self.status_str_b + "\n" + self.status_str_cyc + "\nCycling status: " + \
               self.cyclingphase
         if self.cycling_errors:
@@ -579,9 +726,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
     # For solenoids, we store Bs there. But n reality zeroth element is zero. See wiki page for details.
     # But for correctors small theta is the zeroth component.
     def convert_dipole_vector(self, vector):
-        #vector = list(vector)
-        vector[0] = np.NAN
-        return vector
+        return convert_dipole_vector(vector)
 
     def set_ps_setpoint(self):
         # Set the setpoint on the ps
@@ -594,9 +739,10 @@ class MagnetCircuit(PyTango.Device_4Impl):
                                                                                  self.max_setpoint_value))
             self.set_point = self.min_setpoint_value
         self.debug_stream("SETTING {0} ON THE PS TO: {1} ".format(self.ps_attribute.upper(), self.set_point))
+        self.invalidate_ps_reading()
         try:
             self.ps_device.write_attribute(self.ps_attribute, self.set_point)
-        except PyTango.DevFailed as e:
+        except (AttributeError, PyTango.DevFailed) as e:  # no proxy while the PS cannot be reached
             self.status_str_ps = "Cannot set {0} on PS {1}".format(self.ps_attribute, self.PowerSupplyProxy)
 
     # -----------------------------------------------------------------------------
@@ -692,18 +838,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
                                                                                                        self.BRho,
                                                                                                        self.ps_attribute))
                 # since brho changed, need to recalc the field
-                sign = -1
-                if self.allowed_component == 0 and self.Type not in ["vkick", "Y_CORRECTOR"]:
-                    sign = 1
-                if self.Tilt == 0 and self.Type != "vkick":
-                    self.fieldB[self.allowed_component] = self.MainFieldComponent_r * self.BRho * sign
-                else:
-                    self.fieldA[self.allowed_component] = self.MainFieldComponent_r * self.BRho * sign
-
-                self.set_point \
-                    = calculate_setpoint(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix, self.BRho,
-                                         self.PolTimesOrient, self.Tilt, self.Type, self.Length, self.fieldA,
-                                         self.fieldB, self.is_sole)
+                self.set_point = self.calculate_main_field_setpoint(self.MainFieldComponent_r)
                 ###########################################################
                 # Set the new set point value on the ps
                 self.set_ps_setpoint()
@@ -711,9 +846,7 @@ class MagnetCircuit(PyTango.Device_4Impl):
                 self.debug_stream("Energy changed: will recalculate fields for the PS {0}".format(self.ps_attribute))
                 (success, self.MainFieldComponent_r, self.MainFieldComponent_w, self.fieldA, self.fieldANormalised,
                  self.fieldB, self.fieldBNormalised) \
-                    = calculate_fields(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix, self.BRho,
-                                       self.PolTimesOrient, self.Tilt, self.Type, self.Length, self.actual_measurement,
-                                       self.set_point, is_sole=self.is_sole)
+                    = self.excitation_curve.calculate_fields(self.BRho, self.actual_measurement, self.set_point)
 
     def is_energy_allowed(self, attr):
         # if writing then we need to know MeasurementValue etc
@@ -747,24 +880,26 @@ class MagnetCircuit(PyTango.Device_4Impl):
         self.debug_stream("In write_MainFieldComponent()")
         if self.hasCalibData:
             self.MainFieldComponent_w = attr.get_write_value()
-            # Note that we set the component of the field vector directly here, but
-            # calling calculate_fields will in turn set the whole vector, including this component again
-            sign = -1
-            if self.allowed_component == 0 and self.Type not in ["vkick", "Y_CORRECTOR"]:
-                sign = 1
-            if self.Tilt == 0 and self.Type != "vkick":
-                self.fieldB[self.allowed_component] = self.MainFieldComponent_w * self.BRho * sign
-            else:
-                self.fieldA[self.allowed_component] = self.MainFieldComponent_w * self.BRho * sign
-            self.set_point \
-                = calculate_setpoint(self.allowed_component, self.ps_setpoint_matrix, self.fieldsmatrix, self.BRho,
-                                     self.PolTimesOrient, self.Tilt, self.Type, self.Length, self.fieldA, self.fieldB,
-                                     self.is_sole)
+            self.set_point = self.calculate_main_field_setpoint(self.MainFieldComponent_w)
 
             ###########################################################
             # Set the value on the ps
             self.set_ps_setpoint()
 
+    def calculate_main_field_setpoint(self, main_field_component):
+        # Set point for a new value of the main field component. Note that we set the component of a copy of the
+        # field vector here, calling calculate_fields will in turn set the whole vector, including this component
+        fieldA = self.fieldA.copy()
+        fieldB = self.fieldB.copy()
+        sign = -1
+        if self.allowed_component == 0 and self.Type not in ["vkick", "Y_CORRECTOR"]:
+            sign = 1
+        if self.Tilt == 0 and self.Type != "vkick":
+            fieldB[self.allowed_component] = main_field_component * self.BRho * sign
+        else:
+            fieldA[self.allowed_component] = main_field_component * self.BRho * sign
+        return self.excitation_curve.calculate_setpoint(self.BRho, fieldA, fieldB)
+
     def is_MainFieldComponent_allowed(self, attr):
         return self.get_main_physical_quantity_and_field() and not self.field_out_of_range
 
@@ -953,6 +1088,31 @@ class MagnetCircuitClass(PyTango.DeviceClass):
             [PyTango.DevVarStringArray,
              "List of magnets on this circuit",
              ["not set"]],
+        'UsePowerSupplyEvents':
+            [PyTango.DevBoolean,
+             "Subscribe to change and periodic events on the PS current/voltage instead of reading it for every attribute",
+             [False]],
+        'PowerSupplyEventMaxAge':
+            [PyTango.DevDouble,
+             "Seconds a PS event is used for before reading the PS again. Should be longer than the PS event period",
+             [3.0]],
+        'PowerSupplyReadMaxAge':
+            [PyTango.DevDouble,
+             "Seconds the PS reading is reused for the attributes of one client request",
+             [0.5]],
+        'PushFieldEvents':
+            [PyTango.DevBoolean,
+             "Push change and archive events on the fields and MainFieldComponent when they change "
+             "(subscribes to PS events, also pushed from reads)",
+             [False]],
+        'FieldEventAbsChange':
+            [PyTango.DevDouble,
+             "Absolute change of a field needed to send an event (0 to not use)",
+             [0.0]],
+        'FieldEventRelChange':
+            [PyTango.DevDouble,
+             "Relative change (percent) of a field needed to send an event (0 to not use)",
+             [0.0]],
     }
 
 
@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##     Tango admin device for a magnet server, giving access to all the
+##     magnets and circuits of the server at once
+##
+##     This program is free software: you can redistribute it and/or modify
+##     it under the terms of the GNU General Public License as published by
+##     the Free Software Foundation, either version 3 of the License, or
+##     (at your option) any later version.
+##     This program is distributed in the hope that it will be useful,
+##     but WITHOUT ANY WARRANTY; without even the implied warranty of
+##     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+##     GNU General Public License for more details.
+##
+##     You should have received a copy of the GNU General Public License
+##     along with this program.  If not, see [http://www.gnu.org/licenses/].
+###############################################################################
+
+"""Tango admin device for a magnet server"""
+
+__all__ = ["MagnetServer", "MagnetServerClass"]
+
+__docformat__ = 'restructuredtext'
+
+import PyTango
+import json
+import math
+import time
+import numpy as np
+from localdevicelib import LocalDeviceProxy, hold_readings
+from cycling_statemachine.magnetramping import MagnetRamping
+
+#Longest wait (s) for a ramp to stop in a command, to stay within the client timeout
+_ramp_stop_timeout = 2.0
+
+#Attributes read from each class of device in the server
+FIELD_ATTRIBUTES = {
+    "MagnetCircuit": ["fieldA", "fieldB", "fieldANormalised", "fieldBNormalised", "MainFieldComponent"],
+    "TrimCircuit": ["fieldA", "fieldB", "fieldANormalised", "fieldBNormalised", "MainFieldComponent"],
+    "Magnet": ["fieldA", "fieldB", "fieldANormalised", "fieldBNormalised"],
+}
+
+#Circuits first, so the magnets (which read their circuits) come right after them
+_read_order = ["MagnetCircuit", "TrimCircuit", "Magnet"]
+
+#Attributes the magnets read from their main circuits, read along with the fields so the magnets reuse them
+HELD_ATTRIBUTES = {
+    "MagnetCircuit": ["PowerSupplyReadValue", "BRho"],
+}
+
+
+def json_value(value):
+    #NaN (component not there) is not valid JSON, so give null instead
+    if isinstance(value, np.ndarray):
+        return [json_value(v) for v in value.tolist()]
+    if isinstance(value, (float, np.floating)):
+        value = float(value)
+        if math.isnan(value):
+            return None
+    return value
+
+
+class MagnetServer(PyTango.Device_4Impl):
+
+    def __init__(self, cl, name):
+        PyTango.Device_4Impl.__init__(self, cl, name)
+        self.debug_stream("In __init__()")
+        MagnetServer.init_device(self)
+
+    def delete_device(self):
+        self.debug_stream("In delete_device()")
+        if self._ramper:
+            self._ramper.stop(_ramp_stop_timeout)
+
+    def init_device(self):
+        self.debug_stream("In init_device()")
+        self.get_device_properties(self.get_device_class())
+        self._ramper = None
+        self.set_state(PyTango.DevState.ON)
+
+    def always_executed_hook(self):
+        if self._ramper and self._ramper.is_running():
+            self.set_state(PyTango.DevState.MOVING)
+        else:
+            self.set_state(PyTango.DevState.ON)
+
+    ###############################################################################
+    #
+    def get_devices(self, class_name):
+        #the device objects of one class in this server (a class may not be in this server, e.g. TrimCircuit)
+        try:
+            return PyTango.Util.instance().get_device_list_by_class(class_name)
+        except PyTango.DevFailed:
+            return []
+
+    # -----------------------------------------------------------------------------
+    #    MagnetServer read attribute methods
+    # -----------------------------------------------------------------------------
+
+    def read_RampStatus(self, attr):
+        self.debug_stream("In read_RampStatus()")
+        if not self._ramper:
+            attr.set_value("NOT RAMPING")
+        elif self._ramper.error_stack:
+            attr.set_value(self._ramper.phase + "\n/!\\Errors during ramp : " + self._ramper.ramp_errors)
+        else:
+            attr.set_value(self._ramper.phase)
+
+    # -----------------------------------------------------------------------------
+    #    MagnetServer command methods
+    # -----------------------------------------------------------------------------
+
+    def ReadAllFields(self):
+        self.debug_stream("In ReadAllFields()")
+
+        # All devices are read in one pass, each device as one request (so one PS reading per circuit).
+        # The circuit readings are held for the pass, so the magnets get their fields from the same PS readings.
+        # For each attribute (and State) there is also a flag saying if it could be read (e.g. not when out of range).
+        devices = {}
+        start_time = time.time()
+        with hold_readings():
+            for class_name in _read_order:
+                attr_names = FIELD_ATTRIBUTES[class_name]
+                for device in self.get_devices(class_name):
+                    readings = LocalDeviceProxy(device).read_attributes(["State"] + attr_names +
+                                                                        HELD_ATTRIBUTES.get(class_name, []))
+                    state = readings[0]
+                    entry = {"class": class_name, "state": None if state.has_failed else str(state.value),
+                             "valid": {"State": not state.has_failed}}
+                    for reading in readings[1:len(attr_names) + 1]:
+                        entry[reading.name] = json_value(reading.value)
+                        entry["valid"][reading.name] = not reading.has_failed
+                    devices[device.get_name()] = entry
+
+        return json.dumps({"start_time": start_time, "end_time": time.time(), "devices": devices})
+
+    def ApplyMainFieldComponents(self, argin):
+        self.debug_stream("In ApplyMainFieldComponents()")
+
+        # argin is ([MainFieldComponent values], [MagnetCircuit names]). All set points are calculated and checked
+        # against the PS limits first, without going to the PS; if any circuit fails nothing is written. Otherwise
+        # all PS are written at once, see write_set_points.
+        (values, names) = argin
+        if len(values) != len(names):
+            PyTango.Except.throw_exception("ApplyMainFieldComponents_WrongArgument",
+                                           "Got %d values for %d circuits" % (len(values), len(names)),
+                                           "MagnetServer.ApplyMainFieldComponents()")
+        self.check_unique(names, "ApplyMainFieldComponents")
+
+        # results are by the names as given
+        results = dict((name, "OK") for name in names)
+        circuits = []
+        for (name, value) in zip(names, values):
+            (circuit, set_point, error) = self.prepare_main_field(name, value)
+            if error:
+                results[name] = error
+            else:
+                circuits.append((name, circuit, value, set_point))
+
+        applied = len(circuits) == len(names)
+        if applied:
+            errors = self.write_set_points([(name, circuit) for (name, circuit, value, set_point) in circuits],
+                                           [set_point for (name, circuit, value, set_point) in circuits],
+                                           [value for (name, circuit, value, set_point) in circuits])
+            results.update(errors)
+            applied = not errors
+        else:
+            for (name, circuit, value, set_point) in circuits:
+                results[name] = "Not applied, other circuits failed"
+
+        return json.dumps({"applied": applied, "results": results})
+
+    def StartRamp(self, argin):
+        self.debug_stream("In StartRamp()")
+
+        # argin is ([ramp time, MainFieldComponent values], [MagnetCircuit names]). The circuits are ramped together
+        # from their present PS set points to the ones of the new values, along linear trajectories that all end
+        # after the ramp time. At each tick (RampStepRate per second) the PS of all circuits are written at once.
+        # As for ApplyMainFieldComponents, if any circuit fails the checks nothing is started.
+        (values, names) = argin
+        if len(values) != len(names) + 1:
+            PyTango.Except.throw_exception("StartRamp_WrongArgument",
+                                           "Need the ramp time and %d values for %d circuits, got %d numbers"
+                                           % (len(names), len(names), len(values)),
+                                           "MagnetServer.StartRamp()")
+        self.check_unique(names, "StartRamp")
+        ramp_time = values[0]
+        if math.isinf(ramp_time) or math.isnan(ramp_time) or ramp_time < 0:
+            PyTango.Except.throw_exception("StartRamp_WrongArgument",
+                                           "Ramp time must be a finite number of seconds >= 0, got %s" % ramp_time,
+                                           "MagnetServer.StartRamp()")
+        if not self.RampStepRate > 0:
+            PyTango.Except.throw_exception("StartRamp_WrongConfiguration",
+                                           "RampStepRate must be > 0, is %s" % self.RampStepRate,
+                                           "MagnetServer.StartRamp()")
+
+        # all circuits are checked before a running ramp is stopped, so a rejected ramp leaves it running
+        results = dict((name, "OK") for name in names)
+        circuits = []
+        for (name, value) in zip(names, values[1:]):
+            (circuit, set_point, error) = self.prepare_main_field(name, value)
+            if error:
+                results[name] = error
+            else:
+                circuits.append((name, circuit, value, set_point))
+        if len(circuits) != len(names):
+            for (name, circuit, value, set_point) in circuits:
+                results[name] = "Not started, other circuits failed"
+            return json.dumps({"started": False, "results": results})
+
+        if self._ramper and not self._ramper.stop(_ramp_stop_timeout):
+            PyTango.Except.throw_exception("StartRamp_Busy", "The previous ramp is still stopping, try again",
+                                           "MagnetServer.StartRamp()")
+
+        # the ramp starts from the present PS set points, read once the previous ramp has stopped
+        ramp_circuits = [(name, circuit) for (name, circuit, value, set_point) in circuits]
+        (starts, errors) = self.read_set_points(ramp_circuits)
+        if errors:
+            results.update(errors)
+            for (name, circuit) in ramp_circuits:
+                if name not in errors:
+                    results[name] = "Not started, other circuits failed"
+            return json.dumps({"started": False, "results": results})
+
+        targets = [set_point for (name, circuit, value, set_point) in circuits]
+        values = [value for (name, circuit, value, set_point) in circuits]
+        self._ramper = MagnetRamping(lambda set_points: self.write_ramp_step(ramp_circuits, set_points,
+                                                                             targets, values),
+                                     starts, targets, ramp_time, self.RampStepRate)
+        self._ramper.start()
+        self.set_state(PyTango.DevState.MOVING)
+        return json.dumps({"started": True, "results": results})
+
+    def StopRamp(self):
+        self.debug_stream("In StopRamp()")
+        # the circuits stay at the set points of the last tick; MOVING until the ramp thread has ended
+        if self._ramper and not self._ramper.stop(_ramp_stop_timeout):
+            self.set_state(PyTango.DevState.MOVING)
+        else:
+            self.set_state(PyTango.DevState.ON)
+
+    def write_ramp_step(self, circuits, set_points, targets, values):
+        # MainFieldComponent_w is only known on the last tick, when the targets are written; until then the
+        # circuits work it out from the PS set point on the next read
+        main_field_components = values if list(set_points) == list(targets) else None
+        errors = self.write_set_points(circuits, set_points, main_field_components)
+        if errors:
+            PyTango.Except.throw_exception("StartRamp_WriteFailed",
+                                           "; ".join("%s: %s" % item for item in sorted(errors.items())),
+                                           "MagnetServer.write_ramp_step()")
+
+    def read_set_points(self, circuits):
+        # Reads the set points on the PS of the circuits ((name, circuit) pairs), all at once (asynchronous reads).
+        # Returns the set points in the order of circuits, and the error messages by circuit name.
+        errors = {}
+        requests = []
+        for (name, circuit) in circuits:
+            with PyTango.AutoTangoMonitor(circuit):
+                ps_device = circuit.ps_device  # None while the PS cannot be reached
+            if ps_device is None:
+                errors[name] = "Cannot read %s from PS: no connection" % circuit.ps_attribute
+                continue
+            try:
+                requests.append((name, circuit, ps_device, ps_device.read_attribute_asynch(circuit.ps_attribute)))
+            except PyTango.DevFailed as df:
+                errors[name] = "Cannot read %s from PS: %s" % (circuit.ps_attribute, df[0].desc)
+        set_points = {}
+        for (name, circuit, ps_device, request_id) in requests:
+            try:
+                set_points[name] = ps_device.read_attribute_reply(request_id, ps_device.get_timeout_millis()).w_value
+            except PyTango.DevFailed as df:
+                errors[name] = "Cannot read %s from PS: %s" % (circuit.ps_attribute, df[0].desc)
+        return ([set_points.get(name) for (name, circuit) in circuits], errors)
+
+    def write_set_points(self, circuits, set_points, main_field_components=None):
+        # Writes the set points to the PS of the circuits ((name, circuit) pairs), all at once (asynchronous
+        # writes), so it takes about one PS write time however many circuits. Only the PS requests are made outside
+        # the circuit device monitors; the circuit state is updated under them, as for a client write.
+        # MainFieldComponent_w is set for the circuits written if main_field_components are given.
+        # Returns the error messages by circuit name.
+        if main_field_components is None:
+            main_field_components = [None] * len(circuits)
+        errors = {}
+        requests = []
+        for ((name, circuit), set_point, main_field_component) in zip(circuits, set_points, main_field_components):
+            with PyTango.AutoTangoMonitor(circuit):
+                ps_device = circuit.ps_device  # None while the PS cannot be reached
+            if ps_device is None:
+                errors[name] = "Cannot set %s on PS: no connection" % circuit.ps_attribute
+                continue
+            try:
+                requests.append((name, circuit, ps_device, set_point, main_field_component,
+                                 ps_device.write_attribute_asynch(circuit.ps_attribute, set_point)))
+            except PyTango.DevFailed as df:
+                errors[name] = "Cannot set %s on PS: %s" % (circuit.ps_attribute, df[0].desc)
+        for (name, circuit, ps_device, set_point, main_field_component, request_id) in requests:
+            try:
+                ps_device.write_attribute_reply(request_id, ps_device.get_timeout_millis())
+            except PyTango.DevFailed as df:
+                errors[name] = "Cannot set %s on PS: %s" % (circuit.ps_attribute, df[0].desc)
+                written = False
+            else:
+                written = True
+            with PyTango.AutoTangoMonitor(circuit):
+                # whether written or not, the next read must go to the PS again
+                circuit.invalidate_ps_reading()
+                if written:
+                    circuit.set_point = set_point
+                    if main_field_component is not None:
+                        circuit.MainFieldComponent_w = main_field_component
+        return errors
+
+    def check_unique(self, names, command):
+        # each circuit once, otherwise its results would collapse into one and it would be written twice
+        repeated = sorted(set(name for name in names if names.count(name) > 1))
+        if repeated:
+            PyTango.Except.throw_exception(command + "_WrongArgument",
+                                           "Circuits given more than once: " + ", ".join(repeated),
+                                           "MagnetServer.%s()" % command)
+
+    def prepare_main_field(self, name, value):
+        # (circuit, set point, error message) for writing value to MainFieldComponent of circuit name. The set
+        # point only depends on the calibration and BRho, so the PS is not read here (that would be one PS round
+        # trip per circuit before any write); a PS that cannot be reached shows up when writing.
+        try:
+            circuit = PyTango.Util.instance().get_device_by_name(name)
+        except PyTango.DevFailed:
+            return (None, None, "Not a circuit in this server")
+        if circuit.get_device_class().get_name() != "MagnetCircuit":
+            return (None, None, "Not a MagnetCircuit")
+
+        with PyTango.AutoTangoMonitor(circuit):
+            if not circuit.hasCalibData:
+                return (circuit, None, "Cannot write MainFieldComponent (not calibrated)")
+            set_point = circuit.calculate_main_field_setpoint(value)
+            if not circuit.ps_limits_read and circuit.ps_device:
+                # the PS was not there at init, and no State request has read its limits since
+                circuit.set_point_limits()
+            if circuit.min_setpoint_value is None or circuit.max_setpoint_value is None:
+                return (circuit, None, "PS limits unknown")
+            if not circuit.min_setpoint_value <= set_point <= circuit.max_setpoint_value:
+                return (circuit, None, "Set point %f outside PS limits (%f, %f)" % (set_point,
+                                                                                   circuit.min_setpoint_value,
+                                                                                   circuit.max_setpoint_value))
+        return (circuit, set_point, None)
+
+
+class MagnetServerClass(PyTango.DeviceClass):
+    # Class Properties
+    class_property_list = {
+        'ParallelInitThreads':
+            [PyTango.DevLong,
+             "Threads for the PS and switchboard parts of the circuit inits at server startup "
+             "(0 to init the devices one after the other)",
+             [0]],
+    }
+
+
+    # Device Properties
+    device_property_list = {
+        'RampStepRate':
+            [PyTango.DevDouble,
+             "Number of set point steps per second written by StartRamp",
+             [10.0]],
+    }
+
+
+    # Command definitions
+    cmd_list = {
+        'ReadAllFields':
+            [[PyTango.DevVoid, ""],
+             [PyTango.DevString, "JSON with the field vectors, MainFieldComponent and validity of every magnet and "
+                                 "circuit in the server"]],
+        'ApplyMainFieldComponents':
+            [[PyTango.DevVarDoubleStringArray, "MainFieldComponent values and the MagnetCircuit names to write them to"],
+             [PyTango.DevString, "JSON with applied (true if all were written) and the result for each circuit"]],
+        'StartRamp':
+            [[PyTango.DevVarDoubleStringArray, "Ramp time (s) followed by the MainFieldComponent values, and the "
+                                               "MagnetCircuit names to ramp to them"],
+             [PyTango.DevString, "JSON with started (true if the ramp started) and the result for each circuit"]],
+        'StopRamp':
+            [[PyTango.DevVoid, ""],
+             [PyTango.DevVoid, ""]],
+    }
+
+
+    # Attribute definitions
+    attr_list = {
+        'RampStatus':
+            [[PyTango.DevString,
+              PyTango.SCALAR,
+              PyTango.READ],
+             {
+                 'label': "Ramp Status",
+                 'doc': "status of the last StartRamp"
+             }],
+    }
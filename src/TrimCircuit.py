@@ -30,8 +30,12 @@ import sys
 import numpy as np
 from math import sqrt
 import time
-from magnetcircuitlib import calculate_fields, calculate_setpoint
+from magnetcircuitlib import ExcitationCurve
 from processcalibrationlib import process_calibration_data
+from magnetpropertylib import get_device_properties
+from fieldeventlib import setup_field_events
+from initpoollib import run_init_task
+from proxymanagerlib import ManagedProxy
 
 ##############################################################################################################
 #
@@ -46,6 +50,27 @@ class TrimCircuit (PyTango.Device_4Impl):
                   "X_CORRECTOR",
                   "Y_CORRECTOR"]
 
+    #allowed component for each mode
+    MODE_COMPONENTS = {"SEXTUPOLE"        : 2,
+                       "NORMAL_QUADRUPOLE": 1,
+                       "SKEW_QUADRUPOLE"  : 1,
+                       "X_CORRECTOR"      : 0,
+                       "Y_CORRECTOR"      : 0}
+
+    #units and labels of MainFieldComponent and IntMainFieldComponent for each mode
+    MODE_UNITS = {"SEXTUPOLE"        : ("m ^-3", "k2",    "m ^-2", "length integrated k2"),
+                  "NORMAL_QUADRUPOLE": ("m ^-2", "k1",    "m ^-1", "length integrated k1"),
+                  "SKEW_QUADRUPOLE"  : ("m ^-2", "k1",    "m ^-1", "length integrated k1"),
+                  "X_CORRECTOR"      : ("rad",   "theta", "rad m", "length integrated theta"),
+                  "Y_CORRECTOR"      : ("rad",   "theta", "rad m", "length integrated theta")}
+
+    #calibration properties of each mode (TrimExcitationCurveCurrents_<...> and TrimExcitationCurveFields_<...>)
+    MODE_CALIBRATIONS = {"SEXTUPOLE"        : "normal_sextupole",
+                         "NORMAL_QUADRUPOLE": "normal_quadrupole",
+                         "SKEW_QUADRUPOLE"  : "skew_quadrupole",
+                         "X_CORRECTOR"      : "x_corrector",
+                         "Y_CORRECTOR"      : "y_corrector"}
+
     #allowed types of trim coils (only SX type has sextupole mode!)
     #MODE_TYPES = ["OXX", "OXY", "OYY", "SXDE"]
 
@@ -57,6 +82,10 @@ class TrimCircuit (PyTango.Device_4Impl):
 
     def delete_device(self):
         self.debug_stream("In delete_device()")
+        self.unsubscribe_swb_events()
+        self.unsubscribe_ps_events()
+        self._swb_device.stop()
+        self._ps_device.stop()
 
 
     def init_device(self):
@@ -89,20 +118,25 @@ class TrimCircuit (PyTango.Device_4Impl):
         self.status_str_cal   = {}
         self.status_str_cfg   = ""
         self.status_str_fin   = ""
+        self.status_str_init  = "" #set if init_switchboard failed; FAULT until it works (see get_circuit_state)
         self.field_out_of_range = False
 
         #Proxy to switch board device
-        self._swb_device = None
+        self._swb_device = ManagedProxy(self.SwitchBoardProxy)
         self.Mode = None #one of the allowed modes
         self.oldMode = None #keep track of mode changes
+        self._swb_event_id = None
+        self._swb_event_mode = None #mode from the last SWB event, None to read it from the SWB
 
         #Proxy to power supply device
-        self._ps_device = None
+        self._ps_device = ManagedProxy(self.PowerSupplyProxy)
         self.actual_measurement = None
         self.set_point = None
+        self._ps_event_id = None
 
-        #set limits on current
-        self.set_point_limits()
+        #limits on current, read from the PS in init_switchboard (or by dev_state, if the PS was not reached)
+        self.min_setpoint_value = self.max_setpoint_value = None
+        self.ps_limits_read = False
 
         #read the properties from the Tango DB, including calib data (length, powersupply proxy...)  
         self.PolTimesOrient = 1 #always one for circuit
@@ -111,47 +145,48 @@ class TrimCircuit (PyTango.Device_4Impl):
         self.get_magnet_length() #...this is reading from the magnet, not the circuit!
         #
 
-        #process the calibration data into useful numpy arrays
+        #the calibration data of a mode is processed into useful numpy arrays when first switching to it (see load_calibration)
         self.fieldsmatrix = {} #calibration data accessed via mode
         self.currentsmatrix = {}
         self.hasCalibData = {} #a flag per mode
+        self.excitation_curves = {}
+        self.ps_event_curves = {} #separate curves for the PS event thread, since a curve reuses its result arrays
+        self.mode_tables = {} #everything that depends on the mode only, see get_mode_table
+        self.mode_table = None #table of the present mode
 
         #need to know which type of trim circuit this is (SXDE, OXY, etc)
         #The device names contains the type, e.g R3-301M1/MAG/CRTOXX-01
-        trim_type = self.get_name().split("/")[-1].split("-")[0]
-
-        #normal quadrupole
-        typearg="NORMAL_QUADRUPOLE"
-        (self.hasCalibData[typearg], self.status_str_cal[typearg],  self.fieldsmatrix[typearg],  self.currentsmatrix[typearg]) \
-            = process_calibration_data(self.TrimExcitationCurveCurrents_normal_quadrupole,self.TrimExcitationCurveFields_normal_quadrupole, 1)
-
-        #skew quadrupole - fills An
-        typearg="SKEW_QUADRUPOLE"
-        (self.hasCalibData[typearg], self.status_str_cal[typearg],  self.fieldsmatrix[typearg],  self.currentsmatrix[typearg]) \
-            = process_calibration_data(self.TrimExcitationCurveCurrents_skew_quadrupole,self.TrimExcitationCurveFields_skew_quadrupole, 1)
-
-
-        #horizontal correction
-        typearg="X_CORRECTOR"
-        (self.hasCalibData[typearg], self.status_str_cal[typearg],  self.fieldsmatrix[typearg],  self.currentsmatrix[typearg]) \
-            = process_calibration_data(self.TrimExcitationCurveCurrents_x_corrector,self.TrimExcitationCurveFields_x_corrector, 0)
-
-        #vertical correction - fills An
-        typearg="Y_CORRECTOR"
-        (self.hasCalibData[typearg], self.status_str_cal[typearg],  self.fieldsmatrix[typearg],  self.currentsmatrix[typearg]) \
-            = process_calibration_data(self.TrimExcitationCurveCurrents_y_corrector,self.TrimExcitationCurveFields_y_corrector, 0)
-
-        #only sextupole types have sextupole modes:
-        if "SX" in trim_type:
-            typearg="SEXTUPOLE"
-            (self.hasCalibData[typearg], self.status_str_cal[typearg],  self.fieldsmatrix[typearg],  self.currentsmatrix[typearg]) \
-                = process_calibration_data(self.TrimExcitationCurveCurrents_normal_sextupole,self.TrimExcitationCurveFields_normal_sextupole, 2)
-
+        self.trim_type = self.get_name().split("/")[-1].split("-")[0]
 
         #The switchboard mode determines the allowed field component to be controlled.
         #Note that in the multipole expansion we have:
         self.allowed_component = 0
-        self.get_swb_mode()
+
+        #optionally push events on the fields, so clients need not poll them
+        self.field_events = None
+        if self.PushFieldEvents:
+            self.field_events = setup_field_events(self, self.FieldEventAbsChange, self.FieldEventRelChange)
+
+        #the rest of the init only waits on the PS and SWB, so at server startup it can run alongside other devices
+        run_init_task(self.init_switchboard)
+
+    def init_switchboard(self):
+        #at server startup this runs in an init pool thread, so take the device monitor as a request would
+        with PyTango.AutoTangoMonitor(self):
+            try:
+                #set limits on current, then the mode (its field limits come from the current limits)
+                self.set_point_limits()
+                self.subscribe_swb_events()
+                self.get_swb_mode()
+                self.subscribe_ps_events()
+                self.status_str_init = ""
+            except Exception as e:
+                if isinstance(e, PyTango.DevFailed):
+                    e = e[0].desc
+                self.status_str_init = "Init with SWB %s and PS %s failed: %s" % (self.SwitchBoardProxy, self.PowerSupplyProxy, e)
+                self.error_stream(self.status_str_init)
+                self.set_state(PyTango.DevState.FAULT)
+                self.set_status(self.status_str_init)
 
     ###############################################################################
     #
@@ -163,23 +198,21 @@ class TrimCircuit (PyTango.Device_4Impl):
     #
     @property
     def ps_device(self):
-        if self._ps_device is None:
-            try:
-                self._ps_device = PyTango.DeviceProxy(self.PowerSupplyProxy)
-            except (PyTango.DevFailed, PyTango.ConnectionFailed) as df:
-                self.debug_stream("Failed to get power supply proxy\n" + df[0].desc)
-        return self._ps_device
+        #None straight away while the PS cannot be reached (it is reconnected in the background)
+        ps_device = self._ps_device.get()
+        if ps_device is None:
+            self.debug_stream("Failed to get power supply proxy\n" + self._ps_device.error)
+        return ps_device
 
     ###############################################################################
     #
     @property
     def swb_device(self):
-        if self._swb_device is None:
-            try:
-                self._swb_device = PyTango.DeviceProxy(self.SwitchBoardProxy)
-            except (PyTango.DevFailed, PyTango.ConnectionFailed) as df:
-                self.debug_stream("Failed to get switch board proxy\n" + df[0].desc)
-        return self._swb_device
+        #None straight away while the SWB cannot be reached (it is reconnected in the background)
+        swb_device = self._swb_device.get()
+        if swb_device is None:
+            self.debug_stream("Failed to get switch board proxy\n" + self._swb_device.error)
+        return swb_device
 
     ##############################################################################################################
     #
@@ -187,11 +220,13 @@ class TrimCircuit (PyTango.Device_4Impl):
 
         #Check length of actual magnet devices (should all be the same on one circuit)
         problematic_devices = set()  # let's be optimistic
+        magnet_properties = get_device_properties(self.MagnetProxies, ["Length"])
         for (i, magnet_device_name) in enumerate(self.MagnetProxies):
-            magnet_device = PyTango.DeviceProxy(magnet_device_name)
             try:
-                newlength = float(magnet_device.get_property("Length")["Length"][0])
-            except (IndexError,PyTango.DevFailed):
+                if isinstance(magnet_properties[i], PyTango.DevFailed):
+                    raise magnet_properties[i]
+                newlength = float(magnet_properties[i]["Length"][0])
+            except (IndexError,KeyError,PyTango.DevFailed):
                 newlength = 1
             if i == 0:
                 self.Length = newlength
@@ -206,42 +241,78 @@ class TrimCircuit (PyTango.Device_4Impl):
         else:
             self.debug_stream("Magnet length :  %f " % (self.Length))
 
+    ##############################################################################################################
+    #
+    def load_calibration(self, mode):
+
+        #process the calibration data of a mode the first time it is used, then keep it
+        if mode in self.hasCalibData:
+            return self.hasCalibData[mode]
+
+        #only sextupole types have sextupole modes:
+        if mode == "SEXTUPOLE" and "SX" not in self.trim_type:
+            self.status_str_cal[mode] = "No sextupole mode for trim type %s" % self.trim_type
+            self.hasCalibData[mode] = False
+            return False
+
+        self.debug_stream("Processing calibration data for mode %s" % mode)
+        calibration = self.MODE_CALIBRATIONS[mode]
+        (hasCalibData, self.status_str_cal[mode], self.fieldsmatrix[mode], self.currentsmatrix[mode]) \
+            = process_calibration_data(getattr(self, "TrimExcitationCurveCurrents_" + calibration),
+                                       getattr(self, "TrimExcitationCurveFields_" + calibration), self.MODE_COMPONENTS[mode])
+
+        #compile the excitation curve if calibrated
+        if hasCalibData:
+            self.excitation_curves[mode] = ExcitationCurve(self.MODE_COMPONENTS[mode], self.currentsmatrix[mode], self.fieldsmatrix[mode], self.PolTimesOrient, self.Tilt, mode, self.Length, is_sole=False)
+        self.hasCalibData[mode] = hasCalibData
+        return hasCalibData
+
+    ##############################################################################################################
+    #
+    def get_mode_table(self, mode):
+
+        #Everything derived from the mode, made with its calibration and then kept, so that a mode change only
+        #swaps tables: (mode, allowed component, units and labels, main field component limits at the PS limits
+        #for b.rho 1 (None if unknown, see update_limits), True if the main field component is in fieldA, sign of the component)
+        if mode in self.mode_tables:
+            return self.mode_tables[mode]
+
+        allowed_component = self.MODE_COMPONENTS[mode]
+        limits = None
+        if self.load_calibration(mode) and self.max_setpoint_value != None and self.min_setpoint_value != None:
+            #the main field component is normalised, i.e. goes as 1/b.rho
+            (lo, hi) = self.excitation_curves[mode].calculate_fields_array(1.0, [self.min_setpoint_value, self.max_setpoint_value], find_limit=True)[1]
+            limits = (min(lo, hi), max(lo, hi))
+        sign = -1
+        if allowed_component == 0 and mode not in ["vkick","Y_CORRECTOR"]:
+            sign =  1
+        fill_A = mode in ["SKEW_QUADRUPOLE","Y_CORRECTOR"]
+
+        table = (mode, allowed_component, self.MODE_UNITS[mode], limits, fill_A, sign)
+        self.mode_tables[mode] = table
+        return table
+
     ##############################################################################################################
     #
     def config_type(self):
 
+        #set the attribute configuration for the mode table in use, limits included
+        (mode, allowed_component, (unit, label, int_unit, int_label), limits, fill_A, sign) = self.mode_table
+
         att_vc = self.get_device_attr().get_attr_by_name("MainFieldComponent")
         multi_prop_vc = PyTango.MultiAttrProp()
         att_vc.get_properties(multi_prop_vc)
         multi_prop_vc.description = "The variable component of the field, which depends on the magnet type (k2 for sextupoles, k1 for quads, theta for dipoles, B_s for solenoids)"
+        multi_prop_vc.unit   = unit
+        multi_prop_vc.label  = label
+        self.set_field_limit_properties(multi_prop_vc)
 
         att_ivc = self.get_device_attr().get_attr_by_name("IntMainFieldComponent")
         multi_prop_ivc = PyTango.MultiAttrProp()
         att_ivc.get_properties(multi_prop_ivc)
         multi_prop_ivc.description = "The length integrated variable component of the field for quadrupoles and sextupoles (k2*l for sextupoles, k1*l for quads)."
-
-        if self.Mode in ["SKEW_QUADRUPOLE","NORMAL_QUADRUPOLE"]:
-            self.allowed_component = 1
-            multi_prop_vc.unit   = "m ^-2"
-            multi_prop_vc.label  = "k1"
-            multi_prop_ivc.unit  = "m ^-1"
-            multi_prop_ivc.label = "length integrated k1"
-        elif self.Mode == "SEXTUPOLE":
-            self.allowed_component = 2
-            multi_prop_vc.unit   = "m ^-3"
-            multi_prop_vc.label  = "k2"
-            multi_prop_ivc.unit  = "m ^-2"
-            multi_prop_ivc.label = "length integrated k2"
-        elif self.Mode in ["X_CORRECTOR","Y_CORRECTOR"]:
-            self.allowed_component = 0
-            multi_prop_vc.unit   = "rad"
-            multi_prop_vc.label  = "theta"
-            multi_prop_ivc.unit  = "rad m"
-            multi_prop_ivc.label = "length integrated theta"
-        else:
-            self.status_str_cfg = 'Mode type invalid: %s' % self.Mode
-            self.debug_stream(self.status_str_cfg)
-            return False
+        multi_prop_ivc.unit  = int_unit
+        multi_prop_ivc.label = int_label
 
         att_vc.set_properties(multi_prop_vc)
         att_ivc.set_properties(multi_prop_ivc)
@@ -252,6 +323,7 @@ class TrimCircuit (PyTango.Device_4Impl):
     def set_point_limits(self):
 
         self.min_setpoint_value = self.max_setpoint_value = None
+        self.ps_limits_read = False
         try:
 
             max_setpoint_s = self.ps_device.get_attribute_config("Current").max_value
@@ -263,36 +335,41 @@ class TrimCircuit (PyTango.Device_4Impl):
             else:
                 self.max_setpoint_value = float(max_setpoint_s)
                 self.min_setpoint_value = float(min_setpoint_s)
-                
+            self.ps_limits_read = True
+
         except (AttributeError, PyTango.DevFailed):
             self.debug_stream("Cannot read current limits from PS " + self.PowerSupplyProxy)
 
 
+    def update_limits(self):
+
+        #read the current limits again; the mode tables made without them are made again with them
+        self.set_point_limits()
+        if self.ps_limits_read:
+            self.mode_tables = {}
+            if self.mode_table is not None:
+                self.mode_table = self.get_mode_table(self.mode_table[0])
+                self.set_field_limits()
+
     ##############################################################################################################
     #
     def set_field_limits(self):
 
-        if self.max_setpoint_value != None and self.min_setpoint_value != None:
-
-            #Set the limits on the variable component (k1 etc) which will change if the energy changes
+        #Set the limits on the variable component (k1 etc) which will change if the energy changes
+        if self.mode_table is not None and self.mode_table[3] is not None:
             att = self.get_device_attr().get_attr_by_name("MainFieldComponent")
             multi_prop = PyTango.MultiAttrProp()
             att.get_properties(multi_prop)
+            self.set_field_limit_properties(multi_prop)
+            att.set_properties(multi_prop)
 
-            minMainFieldComponent = calculate_fields(self.allowed_component, self.currentsmatrix[self.Mode], self.fieldsmatrix[self.Mode], self.BRho, self.PolTimesOrient, self.Tilt, self.Mode, self.Length,  self.min_setpoint_value, is_sole=False, find_limit=True)[1]
-            maxMainFieldComponent = calculate_fields(self.allowed_component, self.currentsmatrix[self.Mode], self.fieldsmatrix[self.Mode], self.BRho, self.PolTimesOrient, self.Tilt, self.Mode, self.Length,  self.max_setpoint_value, is_sole=False, find_limit=True)[1]
-
-            #print "calc min  limit for ", self.mincurrent, minMainFieldComponent
-            #print "calc max  limit for ", self.maxcurrent, maxMainFieldComponent
-
-            if minMainFieldComponent<maxMainFieldComponent:
-                multi_prop.min_value=minMainFieldComponent
-                multi_prop.max_value=maxMainFieldComponent
-            else:
-                multi_prop.min_value=maxMainFieldComponent
-                multi_prop.max_value=minMainFieldComponent
+    def set_field_limit_properties(self, multi_prop):
 
-            att.set_properties(multi_prop)
+        #the limits of the mode table are for b.rho 1 (b.rho is positive, so the order stays)
+        limits = self.mode_table[3]
+        if limits is not None:
+            multi_prop.min_value = limits[0] / self.BRho
+            multi_prop.max_value = limits[1] / self.BRho
 
 
     ##############################################################################################################
@@ -336,10 +413,12 @@ class TrimCircuit (PyTango.Device_4Impl):
                 if self.Mode in self.hasCalibData and self.hasCalibData[self.Mode]:
                     #calculate the actual and set fields
                     (success, self.MainFieldComponent_r, self.MainFieldComponent_w, self.fieldA, self.fieldANormalised, self.fieldB, self.fieldBNormalised)  \
-                        = calculate_fields(self.allowed_component, self.currentsmatrix[self.Mode], self.fieldsmatrix[self.Mode], self.BRho, self.PolTimesOrient, self.Tilt, self.Mode, self.Length, self.actual_measurement, self.set_point, is_sole=False)
+                        = self.excitation_curves[self.Mode].calculate_fields(self.BRho, self.actual_measurement, self.set_point)
                     if success==False:
                         self.status_str_b = "Cannot interpolate read/set currents %f/%f " % (self.actual_measurement,self.set_point)
                         self.field_out_of_range = True
+                    else:
+                        self.push_fields((success, self.MainFieldComponent_r, self.MainFieldComponent_w, self.fieldA, self.fieldANormalised, self.fieldB, self.fieldBNormalised))
                     return True
                 else: #if not calib data, can read current but not field
                     self.status_str_b = "Circuit device may only read current"
@@ -351,45 +430,125 @@ class TrimCircuit (PyTango.Device_4Impl):
             return False
 
 
+    ##############################################################################################################
+    #
+    def subscribe_ps_events(self):
+
+        #With field events, change events on the PS current push the fields also when nobody reads them.
+        #Reads still go to the PS.
+        if self.field_events is None or not self.ps_device:
+            return
+        try:
+            #stateless, so keeps trying if the PS is not there yet
+            self._ps_event_id = self.ps_device.subscribe_event("Current", PyTango.EventType.CHANGE_EVENT,
+                                                               self.ps_event_received, [], True)
+        except PyTango.DevFailed as df:
+            self.debug_stream("Cannot subscribe to current events on PS %s: %s" % (self.PowerSupplyProxy, df[0].desc))
+
+    def unsubscribe_ps_events(self):
+        if self._ps_event_id is not None:
+            try:
+                self._ps_device.proxy.unsubscribe_event(self._ps_event_id)
+            except PyTango.DevFailed:
+                pass
+        self._ps_event_id = None
+
+    def ps_event_received(self, event):
+        #called from the event thread; fields of the present mode, once it is configured and calibrated
+        mode_table = self.mode_table
+        if event.err or event.attr_value is None or mode_table is None:
+            return
+        mode = mode_table[0]
+        if not self.hasCalibData.get(mode):
+            return
+        if mode not in self.ps_event_curves:
+            self.ps_event_curves[mode] = ExcitationCurve(self.MODE_COMPONENTS[mode], self.currentsmatrix[mode], self.fieldsmatrix[mode], self.PolTimesOrient, self.Tilt, mode, self.Length, is_sole=False)
+        fields = self.ps_event_curves[mode].calculate_fields(self.BRho, event.attr_value.value, event.attr_value.w_value)
+        self.push_fields(fields, mode_table)
+
+    def push_fields(self, fields, mode_table=None):
+        #push the newly calculated fields, as the clients would read them. As on MagnetCircuit, the zeroth
+        #element is read as NaN for dipoles but not for correctors, and the trim modes at component 0 are correctors.
+        if self.field_events is None:
+            return
+        (mode, allowed_component) = (mode_table or self.mode_table)[:2]
+        dipole = allowed_component == 0 and mode not in ["X_CORRECTOR", "Y_CORRECTOR"]
+        self.field_events.push_fields(fields, dipole=dipole)
+
     ##############################################################################################################
     #
     def get_swb_mode(self):
 
         self.debug_stream("In get_swb_mode()")
 
-        if self.swb_device:
+        #with SWB events the mode is the one of the last event, it is only read when there is none
+        event_mode = self._swb_event_mode
+        if event_mode is not None:
+            self.Mode = event_mode
+
+        elif self.swb_device:
             try:
                 self.Mode =  self.swb_device.Mode
             except:
                 self.debug_stream("Cannot read mode on SWB " + self.SwitchBoardProxy)
                 self.Mode = "MODE UNREADABLE"
                 return False
-            else:
-                #whatever the mode is determines the type of behaviour of the trim coil (quad, sext, etc)
-                #should maybe be event driven, not redetermine each time!
-                if self.oldMode == None or self.Mode != self.oldMode:
-                    self.debug_stream("SWB mode changed")
-                    self.oldMode=self.Mode
-                    if self.Mode not in self.MODE_NAMES:
-                        self.oldMode = None
-                        self.Mode = "MODE INVALID"
-                        return False
-
-                    #set the allowed component, unit of k, etc
-                    config_type_ok = self.config_type() 
-                    if config_type_ok == False:
-                        return False
-
-                    #set alarm levels on MainFieldComponent (etc) corresponding to the PS alarms
-                    if self.hasCalibData[self.Mode]:
-                        self.set_field_limits()
-
-                return True
 
         else:
             self.debug_stream("Read SWB mode:  cannot get proxy to " + self.SwitchBoardProxy)
             return False
 
+        #whatever the mode is determines the type of behaviour of the trim coil (quad, sext, etc)
+        #only reconfigured when the mode changes
+        if self.oldMode == None or self.Mode != self.oldMode:
+            self.debug_stream("SWB mode changed")
+            self.oldMode=self.Mode
+            if self.Mode not in self.MODE_NAMES:
+                self.oldMode = None
+                self.Mode = "MODE INVALID"
+                return False
+
+            #swap in the table of the mode, then set the allowed component, unit of k, etc, and
+            #alarm levels on MainFieldComponent (etc) corresponding to the PS alarms
+            self.mode_table = self.get_mode_table(self.Mode)
+            self.allowed_component = self.mode_table[1]
+            config_type_ok = self.config_type() 
+            if config_type_ok == False:
+                return False
+
+        return True
+
+    ##############################################################################################################
+    #
+    def subscribe_swb_events(self):
+
+        #Change events on the SWB mode save reading it for every state and attribute request. If there are
+        #no events (error events, e.g. SWB down or events not configured), the mode is read from the SWB as before.
+        if not self.UseSwitchBoardEvents or not self.swb_device:
+            return
+        try:
+            #stateless, so keeps trying if the SWB is not there yet
+            self._swb_event_id = self.swb_device.subscribe_event("Mode", PyTango.EventType.CHANGE_EVENT,
+                                                                 self.swb_event_received, [], True)
+        except PyTango.DevFailed as df:
+            self.debug_stream("Cannot subscribe to mode events on SWB %s: %s" % (self.SwitchBoardProxy, df[0].desc))
+
+    def unsubscribe_swb_events(self):
+        if self._swb_event_id is not None:
+            try:
+                self._swb_device.proxy.unsubscribe_event(self._swb_event_id)
+            except PyTango.DevFailed:
+                pass
+        self._swb_event_id = None
+        self._swb_event_mode = None
+
+    def swb_event_received(self, event):
+        #called from the event thread; the device is reconfigured by the next get_swb_mode if the mode changed
+        if event.err or event.attr_value is None:
+            self._swb_event_mode = None
+        else:
+            self._swb_event_mode = event.attr_value.value
+
     ##############################################################################################################
     #
     #def get_swb_state(self):
@@ -420,6 +579,19 @@ class TrimCircuit (PyTango.Device_4Impl):
 
     def dev_state(self):
         self.debug_stream("In dev_state()")
+        state = self.get_circuit_state()
+        self.set_state(state)
+        return state
+
+    def get_circuit_state(self):
+
+        #init_switchboard failed (e.g. a PS timeout at startup): try it again once the SWB and PS can be reached
+        if self.status_str_init and self.swb_device and self.ps_device:
+            self.unsubscribe_swb_events()
+            self.unsubscribe_ps_events()
+            self.init_switchboard()
+        if self.status_str_init:
+            return PyTango.DevState.FAULT
 
         #First check SWB state
         #swb_state = self.get_swb_state()
@@ -427,6 +599,10 @@ class TrimCircuit (PyTango.Device_4Impl):
         #    self.status_str_swb = "SwitchBoard Device is in state " + str(swb_state)
         #    return swb_state
 
+        #the SWB may have been down at init, so subscribe once it can be reached
+        if self._swb_event_id is None:
+            self.subscribe_swb_events()
+
         #SWB might be OK but mode invalid
         self.get_swb_mode()
         if self.Mode not in self.MODE_NAMES:
@@ -434,12 +610,21 @@ class TrimCircuit (PyTango.Device_4Impl):
 
         #Check PS state if SWB is OK
         ps_state = self.get_ps_state()
+
+        #the PS limits or subscription could not be done at init (e.g. PS down), so do them now the PS is there
+        if self.ps_device:
+            if not self.ps_limits_read:
+                self.update_limits()
+            if self._ps_event_id is None:
+                self.subscribe_ps_events()
         return ps_state
 
     def dev_status(self):
 
         #set status messge
-        if self.Mode in self.MODE_NAMES:
+        if self.status_str_init:
+            msg = self.status_str_init
+        elif self.Mode in self.MODE_NAMES:
             msg = "SWB Mode: " + self.Mode +"\n"+ self.status_str_prop +"\n"+ self.status_str_cfg +"\n"+ self.status_str_cal[self.Mode] +"\n"+ self.status_str_ps +"\n"+ self.status_str_swb 
         else:
             msg = "SWB Mode is invalid\n" + self.status_str_prop +"\n"+ self.status_str_cfg +"\n"+  self.status_str_ps +"\n"+ self.status_str_b + "\n" + self.status_str_swb 
@@ -461,10 +646,24 @@ class TrimCircuit (PyTango.Device_4Impl):
         self.debug_stream("SETTING CURRENT ON THE PS TO: %f ", self.set_point)
         try:
             self.ps_device.write_attribute("Current", self.set_point)
-        except PyTango.DevFailed as e:
+        except (AttributeError, PyTango.DevFailed) as e: #no proxy while the PS cannot be reached
             self.status_str_ps = "Cannot set current on PS" + self.PowerSupplyProxy
 
 
+    def calculate_main_field_setpoint(self, main_field_component):
+        #Set point for a new value of the main field component: set the component of the mode (A or B, and sign
+        #from the mode table) in copies of the field vectors, since these are the excitation curve's result
+        #arrays, which its next calculate_fields overwrites
+        (mode, allowed_component, units, limits, fill_A, sign) = self.mode_table
+        fieldA = self.fieldA.copy()
+        fieldB = self.fieldB.copy()
+        if fill_A:
+            fieldA[allowed_component] = main_field_component * self.BRho * sign
+        else:
+            fieldB[allowed_component] = main_field_component * self.BRho * sign
+        return self.excitation_curves[mode].calculate_setpoint(self.BRho, fieldA, fieldB)
+
+
     #-----------------------------------------------------------------------------
     #    TrimCircuit read/write attribute methods
     #-----------------------------------------------------------------------------
@@ -560,23 +759,14 @@ class TrimCircuit (PyTango.Device_4Impl):
         if self.scaleField:
             self.debug_stream("Energy (Brho) changed to %f (%f): will recalculate current to preserve field" % (self.energy_r, self.BRho) )
             #since brho changed, need to recalc the field
-            sign = -1
-            if self.allowed_component == 0 and self.Mode not in ["vkick","Y_CORRECTOR"]:
-                sign =  1
-            if self.Mode not in ["SKEW_QUADRUPOLE","Y_CORRECTOR"]:
-                self.fieldB[self.allowed_component]  = self.MainFieldComponent_r * self.BRho * sign
-            else:
-                self.fieldA[self.allowed_component]  = self.MainFieldComponent_r * self.BRho * sign
-
-            self.set_point \
-                = calculate_setpoint(self.allowed_component, self.currentsmatrix[self.Mode], self.fieldsmatrix[self.Mode], self.BRho,  self.PolTimesOrient, self.Tilt, self.Mode, self.Length, self.fieldA, self.fieldB, False)
+            self.set_point = self.calculate_main_field_setpoint(self.MainFieldComponent_r)
             ###########################################################
             #Set the current on the ps
             self.set_ps_current()
         else:
             self.debug_stream("Energy changed: will recalculate fields for the PS current")
             (success, self.MainFieldComponent_r, self.MainFieldComponent_w, self.fieldA, self.fieldANormalised, self.fieldB, self.fieldBNormalised) \
-                = calculate_fields(self.allowed_component, self.currentsmatrix[self.Mode], self.fieldsmatrix[self.Mode], self.BRho,  self.PolTimesOrient, self.Tilt, self.Mode, self.Length, self.actual_measurement, self.set_point, is_sole=False)
+                = self.excitation_curves[self.Mode].calculate_fields(self.BRho, self.actual_measurement, self.set_point)
 
 
     def is_energy_allowed(self, attr):
@@ -607,18 +797,9 @@ class TrimCircuit (PyTango.Device_4Impl):
     def write_MainFieldComponent(self, attr):
         self.debug_stream("In write_MainFieldComponent()")
         self.MainFieldComponent_w = attr.get_write_value()
-        #Note that we set the component of the field vector directly here, but
-        #calling calculate_fields will in turn set the whole vector, including this component again
-        sign = -1
-        if self.allowed_component == 0 and self.Mode not in ["vkick","Y_CORRECTOR"]:
-            sign =  1
-        if self.Mode not in ["SKEW_QUADRUPOLE","Y_CORRECTOR"]:
-            self.fieldB[self.allowed_component]  = self.MainFieldComponent_w * self.BRho * sign
-        else:
-            self.fieldA[self.allowed_component]  = self.MainFieldComponent_w * self.BRho * sign
-
-        self.set_point \
-            = calculate_setpoint(self.allowed_component, self.currentsmatrix[self.Mode], self.fieldsmatrix[self.Mode], self.BRho,  self.PolTimesOrient, self.Tilt, self.Mode, self.Length, self.fieldA, self.fieldB, False)
+        #Note that we set the component of a copy of the field vector here, calling calculate_fields
+        #will in turn set the whole vector, including this component
+        self.set_point = self.calculate_main_field_setpoint(self.MainFieldComponent_w)
         ###########################################################
         #Set the current on the ps
         self.set_ps_current()
@@ -687,10 +868,26 @@ class TrimCircuitClass(PyTango.DeviceClass):
         [PyTango.DevString,
          "Associated switchboard",
          [ "not set" ] ],
+        'UseSwitchBoardEvents':
+        [PyTango.DevBoolean,
+         "Subscribe to change events on the SWB mode instead of reading it for every request (read if there are no events)",
+         [ False ] ],
         'MagnetProxies':
         [PyTango.DevVarStringArray,
          "List of magnets on this circuit",
          [ "not set" ] ],
+        'PushFieldEvents':
+        [PyTango.DevBoolean,
+         "Push change and archive events on the fields and MainFieldComponent when they change (subscribes to PS current events, also pushed from reads)",
+         [ False ] ],
+        'FieldEventAbsChange':
+        [PyTango.DevDouble,
+         "Absolute change of a field needed to send an event (0 to not use)",
+         [ 0.0 ] ],
+        'FieldEventRelChange':
+        [PyTango.DevDouble,
+         "Relative change (percent) of a field needed to send an event (0 to not use)",
+         [ 0.0 ] ],
         }
     
     #Attribute definitions
@@ -0,0 +1,97 @@
+import math
+import numpy as np
+from threading import Thread, Event
+from collections import deque
+from magnetcycling import tick_context
+
+
+def ramp_trajectory(start, target, ramp_time, step_rate):
+    """Set points for each tick (one row per tick) of a linear ramp from start to target.
+
+    All set points move by the same fraction at each tick, so they all
+    arrive at target together, after ramp_time."""
+    start = np.asarray(start, dtype=float)
+    target = np.asarray(target, dtype=float)
+    steps = max(1, int(math.ceil(ramp_time * step_rate)))
+    fractions = np.arange(1, steps + 1) / float(steps)
+    trajectory = start + np.outer(fractions, target - start)
+    # no rounding error on the last step
+    trajectory[-1] = target
+    return trajectory
+
+
+class MagnetRamping(object):
+
+    def __init__(self, write, start, target, ramp_time, step_rate):
+        # write(set_points) writes the set points of one tick to all the
+        # power supplies, in parallel; it raises (DevFailed) on failure.
+        self.write = write
+        self.step_time = 1.0 / step_rate
+        self.trajectory = ramp_trajectory(start, target, ramp_time, step_rate)
+        self.step = 0
+        # Ramping
+        self.ramp_thread = None  # The ramping thread
+        self.ramp_stop = Event()  # Set when aborting.
+        self.error_stack = deque(maxlen=10)
+        self.ramp_interrupted = False
+        self.ramp_ended = False
+
+    @property
+    def steps(self):
+        return len(self.trajectory)
+
+    def is_running(self):
+        try:
+            return self.ramp_thread.is_alive()
+        except AttributeError:
+            return False
+
+    @property
+    def ramp_errors(self):
+        return "\n".join(set(map(str, self.error_stack)))
+
+    def start(self):
+        self.stop()
+        self.error_stack.clear()
+        self.ramp_stop.clear()
+        self.step = 0
+        self.ramp_thread = Thread(target=self.ramp)
+        self.ramp_thread.start()
+
+    def stop(self, timeout=None):
+        # Stop the ramping thread, leaving the set points of the last tick. Waits at most timeout
+        # (a tick's PS writes may take a while); returns True if the thread has finished.
+        self.ramp_stop.set()
+        if self.ramp_thread is not None and self.ramp_thread.isAlive():
+            self.ramp_thread.join(timeout)
+        return not self.is_running()
+
+    @property
+    def phase(self):
+        """Get the 'phase' of the ramp; a high-level state"""
+        if self.is_running():
+            return "RAMPING (%d/%d)" % (self.step, self.steps)
+        if self.ramp_ended:
+            return "RAMP DONE"
+        if self.ramp_interrupted:
+            return "RAMP INTERRUPTED (%d/%d)" % (self.step, self.steps)
+        return "NOT RAMPING"
+
+    def ramp(self):
+        """The main loop for one ramp, one tick per step."""
+        self.ramp_ended = False
+        self.ramp_interrupted = False
+        for set_points in self.trajectory:
+            if self.ramp_stop.isSet():
+                break
+            with tick_context(self.step_time, sleep=self.ramp_stop.wait):
+                try:
+                    self.write(set_points)
+                except Exception as e:
+                    # the power supplies are no longer on a common trajectory, so stop here (any error,
+                    # so that RampStatus says why the ramp was interrupted)
+                    self.error_stack.append(e)
+                    break
+                self.step += 1
+        self.ramp_ended = self.step == self.steps
+        self.ramp_interrupted = not self.ramp_ended
@@ -0,0 +1,77 @@
+import unittest
+
+import numpy as np
+from mock import Mock
+from cycling_statemachine.magnetramping import MagnetRamping, ramp_trajectory
+from PyTango import DevFailed
+
+START = [0.0, 10.0, -2.0]
+TARGET = [5.0, 0.0, 2.0]
+RAMP_TIME = 0.05
+STEP_RATE = 100.
+
+
+class RampTrajectoryTestCase(unittest.TestCase):
+
+    def test_trajectory(self):
+        " all set points reach the target together, in equal steps "
+        trajectory = ramp_trajectory(START, TARGET, 1.0, 4.)
+        self.assertEqual(trajectory.shape, (4, 3))
+        np.testing.assert_array_equal(trajectory[-1], TARGET)
+        np.testing.assert_allclose(np.diff(trajectory, axis=0),
+                                   np.tile((np.array(TARGET) - START) / 4., (3, 1)))
+
+    def test_short_ramp(self):
+        " a ramp shorter than one tick is one step to the target "
+        trajectory = ramp_trajectory(START, TARGET, 0., STEP_RATE)
+        np.testing.assert_array_equal(trajectory, [TARGET])
+
+
+class MagnetRampingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.write = Mock()
+        self.ramping = MagnetRamping(self.write, START, TARGET, RAMP_TIME, STEP_RATE)
+
+    def tearDown(self):
+        self.ramping.stop()
+        assert not self.ramping.is_running()
+
+    def test_ramp(self):
+        " every tick is written, ending at the target "
+        self.assertEqual(self.ramping.phase, "NOT RAMPING")
+        self.ramping.start()
+        self.ramping.ramp_thread.join()
+        self.assertEqual(self.write.call_count, self.ramping.steps)
+        np.testing.assert_array_equal(self.write.call_args[0][0], TARGET)
+        assert self.ramping.ramp_ended
+        assert not self.ramping.ramp_interrupted
+        self.assertEqual(self.ramping.phase, "RAMP DONE")
+
+    def test_stop(self):
+        " stopping leaves the set points of the last tick "
+        self.ramping = MagnetRamping(self.write, START, TARGET, 10., STEP_RATE)
+        self.ramping.start()
+        assert self.ramping.is_running()
+        assert self.ramping.stop(1.0)
+        assert not self.ramping.ramp_ended
+        assert self.ramping.ramp_interrupted
+        assert self.write.call_count < self.ramping.steps
+
+    def test_exception(self):
+        " a failed write stops the ramp "
+        self.write.side_effect = DevFailed()
+        self.ramping.start()
+        self.ramping.ramp_thread.join()
+        self.assertEqual(self.write.call_count, 1)
+        self.assertEqual(len(self.ramping.error_stack), 1)
+        assert self.ramping.ramp_interrupted
+        assert not self.ramping.ramp_ended
+
+    def test_other_exception(self):
+        " any error stops the ramp, and is kept for RampStatus "
+        self.write.side_effect = ValueError("bad set point")
+        self.ramping.start()
+        self.ramping.ramp_thread.join()
+        self.assertEqual(self.ramping.ramp_errors, "bad set point")
+        assert self.ramping.ramp_interrupted
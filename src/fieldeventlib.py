@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##    Change and archive events for the field attributes of the circuit devices
+##
+###############################################################################
+
+import PyTango
+import threading
+import numpy as np
+
+#Attributes pushed by the circuits whenever they calculate new fields from the PS value
+FIELD_EVENT_ATTRIBUTES = ["fieldA", "fieldB", "fieldANormalised", "fieldBNormalised", "MainFieldComponent"]
+
+
+def convert_dipole_vector(vector):
+
+    #For dipoles theta (theta * BRho) is kept in the zeroth element of the field vectors, but is read as NaN
+    #(in reality the zeroth element is zero). Copy, the vectors may be shared with a PS event snapshot.
+    vector = np.array(vector)
+    vector[0] = np.NAN
+    return vector
+
+
+def same_value(last, value):
+
+    #NaN (e.g. the dipole element) counts as equal to NaN
+    return last.shape == value.shape and np.all((last == value) | (np.isnan(last) & np.isnan(value)))
+
+
+def setup_field_events(device, abs_change, rel_change):
+
+    #The device pushes the events itself, so clients can subscribe without the attributes being polled.
+    #With a threshold, Tango only sends an event if the value moved by more than it since the last event
+    #(the same thresholds are used for archive events). Without, every push is sent.
+    detect = bool(abs_change or rel_change)
+    for name in FIELD_EVENT_ATTRIBUTES:
+        if detect:
+            att = device.get_device_attr().get_attr_by_name(name)
+            multi_prop = PyTango.MultiAttrProp()
+            att.get_properties(multi_prop)
+            if abs_change:
+                multi_prop.abs_change = abs_change
+                multi_prop.archive_abs_change = abs_change
+            if rel_change:
+                multi_prop.rel_change = rel_change
+                multi_prop.archive_rel_change = rel_change
+            att.set_properties(multi_prop)
+        device.set_change_event(name, True, detect)
+        device.set_archive_event(name, True, detect)
+    return FieldEvents(device)
+
+
+class FieldEvents(object):
+
+    #Pushes the field events of one device, from client reads and PS events alike. A value is only pushed if
+    #it differs from the last one pushed, so without thresholds repeated reads of an unchanged PS send nothing.
+
+    def __init__(self, device):
+        self.device = device
+        self._last = {} #attribute name to last value pushed
+        self._lock = threading.Lock()
+
+    def push_fields(self, fields, dipole=False):
+
+        #fields as calculated by ExcitationCurve.calculate_fields; dipole to push the vectors as a dipole reads them
+        (success, main_field_r, main_field_w, fieldA, fieldANormalised, fieldB, fieldBNormalised) = fields
+        if success == False:
+            return
+        if dipole:
+            (fieldA, fieldANormalised, fieldB, fieldBNormalised) = \
+                [convert_dipole_vector(v) for v in (fieldA, fieldANormalised, fieldB, fieldBNormalised)]
+        self.push({"fieldA": fieldA, "fieldANormalised": fieldANormalised, "fieldB": fieldB,
+                   "fieldBNormalised": fieldBNormalised, "MainFieldComponent": main_field_r})
+
+    def push(self, values):
+
+        #values is a dict of attribute name to value. Pushing is done outside the lock, as the request thread
+        #holds the device monitor. A failed push must not fail the read it comes from.
+        changed = []
+        with self._lock:
+            for name, value in values.items():
+                value = np.array(value, dtype=float) #copy, the curves reuse their arrays
+                last = self._last.get(name)
+                if last is None or not same_value(last, value):
+                    self._last[name] = value
+                    changed.append((name, value if value.ndim else float(value)))
+        for name, value in changed:
+            try:
+                self.device.push_change_event(name, value)
+                self.device.push_archive_event(name, value)
+            except PyTango.DevFailed as df:
+                self.device.debug_stream("Cannot push events for %s: %s" % (name, df[0].desc))
+                with self._lock:
+                    self._last.pop(name, None)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##    Optional parallel device initialisation at server startup
+##
+###############################################################################
+
+from multiprocessing.pool import ThreadPool
+
+#While the pool runs (started before server_init, joined before server_run) the devices hand it the parts of
+#their init that only wait on other devices (PS and switchboard proxies, limits, subscriptions), so these run
+#side by side instead of one device after the other. With no pool (the default, or a later Init command) the
+#tasks run straight away.
+_pool = None
+_tasks = []
+
+
+def start_init_pool(threads):
+
+    global _pool
+    if threads > 0:
+        _pool = ThreadPool(threads)
+
+
+def run_init_task(func, *args):
+
+    if _pool is None:
+        func(*args)
+    else:
+        _tasks.append((func, _pool.apply_async(func, args)))
+
+
+def join_init_pool():
+
+    #Wait for all the tasks and stop the pool. Returns (task, exception) for each task that raised.
+    global _pool
+    if _pool is None:
+        return []
+    _pool.close()
+    _pool.join()
+    _pool = None
+
+    failed = []
+    for (func, result) in _tasks:
+        try:
+            result.get()
+        except Exception as e:
+            failed.append((func, e))
+    del _tasks[:]
+    return failed
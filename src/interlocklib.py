@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##    Monitoring of the temperature interlock tags of the magnets
+##
+###############################################################################
+
+import threading
+import time
+import PyTango
+
+
+class InterlockTag(object):
+
+    #One PLC interlock tag, shared by all the magnets in the server that use it. Kept up to date by a change
+    #event subscription, or by polling (see InterlockMonitor) while events are not coming through.
+
+    def __init__(self, name):
+        self.name = name
+        self.proxy = PyTango.AttributeProxy(name)
+        self.listeners = set()
+        self.event_id = None
+        self.subscribed = False #True while events are arriving without error
+        self.value = None
+        self.read_time = None #time of the last successful read
+        self.error = None
+
+    def subscribe(self):
+        try:
+            # stateless, so Tango keeps retrying (and we keep polling) until events work
+            self.event_id = self.proxy.subscribe_event(PyTango.EventType.CHANGE_EVENT, self.event_received, [], True)
+        except PyTango.DevFailed:
+            self.event_id = None
+
+    def unsubscribe(self):
+        if self.event_id is not None:
+            try:
+                self.proxy.unsubscribe_event(self.event_id)
+            except PyTango.DevFailed:
+                pass
+        self.event_id = None
+        self.subscribed = False
+
+    def event_received(self, event):
+        if event.err:
+            self.subscribed = False
+            self.update(None, event.errors[0].desc)
+        else:
+            self.subscribed = True
+            self.update(event.attr_value.value, None)
+
+    def update(self, value, error):
+        #A failed read keeps the last value and its time: an interlock that was set stays set (and goes
+        #stale) until the tag can be read again, rather than being cleared by the failure.
+        if error is not None:
+            (value, read_time) = (self.value, self.read_time)
+        else:
+            read_time = time.time()
+        changed = (value, error) != (self.value, self.error)
+        (self.value, self.read_time, self.error) = (value, read_time, error)
+        if changed:
+            for listener in list(self.listeners):
+                listener(self.name, self.reading())
+
+    def reading(self):
+        #(last value, time read, error message of the last read or None). With working events there is
+        #no news, so the value is current.
+        if self.subscribed:
+            return (self.value, time.time(), self.error)
+        return (self.value, self.read_time, self.error)
+
+
+class InterlockMonitor(object):
+
+    #Reads interlock tags in a background thread, all at once (asynchronous reads), and keeps the last reading
+    #in each InterlockTag. The device only looks at the readings, so a slow PLC delays the next update instead
+    #of every client call.
+
+    def __init__(self, period=1.0, timeout=3.0):
+        self.period = period
+        self.timeout = timeout
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    def tags_to_poll(self):
+        #the InterlockTags to read at each period
+        return []
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name=self.__class__.__name__)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(self.period + self.timeout)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self.poll()
+            self._stop_event.wait(self.period)
+
+    def poll(self):
+
+        #Send all the reads, then collect the replies
+        request_ids = []
+        for tag in self.tags_to_poll():
+            try:
+                request_ids.append((tag, tag.proxy.read_asynch()))
+            except PyTango.DevFailed as df:
+                tag.update(None, df[0].desc)
+
+        for (tag, request_id) in request_ids:
+            try:
+                value = tag.proxy.read_reply(request_id, int(self.timeout * 1000)).value
+            except PyTango.DevFailed as df:
+                tag.update(None, df[0].desc)
+            else:
+                tag.update(value, None)
+
+
+class InterlockRegistry(InterlockMonitor):
+
+    #Process wide registry of interlock tags. Magnets register their tags, and each distinct tag is read
+    #once for all of them (one subscription, or one poll), so PLC load does not grow with the number of magnets.
+    #Only the tags without working events are polled, at the shortest period asked for by the magnets.
+
+    def __init__(self, period=1.0, timeout=3.0):
+        InterlockMonitor.__init__(self, period, timeout)
+        self.default_period = period #when no registration asks for a period
+        self._tags = {} #lower case tag name -> InterlockTag
+        self._periods = {} #(lower case tag name, listener) -> period asked for
+        self._lock = threading.Lock()
+
+    def register(self, name, listener, period=None):
+        #listener(tag name, reading) is called when the tag changes. Returns nothing, raises PyTango.DevFailed
+        #if the tag cannot be set up.
+        with self._lock:
+            if period is not None:
+                self._periods[(name.lower(), listener)] = period
+                self._update_period()
+            tag = self._tags.get(name.lower())
+            if tag is None:
+                tag = InterlockTag(name)
+                tag.subscribe()
+                self._tags[name.lower()] = tag
+            tag.listeners.add(listener)
+            self.start()
+
+    def unregister(self, name, listener):
+        with self._lock:
+            tag = self._tags.get(name.lower())
+            if tag is None:
+                return
+            tag.listeners.discard(listener)
+            if self._periods.pop((name.lower(), listener), None) is not None:
+                self._update_period()
+            if not tag.listeners:
+                tag.unsubscribe()
+                del self._tags[name.lower()]
+
+    def _update_period(self):
+        self.period = min(self._periods.values()) if self._periods else self.default_period
+
+    def reading(self, name):
+        tag = self._tags.get(name.lower())
+        if tag is None:
+            return (None, None, "Interlock tag not registered")
+        return tag.reading()
+
+    def tags_to_poll(self):
+        with self._lock:
+            return [tag for tag in self._tags.values() if not tag.subscribed]
+
+
+#The one registry for all the magnets in this server
+interlock_registry = InterlockRegistry()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##    Direct access to devices running in the same server
+##
+###############################################################################
+
+## Magnets and their circuits normally run in the same server (see Magnet.main). Reading a circuit through a
+## PyTango.DeviceProxy then still goes through CORBA. LocalDeviceProxy calls the circuit device object instead,
+## the same way Tango would for a read (always_executed_hook, dev_state, is_X_allowed, read_X), while holding
+## the device monitor so it is serialised with other requests to that device.
+## Only reads are supported, which is all the magnet does.
+
+import PyTango
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+#readings kept by hold_readings, per thread: device name to {attribute name: LocalDeviceAttribute}
+_held = threading.local()
+
+
+def get_device_proxy(device_name, local=True):
+
+    #The device object wrapped in a LocalDeviceProxy if it runs in this server, otherwise a PyTango.DeviceProxy
+    if local:
+        try:
+            return LocalDeviceProxy(PyTango.Util.instance().get_device_by_name(device_name))
+        except PyTango.DevFailed:
+            pass
+    return PyTango.DeviceProxy(device_name)
+
+
+@contextmanager
+def hold_readings():
+
+    #Within the block, the readings made through a LocalDeviceProxy in this thread are kept, and a later read of
+    #the same attributes of a device gets them instead of a new request. So a pass over devices that also read
+    #each other (magnets reading their circuits) sees one reading of each device.
+    _held.readings = {}
+    try:
+        yield
+    finally:
+        _held.readings = None
+
+
+class LocalAttribute(object):
+
+    #Stands in for the attribute passed to read_X, keeping the values set
+    def __init__(self):
+        self.value = None
+        self.w_value = None
+
+    def set_value(self, value, *args):
+        self.value = value
+
+    def set_value_date_quality(self, value, *args):
+        self.value = value
+
+    def set_write_value(self, value, *args):
+        self.w_value = value
+
+
+class LocalDeviceAttribute(object):
+
+    #Result of a read, with the parts of PyTango.DeviceAttribute the magnet uses (and the DevFailed if it failed)
+    def __init__(self, name, value=None, w_value=None, error=None):
+        self.name = name
+        self.value = value
+        self.w_value = w_value
+        self.error = error
+        self.has_failed = error is not None
+
+
+def read_error(reason, desc):
+
+    #the DevFailed a DeviceProxy would give for a read that failed in the device
+    error = PyTango.DevError()
+    error.reason = reason
+    error.desc = desc
+    error.origin = "LocalDeviceProxy.read_attributes()"
+    return PyTango.DevFailed(error)
+
+
+class LocalDeviceProxy(object):
+
+    def __init__(self, device):
+        self.device = device
+
+    def dev_name(self):
+        return self.device.get_name()
+
+    def ping(self):
+        #nothing to go through, so no time
+        return 0
+
+    def read_attribute(self, name):
+        #as on a DeviceProxy, a failed read raises DevFailed (read_attributes gives has_failed instead)
+        reading = self.read_attributes([name])[0]
+        if reading.has_failed:
+            raise reading.error
+        return reading
+
+    def read_attributes(self, names):
+        #One request, as read_attributes on a DeviceProxy would be, unless the readings are held (see hold_readings)
+        held = getattr(_held, "readings", None)
+        if held is not None:
+            device_held = held.setdefault(self.dev_name(), {})
+            if all(name in device_held for name in names):
+                return [device_held[name] for name in names]
+        with PyTango.AutoTangoMonitor(self.device):
+            self.device.always_executed_hook()
+            readings = [self._read(name) for name in names]
+        if held is not None:
+            device_held.update(zip(names, readings))
+        return readings
+
+    def _read(self, name):
+        try:
+            if name == "State":
+                return LocalDeviceAttribute(name, self.device.dev_state())
+            if name == "Status":
+                return LocalDeviceAttribute(name, self.device.dev_status())
+            is_allowed = getattr(self.device, "is_%s_allowed" % name, None)
+            if is_allowed is not None and not is_allowed(PyTango.AttReqType.READ_REQ):
+                return LocalDeviceAttribute(name, error=read_error(
+                    "API_AttrNotAllowed", "It is currently not allowed to read attribute %s" % name))
+            attr = LocalAttribute()
+            getattr(self.device, "read_%s" % name)(attr)
+        except PyTango.DevFailed as df:
+            self.device.debug_stream("Local read of %s failed: %s" % (name, df))
+            return LocalDeviceAttribute(name, error=df)
+        except Exception as e:
+            # through a DeviceProxy, Tango would give this to the client as a DevFailed
+            self.device.debug_stream("Local read of %s failed: %r" % (name, e))
+            return LocalDeviceAttribute(name, error=read_error("PyDs_PythonError", "%s: %s" % (type(e).__name__, e)))
+        if attr.value is None:
+            return LocalDeviceAttribute(name, error=read_error(
+                "API_AttrValueNotSet", "Value for attribute %s has not been updated" % name))
+        # copy arrays, the device may reuse them for its next calculation
+        if isinstance(attr.value, np.ndarray):
+            attr.value = attr.value.copy()
+        return LocalDeviceAttribute(name, attr.value, attr.w_value)
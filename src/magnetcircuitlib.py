@@ -13,6 +13,7 @@
 ## NOTE PJB THIS VERSION ONLY FOR THE RING SINCE NO FACTORIAL FACTOR!
 
 import numpy as np
+from bisect import bisect_right
 from math import sqrt, factorial
 
 _maxdim = 10 #Maximum number of multipole components
@@ -166,3 +167,309 @@ def calculate_setpoint(allowed_component, setpoints_matrix, fieldsmatrix, brho,
     #print "will interp ", intBtimesBRho, fields_o, currents_o, calc_current
 
     return calc_current
+
+class ExcitationCurve(object):
+
+    #Excitation curve "compiled" from the processed calibration matrices. Everything that does not depend on
+    #the power supply value or on BRho (which rows hold data, the interpolation slopes, the A/B choice and the
+    #sign convention) is worked out once here, so calculate_fields only does the interpolation itself.
+    #Results are identical to the calculate_fields function above.
+
+    def __init__(self, allowed_component, setpoints_matrix, fieldsmatrix, poltimesorient, tilt, typ, length, is_sole=False):
+
+        self.allowed_component = allowed_component
+        self.poltimesorient = poltimesorient
+        self.length = length
+        self.is_sole = is_sole
+
+        #Same row selection as calculate_fields: stop at the first multipole with Nan data, skip all zero ones
+        rows = []
+        for i in range (0,_maxdim):
+            if np.isnan(setpoints_matrix[i]).any():
+                break
+            if np.all(setpoints_matrix[i]==0):
+                continue
+            rows.append(i)
+        self.rows = np.asarray(rows, dtype=int)
+
+        self.setpoints = np.array(setpoints_matrix[rows], dtype=float)
+        self.fields    = np.array(fieldsmatrix[rows], dtype=float)
+        self.npoints   = self.setpoints.shape[1]
+
+        #Slopes between calibration points, computed as np.interp does. Repeated set points give inf/nan slopes
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.slopes = (self.fields[:,1:] - self.fields[:,:-1]) / (self.setpoints[:,1:] - self.setpoints[:,:-1])
+        self._rowindex = np.arange(len(rows))[:, np.newaxis]
+
+        #Lookup table of (set point, field, slope) per interval, with an interval of zero slope added below and
+        #above the data. Evaluating slope*(x-set point)+field in the table then reproduces np.interp exactly
+        #(-0.0 above so that the last field value is returned unchanged), provided the slopes are finite and
+        #there is no -0.0 in the field data. Otherwise we use the slower general path.
+        zeros = np.zeros((len(rows), 1))
+        self._table = np.array([np.hstack((self.setpoints[:,:1], self.setpoints)),
+                                np.hstack((self.fields[:,:1], self.fields)),
+                                np.hstack((zeros, self.slopes, -zeros))])
+        self._offsets = self._rowindex * (self.npoints + 1)
+        self._exact_table = bool(np.isfinite(self.slopes).all()) and \
+            not (np.signbit(self.fields) & (self.fields == 0)).any()
+        #If all multipoles were measured at the same set points a single search is enough
+        self._shared_setpoints = len(rows) > 0 and bool((self.setpoints == self.setpoints[0]).all())
+
+        #A value must lie within the interpolation range of every row used
+        if len(rows) > 0:
+            self.min_setpoint = self.setpoints[:,0].max()
+            self.max_setpoint = self.setpoints[:,-1].min()
+        else:
+            self.min_setpoint = self.max_setpoint = None
+
+        #Fill A or B vector as appropriate
+        self.fill_A = not (tilt == 0 and typ not in ["vkick","SKEW_QUADRUPOLE","Y_CORRECTOR"])
+        #Is the allowed ("steering") component among the rows we calculate
+        self.has_component = allowed_component in rows
+        if self.has_component:
+            self._component_row = rows.index(allowed_component)
+
+        #sign convention for ring
+        self.sign = -1
+        if  allowed_component == 0 and typ not in ["vkick","Y_CORRECTOR"]:
+            self.sign =  1
+
+        #Inverse curve (field -> set point) of the allowed component, used by calculate_setpoint. Fields must be
+        #strictly monotonic (checked by process_calibration_data), and are stored increasing for the lookup.
+        inv_fields = fieldsmatrix[allowed_component]
+        inv_setpoints = setpoints_matrix[allowed_component]
+        steps = np.diff(inv_fields)
+        self.invertible = len(steps) > 0 and bool((steps > 0.0).all() or (steps < 0.0).all())
+        if self.invertible and steps[0] < 0.0:
+            inv_fields = inv_fields[::-1]
+            inv_setpoints = inv_setpoints[::-1]
+        self._inv_fields = [float(x) for x in inv_fields]
+        self._inv_setpoints = [float(x) for x in inv_setpoints]
+        self._inv_slopes = [(self._inv_setpoints[k+1] - self._inv_setpoints[k]) / (self._inv_fields[k+1] - self._inv_fields[k])
+                            if self.invertible else np.NAN for k in range(len(self._inv_fields) - 1)]
+
+        #Output vectors are reused from call to call
+        self.fieldA           = np.empty(_maxdim, dtype=float)
+        self.fieldANormalised = np.empty(_maxdim, dtype=float)
+        self.fieldB           = np.empty(_maxdim, dtype=float)
+        self.fieldBNormalised = np.empty(_maxdim, dtype=float)
+        self._values = np.empty(2, dtype=float)
+
+    def interpolate(self, values):
+
+        #Interpolate all rows at once for a 1-d array of set point values, giving an array (rows, values)
+        #The arithmetic is exactly that of np.interp on each row, so the results are bit identical.
+        #Set points of each row are increasing, as ensured by process_calibration_data
+
+        if not self._exact_table:
+            return self._interpolate_general(values)
+
+        if self._shared_setpoints:
+            index = np.searchsorted(self.setpoints[0], values, 'right')
+            setpoint, field, slope = self._table.take(index, axis=2)
+        else:
+            #keep nan out of the comparisons (nan in gives nan out anyway)
+            isnan = np.isnan(values)
+            if isnan.any():
+                values = np.where(isnan, 0.0, values)
+            index = (self.setpoints[:, :, np.newaxis] <= values).sum(axis=1)
+            setpoint, field, slope = self._table.reshape(3, -1).take(index + self._offsets, axis=1)
+            if isnan.any():
+                setpoint = np.where(isnan, np.NAN, setpoint)
+        return slope * (values - setpoint) + field
+
+    def _interpolate_general(self, values):
+
+        #As interpolate, but also dealing with repeated set points and signed zeros, as np.interp does
+        sp = self.setpoints
+        fp = self.fields
+        isnan = np.isnan(values)
+        hasnan = isnan.any()
+        if hasnan:
+            values = np.where(isnan, 0.0, values)
+        j  = (sp[:, :, np.newaxis] <= values).sum(axis=1) - 1
+        jc = np.clip(j, 0, self.npoints - 2)
+        xj = sp[self._rowindex, jc]
+        fj = fp[self._rowindex, jc]
+        slope = self.slopes[self._rowindex, jc]
+
+        with np.errstate(invalid='ignore'):
+            result = slope * (values - xj) + fj
+            #If we get nan in one direction, try the other
+            retry = np.isnan(result)
+            if retry.any():
+                fj1 = fp[self._rowindex, jc + 1]
+                result2 = slope * (values - sp[self._rowindex, jc + 1]) + fj1
+                result2 = np.where(np.isnan(result2) & (fj == fj1), fj, result2)
+                result = np.where(retry, result2, result)
+
+        #points on the grid take the data value, points outside the data the first or last value
+        result = np.where(values == xj, fj, result)
+        result = np.where(j < 0, fp[:, :1], result)
+        result = np.where(j >= self.npoints - 1, fp[:, -1:], result)
+        if hasnan:
+            result[:, isnan] = np.NAN
+        return result
+
+    def calculate_fields(self, brho, ps_read_value, ps_set_value=None, find_limit=False):
+
+        #Same return values as calculate_fields above. Note that the field vectors returned are the
+        #buffers of this object, so are overwritten by the next call
+
+        #If we are not just finding the limit of the interpolation data,
+        #if current is beyond interpolation data return an error
+        if not find_limit and len(self.rows) > 0:
+            if ps_read_value < self.min_setpoint or ps_read_value > self.max_setpoint:
+                return False, None, None, None, None, None, None
+            if ps_set_value is not None:
+                if ps_set_value < self.min_setpoint or ps_set_value > self.max_setpoint:
+                    return False, None, None, None, None, None, None
+
+        #Interpolate read and set values together, divide by length (fix for theta length factor later)
+        self._values[0] = ps_read_value
+        self._values[1] = ps_read_value if ps_set_value is None else ps_set_value
+        fields = self.poltimesorient * self.interpolate(self._values) / self.length
+        if ps_set_value is None:
+            fields[:, 1] = np.NAN
+        fields_norm = fields / brho
+
+        #Fill A or B vector as appropriate, the other is all Nan
+        if self.fill_A:
+            filled, filled_norm, empty, empty_norm = self.fieldA, self.fieldANormalised, self.fieldB, self.fieldBNormalised
+        else:
+            filled, filled_norm, empty, empty_norm = self.fieldB, self.fieldBNormalised, self.fieldA, self.fieldANormalised
+        filled.fill(np.NAN)
+        filled_norm.fill(np.NAN)
+        empty.fill(np.NAN)
+        empty_norm.fill(np.NAN)
+        filled[self.rows] = fields[:, 0]
+        filled_norm[self.rows] = fields_norm[:, 0]
+
+        thiscomponent = 0.0
+        thissetcomponent = np.NAN
+        if self.has_component:
+            r = self._component_row
+            thiscomponent = fields_norm[r, 0]
+            thissetcomponent = fields_norm[r, 1]
+            if self.is_sole:
+                thiscomponent = fields[r, 0]
+                thissetcomponent = fields[r, 1]
+            #hack for theta (zeroth component) should not be divided by length
+            if self.allowed_component == 0:
+                thiscomponent = fields_norm[r, 0] * self.length
+                thissetcomponent = fields_norm[r, 1] * self.length
+
+        return True, self.sign*thiscomponent, self.sign*thissetcomponent, \
+            self.fieldA, self.fieldANormalised, self.fieldB, self.fieldBNormalised
+
+    def setpoint_for_field(self, field):
+
+        #Inverse lookup by binary search: the set point giving this value of the (length integrated, BRho scaled)
+        #field of the allowed component. Same arithmetic as np.interp, so identical to calculate_setpoint above.
+        if not self.invertible:
+            raise ValueError("Field data is not monotonic, cannot calculate set point")
+        if field != field:
+            return field
+        xp = self._inv_fields
+        j = bisect_right(xp, field) - 1
+        if j < 0:
+            return self._inv_setpoints[0]
+        if j >= len(xp) - 1:
+            return self._inv_setpoints[-1]
+        if field == xp[j]:
+            return self._inv_setpoints[j]
+        return self._inv_slopes[j]*(field - xp[j]) + self._inv_setpoints[j]
+
+    def calculate_setpoint(self, brho, fieldA, fieldB):
+
+        #Same as calculate_setpoint above, using the precomputed inverse curve
+        #Take data from A or B vector as appropriate, apply extra sign factor
+        if self.fill_A:
+            intBtimesBRho = fieldA[self.allowed_component]*self.length * self.poltimesorient
+        else:
+            intBtimesBRho = fieldB[self.allowed_component]*self.length * self.poltimesorient
+
+        #hack since for theta should not multiply by length
+        if self.allowed_component == 0:
+            intBtimesBRho = intBtimesBRho / self.length
+
+        #if a solenoid, no brho factor
+        if self.is_sole:
+            intBtimesBRho = intBtimesBRho / brho
+
+        return self.setpoint_for_field(intBtimesBRho)
+
+    def calculate_fields_array(self, brho, ps_values, find_limit=False):
+
+        #Evaluate the fields for a 1-d array of N power supply values in one go. Returns a mask of the values
+        #inside the interpolation data (all True if find_limit), the main field component (N) and
+        #fieldA, fieldANormalised, fieldB, fieldBNormalised (N, _maxdim). Values outside the data give Nan.
+        #Each point gives exactly what calculate_fields gives for it as the read value.
+
+        ps_values = np.asarray(ps_values, dtype=float).ravel()
+        npoints = len(ps_values)
+
+        if find_limit or len(self.rows) == 0:
+            valid = np.ones(npoints, dtype=bool)
+        else:
+            with np.errstate(invalid='ignore'):
+                valid = ~((ps_values < self.min_setpoint) | (ps_values > self.max_setpoint))
+
+        fields = (self.poltimesorient * self.interpolate(ps_values) / self.length).T
+        fields_norm = fields / brho
+
+        fieldA           = np.full((npoints, _maxdim), np.NAN)
+        fieldANormalised = np.full((npoints, _maxdim), np.NAN)
+        fieldB           = np.full((npoints, _maxdim), np.NAN)
+        fieldBNormalised = np.full((npoints, _maxdim), np.NAN)
+        if self.fill_A:
+            fieldA[:, self.rows] = fields
+            fieldANormalised[:, self.rows] = fields_norm
+        else:
+            fieldB[:, self.rows] = fields
+            fieldBNormalised[:, self.rows] = fields_norm
+
+        component = np.zeros(npoints)
+        if self.has_component:
+            r = self._component_row
+            component = fields_norm[:, r]
+            if self.is_sole:
+                component = fields[:, r]
+            #hack for theta (zeroth component) should not be divided by length
+            if self.allowed_component == 0:
+                component = fields_norm[:, r] * self.length
+        component = self.sign*component
+
+        if not valid.all():
+            component[~valid] = np.NAN
+            for field in (fieldA, fieldANormalised, fieldB, fieldBNormalised):
+                field[~valid] = np.NAN
+
+        return valid, component, fieldA, fieldANormalised, fieldB, fieldBNormalised
+
+
+def calculate_fields_array(allowed_component, setpoints_matrix, fieldsmatrix, brho, poltimesorient, tilt, typ, length, ps_values, is_sole=False, find_limit=False):
+
+    #Batch version of calculate_fields for a 1-d array of power supply values, see ExcitationCurve.calculate_fields_array
+    #For repeated use on the same calibration, keep an ExcitationCurve instead
+    curve = ExcitationCurve(allowed_component, setpoints_matrix, fieldsmatrix, poltimesorient, tilt, typ, length, is_sole)
+    return curve.calculate_fields_array(brho, ps_values, find_limit)
+
+
+class FieldSum(object):
+
+    #Sum of a main and a trim field vector, where NaN (component not there) counts as zero unless it is NaN in both:
+    #the plain sum, then the main value where the trim is NaN and the trim value where the main is NaN.
+    #The NaN masks are buffers made once, the returned sum is a new array for the caller.
+
+    def __init__(self, size):
+        self._main_nan = np.zeros(size, dtype=bool)
+        self._trim_nan = np.zeros(size, dtype=bool)
+
+    def __call__(self, main_field, trim_field):
+        out = np.add(main_field, trim_field)
+        np.isnan(trim_field, out=self._trim_nan)
+        np.copyto(out, main_field, where=self._trim_nan)
+        np.isnan(main_field, out=self._main_nan)
+        np.copyto(out, trim_field, where=self._main_nan)
+        return out
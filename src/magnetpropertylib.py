@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##    Reading properties of the magnet devices on a circuit
+##
+###############################################################################
+
+import PyTango
+from multiprocessing.pool import ThreadPool
+
+_max_threads = 16 #Maximum number of magnet devices read at the same time
+
+#Snapshot of magnet properties taken at server startup: lower case device name -> {property: [values]}
+#Circuits look here first during init, so magnets on several circuits are not read again for each one.
+_snapshot = {}
+
+
+def _parallel_map(func, items, max_threads=_max_threads):
+
+    if len(items) < 2:
+        return [func(item) for item in items]
+
+    pool = ThreadPool(min(max_threads, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_device_properties(device_names, property_names, max_threads=_max_threads):
+
+    #Read the same properties from each device, with one get_property call (one database round trip) per device.
+    #Devices are read in parallel, so the time taken stays flat as a circuit gains magnets.
+    #Returns a list in the order of device_names, holding a dict of property name to list of values for each
+    #device, or the PyTango.DevFailed if the device could not be read (the caller decides what to do with it).
+    property_names = list(property_names)
+
+    def read(device_name):
+        snapshot = _snapshot.get(device_name.lower())
+        if snapshot is not None and all(prop in snapshot for prop in property_names):
+            return dict((prop, snapshot[prop]) for prop in property_names)
+        try:
+            return PyTango.DeviceProxy(device_name).get_property(property_names)
+        except PyTango.DevFailed as df:
+            return df
+
+    return _parallel_map(read, device_names, max_threads)
+
+
+def select_server_properties(db, server_name, class_name, property_names):
+
+    #The properties of all devices of one class in a server, in a single database query (DbMySqlSelect, the
+    #read-only SQL access of the database device). Returns lower case device name -> {lower case property
+    #name: [values]}, for the devices that have any of the properties.
+    quote = lambda text: "'%s'" % text.replace("'", "''")
+    query = ("SELECT device, name, value FROM property_device"
+             " WHERE device IN (SELECT name FROM device WHERE server = %s AND class = %s)"
+             " AND name IN (%s) ORDER BY device, name, count"
+             % (quote(server_name), quote(class_name), ", ".join(quote(prop) for prop in property_names)))
+    (lvalue, svalue) = db.command_inout("DbMySqlSelect", query)
+    properties = {}
+    #one row (device, property, one line of the value) after the other
+    for (device_name, prop, value) in zip(svalue[0::3], svalue[1::3], svalue[2::3]):
+        properties.setdefault(device_name.lower(), {}).setdefault(prop.lower(), []).append(value)
+    return properties
+
+
+def prefetch_server_properties(server_name, class_name, property_names, max_threads=_max_threads):
+
+    #Take the startup snapshot: the properties of all devices of one class in this server, read straight from
+    #the database without making device proxies. One query for the device list, one for all their properties
+    #(or, if the database cannot do that query, one per device, in parallel). Returns the number of devices in
+    #the snapshot.
+    property_names = list(property_names)
+    db = PyTango.Database()
+    device_class_list = db.get_device_class_list(server_name) #flat list of device, class, device, class...
+    device_names = [name for (name, cls) in zip(device_class_list[::2], device_class_list[1::2])
+                    if cls == class_name]
+
+    try:
+        selected = select_server_properties(db, server_name, class_name, property_names)
+    except PyTango.DevFailed:
+        selected = None
+    if selected is not None:
+        for device_name in device_names:
+            properties = selected.get(device_name.lower(), {})
+            #undefined properties are an empty list, as the database gives them
+            _snapshot[device_name.lower()] = dict((prop, properties.get(prop.lower(), [])) for prop in property_names)
+        return len(device_names)
+
+    def read(device_name):
+        try:
+            return db.get_device_property(device_name, property_names)
+        except PyTango.DevFailed as df:
+            return df
+
+    count = 0
+    for (device_name, properties) in zip(device_names, _parallel_map(read, device_names, max_threads)):
+        if not isinstance(properties, PyTango.DevFailed):
+            _snapshot[device_name.lower()] = dict((prop, list(properties[prop])) for prop in property_names)
+            count += 1
+    return count
+
+
+def clear_snapshot():
+
+    #Once the devices are up, later inits (Init command) must read the database again
+    _snapshot.clear()
@@ -14,11 +14,43 @@
 #       - Actual current values may be different (but same number, same sign)
 # NB dealing always with currents except for the 2x bumper type magnets in the 3GeV ring which control voltage 
 
+import hashlib
 import numpy as np
 
 _maxdim = 10 #Maximum number of multipole components
 
-def process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, allowedcomp):
+#Process wide cache of processed calibrations, keyed by a hash of the property contents.
+#Many devices in a server share the same calibration, so parse it once and share one read only copy.
+_calibration_cache = {}
+
+def calibration_key(ExcitationCurveSetPoints, ExcitationCurveFields, allowedcomp, invertible=True):
+
+    content = repr((list(ExcitationCurveSetPoints), list(ExcitationCurveFields), allowedcomp, invertible))
+    return hashlib.sha1(content).hexdigest()
+
+def clear_calibration_cache():
+    _calibration_cache.clear()
+
+def process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, allowedcomp, invertible=True):
+
+    #If invertible, the field of the allowed component must be strictly monotonic in the set point, so that
+    #set points can be calculated from fields (circuits). Magnets only calculate fields, so need not check.
+    #The returned matrices are shared between devices with the same calibration and are read only.
+
+    key = calibration_key(ExcitationCurveSetPoints, ExcitationCurveFields, allowedcomp, invertible)
+    try:
+        return _calibration_cache[key]
+    except KeyError:
+        pass
+
+    result = _process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, allowedcomp, invertible)
+    for matrix in result[2:]:
+        if matrix is not None:
+            matrix.setflags(write=False)
+    _calibration_cache[key] = result
+    return result
+
+def _process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, allowedcomp, invertible):
 
     hasCalibData=False
 
@@ -42,7 +74,6 @@ def process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, al
     if len(ExcitationCurveSetPoints) <= allowedcomp:
         return hasCalibData, "Calibration error: data incompatible with magnet type.", None, None
 
-    #Make numpy arrays for field and set points for each multipole component. 
     #At this point the calibration data are strings with comma separated values. Get the length by counting commas!
     #Check length is same for all multipoles
     array_length_ref = -1
@@ -59,27 +90,17 @@ def process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, al
             if array_length_I != array_length_ref:
                 return hasCalibData, "Calibration error: multipole %i has different length data than the first" % i, None, None
 
+    #Make numpy arrays for field and set points for each multipole component.
+    (setpoints_ok, msg, setpoints_data) = parse_excitation_curve(ExcitationCurveSetPoints)
+    if not setpoints_ok:
+        return hasCalibData, msg, None, None
+    (fields_ok, msg, fields_data) = parse_excitation_curve(ExcitationCurveFields)
+    if not fields_ok:
+        return hasCalibData, msg, None, None
+
     #Assume now the circuit/magnet is calibrated
     hasCalibData=True
-    array_length = array_length_ref+1
-
-    #Arrays to hold data as provided:
-    fieldsmatrix_orig   = np.zeros(shape=(_maxdim,array_length), dtype=float)
-    setpointsmatrix_orig = np.zeros(shape=(_maxdim,array_length), dtype=float)
-    fieldsmatrix_orig[:]   = np.NAN
-    setpointsmatrix_orig[:] = np.NAN
-
-    #Fill the numpy arrays. Loop over number of multipoles provided.
-    for i in range (0,len(ExcitationCurveSetPoints)):
-
-        #PJB Conversion of string to floats
-        #Property is a vector of strings to start with like "[1,2,3]\n[1,2,3]" No way to store a matrix of floats?
-        #Have to strip off the [ and ] !
-        if len(ExcitationCurveSetPoints[i])>0:
-
-            fieldsmatrix_orig[i]   =  [float(x) for x in "".join(ExcitationCurveFields[i][1:-1]).split(",")]
-            setpointsmatrix_orig[i] =  [float(x) for x in "".join(ExcitationCurveSetPoints[i][1:-1]).split(",")] 
-
+    nmultipoles, array_length = setpoints_data.shape
 
     #Provided calibration points may be for positive or negative set points only, in which case the final
     #array needs to be "reflected" in the origin. 
@@ -88,42 +109,83 @@ def process_calibration_data(ExcitationCurveSetPoints, ExcitationCurveFields, al
 
     #Assume same sign of set point measurements for each multipole, so check allowed component to see if is passes through 0
     #(lower multipoles may be all zeroes)
-    if setpointsmatrix_orig[allowedcomp][0] * setpointsmatrix_orig[allowedcomp][-1] < 0.0:
-        #print "already reflected ", fieldsmatrix_orig, setpointsmatrix_orig
+    if setpoints_data[allowedcomp][0] * setpoints_data[allowedcomp][-1] < 0.0:
         #arrange in order of increasing set point
-        for i in range (0,len(ExcitationCurveSetPoints)):
-            if setpointsmatrix_orig[i][0] > 0.0:
-                fieldsmatrix_orig[i]   = fieldsmatrix_orig[i][::-1]
-                setpointsmatrix_orig[i] = setpointsmatrix_orig[i][::-1]
+        descending = setpoints_data[:,0] > 0.0
+        fields_data[descending]    = fields_data[descending,::-1]
+        setpoints_data[descending] = setpoints_data[descending,::-1]
 
-        #print "already reflected ", fieldsmatrix_orig, setpointsmatrix_orig
-        return  hasCalibData, "Calibration available", fieldsmatrix_orig, setpointsmatrix_orig
+        fieldsmatrix    = np.zeros(shape=(_maxdim,array_length), dtype=float)
+        setpointsmatrix = np.zeros(shape=(_maxdim,array_length), dtype=float)
+        fieldsmatrix[:]    = np.NAN
+        setpointsmatrix[:] = np.NAN
+        fieldsmatrix[:nmultipoles]    = fields_data
+        setpointsmatrix[:nmultipoles] = setpoints_data
 
     #Otherwise need to reflect and combine the data 
     else:
-        #Make "reflected" arrays for negative set points and opposite sign on the fields, then merge the two later below
-        fieldsmatrix_ref    = np.zeros(shape=(_maxdim,array_length-1), dtype=float)
-        setpointsmatrix_ref  = np.zeros(shape=(_maxdim,array_length-1), dtype=float)
-        fieldsmatrix_ref[:]   = np.NAN
-        setpointsmatrix_ref[:] = np.NAN
-        #
-        #Returned array will be combination of original and reflected. 
-        fieldsmatrix_comb   = np.zeros(shape=(_maxdim,(2*array_length)-1), dtype=float)
-        setpointsmatrix_comb = np.zeros(shape=(_maxdim,(2*array_length)-1), dtype=float)
-        fieldsmatrix_comb[:]   = np.NAN
-        setpointsmatrix_comb[:] = np.NAN
-
-        for i in range (0,len(ExcitationCurveSetPoints)):
-            
-            #need to sort the set points and fields by absolute values for interpolation to work later
-            setpointsmatrix_orig[i] = sorted(setpointsmatrix_orig[i],key=abs)
-            fieldsmatrix_orig[i]   = sorted(fieldsmatrix_orig[i],key=abs)
-            
-            setpointsmatrix_ref[i] = (-setpointsmatrix_orig[i][1:])[::-1]
-            fieldsmatrix_ref[i]   = (-fieldsmatrix_orig[i][1:])[::-1]
-            
-            setpointsmatrix_comb[i] = np.concatenate((setpointsmatrix_ref[i],setpointsmatrix_orig[i]),axis=0)
-            fieldsmatrix_comb[i]   = np.concatenate((fieldsmatrix_ref[i],fieldsmatrix_orig[i]),axis=0)
-
-        #print "reflected ", fieldsmatrix_comb, setpointsmatrix_comb
-        return  hasCalibData, "Calibration available", fieldsmatrix_comb, setpointsmatrix_comb
+        #need to sort the set points and fields by absolute values for interpolation to work later
+        #(stable sort, so equal absolute values keep the order given)
+        setpoints_data = sort_by_abs(setpoints_data)
+        fields_data    = sort_by_abs(fields_data)
+
+        #Returned array will be combination of "reflected" arrays for negative set points and opposite sign
+        #on the fields, followed by the original
+        fieldsmatrix    = np.zeros(shape=(_maxdim,(2*array_length)-1), dtype=float)
+        setpointsmatrix = np.zeros(shape=(_maxdim,(2*array_length)-1), dtype=float)
+        fieldsmatrix[:]    = np.NAN
+        setpointsmatrix[:] = np.NAN
+        fieldsmatrix[:nmultipoles,:array_length-1]    = -fields_data[:,:0:-1]
+        setpointsmatrix[:nmultipoles,:array_length-1] = -setpoints_data[:,:0:-1]
+        fieldsmatrix[:nmultipoles,array_length-1:]    = fields_data
+        setpointsmatrix[:nmultipoles,array_length-1:] = setpoints_data
+
+    #If invertible, need to be able to calculate set points from fields
+    if invertible and not is_monotonic(fieldsmatrix[allowedcomp]):
+        return False, "Calibration error: field data for multipole %i is not monotonic, cannot calculate set points" % allowedcomp, None, None
+    return  hasCalibData, "Calibration available", fieldsmatrix, setpointsmatrix
+
+
+def parse_excitation_curve(ExcitationCurve):
+
+    #Property is a vector of strings like "[1,2,3]\n[1,2,3]", one per multipole. No way to store a matrix of floats?
+    #Convert all of them to a (multipoles, points) array in one go, instead of a float() call per value.
+    #Returns (ok, message, array)
+    rows = []
+    array_length_ref = -1
+    for i in range (0,len(ExcitationCurve)):
+        #Have to strip off the [ and ] !
+        values = ExcitationCurve[i][1:-1].split(",")
+        if len(values) < 2: #cannot be one entry and no commas
+            return False, "Calibration data is missing for multipole %i" % i, None
+        if i == 0:
+            array_length_ref = len(values)
+        elif len(values) != array_length_ref:
+            return False, "Calibration error: multipole %i has different length data than the first" % i, None
+        rows.extend(values)
+
+    try:
+        data = np.array(rows, dtype=float)
+    except ValueError:
+        #Slow path only to find which multipole is bad
+        for i in range (0,len(ExcitationCurve)):
+            try:
+                np.array(ExcitationCurve[i][1:-1].split(","), dtype=float)
+            except ValueError:
+                return False, "Calibration error: cannot convert data for multipole %i to numbers" % i, None
+        raise
+    return True, "", data.reshape(len(ExcitationCurve), array_length_ref)
+
+
+def sort_by_abs(data):
+
+    #Sort each row by absolute value, like sorted(row, key=abs)
+    order = np.argsort(np.abs(data), axis=1, kind='mergesort')
+    return data[np.arange(len(data))[:,np.newaxis], order]
+
+
+def is_monotonic(fields):
+
+    #Fields (in order of increasing set point) must be strictly increasing or strictly decreasing
+    steps = np.diff(fields)
+    return bool((steps > 0.0).all() or (steps < 0.0).all())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+###############################################################################
+##    Proxies to other devices (PS, switchboards, circuits) that fail fast
+##
+###############################################################################
+
+## A DeviceProxy to a device that is down makes every call on it wait for the connection timeout, and the
+## devices used to retry making the proxy on every request. A ManagedProxy connects once when first used; after
+## that, while the device cannot be reached, get() gives None straight away and a background thread tries to
+## connect again, waiting twice as long after each failed attempt (up to _max_retry).
+## Calls go through the ManagedProxy, which notices connection failures and goes back to reconnecting.
+
+import PyTango
+import threading
+
+_min_retry = 1.0 #Seconds before the first reconnect attempt
+_max_retry = 60.0 #Longest time between reconnect attempts
+
+#DevFailed reasons meaning the device could not be reached, rather than that it refused a call
+CONNECTION_ERRORS = ("API_CantConnectToDevice",
+                     "API_DeviceNotExported",
+                     "API_DeviceTimedOut",
+                     "API_ServerNotRunning",
+                     "API_CorbaException",
+                     "API_CommunicationFailed")
+
+
+def is_connection_error(df):
+
+    if isinstance(df, (PyTango.ConnectionFailed, PyTango.CommunicationFailed)):
+        return True
+    return any(getattr(error, "reason", None) in CONNECTION_ERRORS for error in df.args)
+
+
+class ManagedProxy(object):
+
+    def __init__(self, device_name, factory=None, min_retry=_min_retry, max_retry=_max_retry):
+        #factory(device_name) makes the proxy, PyTango.DeviceProxy by default
+        self.device_name = device_name
+        self.factory = factory
+        self.min_retry = min_retry
+        self.max_retry = max_retry
+        self.proxy = None #last proxy made, also while disconnected (e.g. to unsubscribe events)
+        self.connected = False
+        self.error = "" #why the last connection attempt failed
+        self._first = True
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def get(self):
+
+        #This object (calls go to the proxy) if connected, otherwise None without waiting.
+        #The first call connects in the calling thread, so a device init sees the proxy straight away.
+        if self.connected:
+            return self
+        if self._first:
+            self._first = False
+            if self._connect():
+                return self
+        self._start_reconnect()
+        return None
+
+    def stop(self):
+
+        #Stop reconnecting (device deleted); an attempt in progress is let run out
+        self._stop.set()
+
+    def failed(self, df):
+
+        #A call on the proxy failed; if the device could not be reached, fail fast until reconnected
+        if self.connected and is_connection_error(df):
+            self.connected = False
+            self.error = df.args[0].desc if df.args else str(df)
+            self._start_reconnect()
+
+    def _connect(self):
+
+        try:
+            proxy = self.proxy
+            if proxy is None:
+                proxy = (self.factory or PyTango.DeviceProxy)(self.device_name)
+            proxy.ping()
+        except (PyTango.DevFailed, PyTango.ConnectionFailed) as df:
+            self.error = df.args[0].desc if df.args else str(df)
+            return False
+        self.proxy = proxy
+        self.connected = True
+        self.error = ""
+        return True
+
+    def _start_reconnect(self):
+
+        with self._lock:
+            if self._stop.isSet() or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._thread = threading.Thread(target=self._reconnect, name="reconnect %s" % self.device_name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _reconnect(self):
+
+        retry = self.min_retry
+        while not self._stop.wait(retry):
+            if self._connect():
+                return
+            retry = min(2 * retry, self.max_retry)
+
+    def __getattr__(self, name):
+
+        #Everything else goes to the proxy, with connection failures noticed on the way
+        proxy = self.__dict__.get("proxy")
+        if proxy is None:
+            raise AttributeError(name)
+        try:
+            value = getattr(proxy, name)
+        except PyTango.DevFailed as df:
+            self.failed(df)
+            raise
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            try:
+                return value(*args, **kwargs)
+            except PyTango.DevFailed as df:
+                self.failed(df)
+                raise
+        return call
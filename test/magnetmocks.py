@@ -0,0 +1,17 @@
+"""Mock magnet devices shared by the device tests."""
+
+from mock import MagicMock
+
+
+def get_magnet_properties(test_class, devname, props):
+    """ get_property of a mock magnet proxy in test_class.magnet_proxies: a property set on the proxy,
+    otherwise the one in test_class.magnets. Properties are read as a list, undefined ones give an
+    empty list like the database """
+    magnet_proxy = test_class.magnet_proxies[devname]
+    result = {}
+    for prop in props:
+        value = getattr(magnet_proxy, prop)
+        if isinstance(value, MagicMock):
+            value = test_class.magnets[devname].get(prop, [])
+        result[prop] = value
+    return result
@@ -0,0 +1,76 @@
+"""Tests of the PS and switchboard parts of the circuit inits in the init pool (ParallelInitThreads),
+with mock devices running the circuit methods."""
+
+import threading
+import types
+import unittest
+from mock import MagicMock, patch
+
+import PyTango
+
+import initpoollib
+from MagnetCircuit import MagnetCircuit
+from TrimCircuit import TrimCircuit
+
+
+def make_circuit(circuit_class, *methods):
+    """ mock device with the named methods of circuit_class, remembering the thread of its init """
+    device = MagicMock()
+    device.status_str_init = ""
+    device.get_ps_state.return_value = PyTango.DevState.ON
+    device.iscycling = False
+    device.Mode = "NORMAL_QUADRUPOLE"
+    device.MODE_NAMES = getattr(circuit_class, "MODE_NAMES", [])
+    device.set_point_limits.side_effect = lambda: setattr(device, "init_thread", threading.current_thread())
+    for name in methods:
+        setattr(device, name, types.MethodType(vars(circuit_class)[name], device))
+    return device
+
+
+def ps_timeout():
+    error = PyTango.DevError()
+    error.desc = "PS timed out"
+    return PyTango.DevFailed(error)
+
+
+@patch("PyTango.AutoTangoMonitor", MagicMock())
+class CircuitInitTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        initpoollib.join_init_pool()
+
+    def run_in_pool(self, tasks):
+        initpoollib.start_init_pool(2)
+        for task in tasks:
+            initpoollib.run_init_task(task)
+        self.assertEqual(initpoollib.join_init_pool(), [])
+
+    def test_failed_init_is_fault_until_it_works(self):
+        good = make_circuit(MagnetCircuit, "init_power_supply", "dev_state")
+        bad = make_circuit(MagnetCircuit, "init_power_supply", "dev_state")
+        bad.subscribe_ps_events.side_effect = ps_timeout()
+        self.run_in_pool([good.init_power_supply, bad.init_power_supply])
+        self.assertIsNot(good.init_thread, threading.current_thread())
+        self.assertEqual(good.status_str_init, "")
+        self.assertIn("PS timed out", bad.status_str_init)
+        bad.set_state.assert_called_with(PyTango.DevState.FAULT)
+        self.assertEqual(bad.dev_state(), PyTango.DevState.FAULT)
+        #the PS answers again
+        bad.subscribe_ps_events.side_effect = None
+        self.assertEqual(bad.dev_state(), PyTango.DevState.ON)
+        self.assertEqual(bad.status_str_init, "")
+        bad.set_state.assert_called_with(PyTango.DevState.ON)
+
+    def test_failed_trim_init_sets_fault(self):
+        trim = make_circuit(TrimCircuit, "init_switchboard", "dev_state", "get_circuit_state")
+        trim.subscribe_swb_events.side_effect = ps_timeout()
+        self.run_in_pool([trim.init_switchboard])
+        self.assertEqual(trim.dev_state(), PyTango.DevState.FAULT)
+        trim.set_state.assert_called_with(PyTango.DevState.FAULT)
+        trim.subscribe_swb_events.side_effect = None
+        self.assertEqual(trim.dev_state(), PyTango.DevState.ON)
+        trim.set_state.assert_called_with(PyTango.DevState.ON)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,7 @@ import PyTango
 import MagnetCircuit
 from functools import partial
 from devicetest import DeviceTestCase
+from magnetmocks import get_magnet_properties
 
 
 # Device test case
@@ -111,17 +112,10 @@ class MagnetCircuitTestCase(DeviceTestCase):
             mock_proxy.get_attribute_config = get_ps_attribute_config
             return mock_proxy
 
-        def get_magnet_property(devname, prop):
-            magnet_property = getattr(cls.magnet_proxies[devname], prop)
-            if not isinstance(magnet_property, MagicMock):
-                return {prop: magnet_property}
-            if prop in cls.magnets[devname]:
-                return {prop: cls.magnets[devname][prop]}
-
         def make_magnet_proxy(devname):
             """ mock magnet proxy """
             mock_proxy = make_proxy()
-            mock_proxy.get_property = partial(get_magnet_property, devname)
+            mock_proxy.get_property = partial(get_magnet_properties, cls, devname)
             return mock_proxy
 
         def proxy_result(devname):
@@ -0,0 +1,183 @@
+"""Tests of reusing the PS reading of a circuit and the main and trim circuit readings of a magnet, with mock
+devices running the device methods."""
+
+import types
+import unittest
+from mock import MagicMock, patch
+
+import numpy as np
+import PyTango
+
+from MagnetCircuit import MagnetCircuit
+from Magnet import Magnet
+
+
+def make_device(device_class, *methods):
+    """ mock device with the named methods of device_class """
+    device = MagicMock()
+    for name in methods:
+        setattr(device, name, types.MethodType(vars(device_class)[name], device))
+    return device
+
+
+def calculated_fields(success=True):
+    return (success, 1.0, 1.0, np.zeros(10), np.zeros(10), np.ones(10), np.ones(10))
+
+
+class Clock(object):
+    """ time.time, moved on by the tests """
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DeviceReadsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = patch("time.time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class CircuitPowerSupplyReadTestCase(DeviceReadsTestCase):
+
+    def setUp(self):
+        DeviceReadsTestCase.setUp(self)
+        self.circuit = make_device(MagnetCircuit, "always_executed_hook", "invalidate_ps_reading",
+                                   "get_main_physical_quantity_and_field", "read_main_physical_quantity_and_field",
+                                   "calculate_ps_fields", "set_ps_reading", "set_ps_setpoint")
+        self.circuit.PowerSupplyReadMaxAge = 0.5
+        self.circuit.BRho = 1.0
+        self.circuit._ps_snapshot = None  # no PS events
+        self.circuit.hasCalibData = True
+        self.circuit.ps_attribute = "Current"
+        self.circuit.min_setpoint_value = -10.0
+        self.circuit.max_setpoint_value = 10.0
+        self.circuit.excitation_curve.calculate_fields.return_value = calculated_fields()
+        self.ps = self.circuit.ps_device
+        self.ps.read_attribute.return_value = MagicMock(value=1.0, w_value=1.0)
+        self.circuit.always_executed_hook()
+
+    def read_attributes(self, count):
+        #as the is_<attribute>_allowed methods of one request
+        for i in range(count):
+            self.assertTrue(self.circuit.get_main_physical_quantity_and_field())
+
+    def test_one_ps_read_per_request(self):
+        self.read_attributes(4)
+        self.ps.read_attribute.assert_called_once_with("Current")
+        self.assertEqual(self.circuit.actual_measurement, 1.0)
+        #a new request reads again
+        self.circuit.always_executed_hook()
+        self.read_attributes(2)
+        self.assertEqual(self.ps.read_attribute.call_count, 2)
+
+    def test_read_again_after_set_point_write(self):
+        self.read_attributes(1)
+        self.circuit.set_point = 2.0
+        self.circuit.set_ps_setpoint()
+        self.ps.write_attribute.assert_called_once_with("Current", 2.0)
+        self.ps.read_attribute.return_value = MagicMock(value=1.5, w_value=2.0)
+        self.read_attributes(2)
+        self.assertEqual(self.ps.read_attribute.call_count, 2)
+        self.assertEqual((self.circuit.actual_measurement, self.circuit.set_point), (1.5, 2.0))
+
+    def test_read_again_after_brho_change(self):
+        self.read_attributes(1)
+        self.circuit.BRho = 2.0
+        self.read_attributes(2)
+        self.assertEqual(self.ps.read_attribute.call_count, 2)
+        self.circuit.excitation_curve.calculate_fields.assert_called_with(2.0, 1.0, 1.0)
+
+    def test_read_again_after_max_age(self):
+        self.read_attributes(1)
+        self.clock.now += 0.4
+        self.read_attributes(1)
+        self.assertEqual(self.ps.read_attribute.call_count, 1)
+        self.clock.now += 0.2
+        self.read_attributes(1)
+        self.assertEqual(self.ps.read_attribute.call_count, 2)
+
+    def test_failed_read_not_reused(self):
+        self.ps.read_attribute.side_effect = PyTango.DevFailed(PyTango.DevError())
+        self.assertFalse(self.circuit.get_main_physical_quantity_and_field())
+        self.ps.read_attribute.side_effect = None
+        self.circuit.always_executed_hook()
+        self.read_attributes(1)
+        self.assertEqual(self.ps.read_attribute.call_count, 2)
+
+
+class MagnetReadTestCase(DeviceReadsTestCase):
+
+    def setUp(self):
+        DeviceReadsTestCase.setUp(self)
+        self.magnet = make_device(Magnet, "always_executed_hook", "get_main_physical_quantity_and_field",
+                                  "get_trim_fields")
+        self.magnet.MainCoil = None
+        for name in ["cfg", "cir", "b", "trm", "ilk", "trmi"]:
+            setattr(self.magnet, "status_str_" + name, "")
+        self.magnet.main_circuit_reading = (1.0, 1.0)
+        self.magnet.main_fields_reading = None
+        self.magnet.excitation_curve.calculate_fields.return_value = calculated_fields()
+        self.magnet.trim_fields = None
+        self.magnet.trim_fields_time = 0.0
+        self.magnet.TrimFieldMaxAge = 0.0
+        self.trim = self.magnet.trim_circuit_device
+        self.trim.read_attributes.return_value = [MagicMock(has_failed=False, value=np.ones(10))] * 4
+
+    def test_main_fields_calculated_for_new_reading(self):
+        calculate_fields = self.magnet.excitation_curve.calculate_fields
+        for i in range(3):
+            self.assertTrue(self.magnet.get_main_physical_quantity_and_field())
+        self.assertEqual(calculate_fields.call_count, 1)
+        self.magnet.main_circuit_reading = (2.0, 1.0)
+        self.magnet.get_main_physical_quantity_and_field()
+        calculate_fields.assert_called_with(1.0, 2.0)
+        #a BRho change alone also changes the fields
+        self.magnet.main_circuit_reading = (2.0, 3.0)
+        self.magnet.get_main_physical_quantity_and_field()
+        calculate_fields.assert_called_with(3.0, 2.0)
+        self.assertEqual(calculate_fields.call_count, 3)
+
+    def test_main_circuit_unreadable(self):
+        self.magnet.main_circuit_reading = None
+        self.assertFalse(self.magnet.get_main_physical_quantity_and_field())
+        self.assertFalse(self.magnet.excitation_curve.calculate_fields.called)
+
+    def test_trim_fields_read_once_per_request(self):
+        self.magnet.always_executed_hook()
+        for name in ["fieldA", "fieldB", "fieldBNormalised"]:
+            self.assertEqual(self.magnet.get_trim_fields()[name].tolist(), [1.0] * 10)
+        self.trim.read_attributes.assert_called_once_with(["fieldA", "fieldANormalised", "fieldB", "fieldBNormalised"])
+        self.clock.now += 0.001
+        self.magnet.always_executed_hook()
+        self.magnet.get_trim_fields()
+        self.assertEqual(self.trim.read_attributes.call_count, 2)
+
+    def test_trim_fields_kept_for_max_age(self):
+        self.magnet.TrimFieldMaxAge = 5.0
+        self.magnet.always_executed_hook()
+        self.magnet.get_trim_fields()
+        self.clock.now += 4.0
+        self.magnet.always_executed_hook()
+        self.magnet.get_trim_fields()
+        self.assertEqual(self.trim.read_attributes.call_count, 1)
+        self.clock.now += 2.0
+        self.magnet.always_executed_hook()
+        self.magnet.get_trim_fields()
+        self.assertEqual(self.trim.read_attributes.call_count, 2)
+
+    def test_failed_trim_field_read_as_none(self):
+        self.trim.read_attributes.return_value = [MagicMock(has_failed=False, value=np.ones(10))] * 3 + \
+                                                 [MagicMock(has_failed=True)]
+        self.magnet.always_executed_hook()
+        trim_fields = self.magnet.get_trim_fields()
+        self.assertIsNone(trim_fields["fieldBNormalised"])
+        self.assertEqual(trim_fields["fieldB"].tolist(), [1.0] * 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+"""Tests of the field event pushing, independent of the Tango devices."""
+
+import unittest
+
+import numpy as np
+
+from fieldeventlib import FieldEvents
+
+
+class PushingDevice(object):
+
+    def __init__(self):
+        self.pushed = []
+
+    def push_change_event(self, name, value):
+        self.pushed.append((name, value))
+
+    def push_archive_event(self, name, value):
+        pass
+
+
+class FieldEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.device = PushingDevice()
+        self.events = FieldEvents(self.device)
+        self.field = np.array([0.1, 0.2, 0.0])
+        self.fields = (True, 0.2, 0.2, self.field, self.field, self.field, self.field)
+
+    def pushed(self):
+        return dict(self.device.pushed)
+
+    def test_unchanged_fields_not_pushed_again(self):
+        self.events.push_fields(self.fields)
+        self.assertEqual(len(self.device.pushed), 5)
+        self.events.push_fields(self.fields)
+        self.assertEqual(len(self.device.pushed), 5)
+
+    def test_changed_fields_pushed(self):
+        self.events.push_fields(self.fields)
+        del self.device.pushed[:]
+        #the excitation curve reuses its arrays, so the change is in place
+        self.field[1] = 0.3
+        self.events.push_fields(self.fields)
+        self.assertEqual(sorted(self.pushed()), ["fieldA", "fieldANormalised", "fieldB", "fieldBNormalised"])
+        self.assertEqual(self.pushed()["fieldA"][1], 0.3)
+
+    def test_dipole_vectors_pushed_as_read(self):
+        self.events.push_fields(self.fields, dipole=True)
+        self.assertTrue(np.isnan(self.pushed()["fieldB"][0]))
+        self.assertEqual(self.field[0], 0.1)
+        #NaN is the same value as before
+        del self.device.pushed[:]
+        self.events.push_fields(self.fields, dipole=True)
+        self.assertEqual(self.device.pushed, [])
+
+    def test_failed_interpolation_not_pushed(self):
+        self.events.push_fields((False,) + self.fields[1:])
+        self.assertEqual(self.device.pushed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
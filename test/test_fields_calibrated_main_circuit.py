@@ -12,6 +12,7 @@ import MagnetCircuit
 
 from unittest import skip
 from devicetest import DeviceTestCase
+from magnetmocks import get_magnet_properties
 
 # Device test case
 class MagnetCircuitTestCase(DeviceTestCase):
@@ -111,15 +112,9 @@ class MagnetCircuitTestCase(DeviceTestCase):
             mock_proxy.get_attribute_config = get_ps_attribute_config
             return mock_proxy
 
-        def get_magnet_property(devname, prop):
-            if not isinstance(getattr(cls.magnet_proxies[devname], prop), MagicMock):
-                return {prop: getattr(cls.magnet_proxies[devname], prop)}
-            if prop in cls.magnets[devname]:
-                return {prop: cls.magnets[devname][prop]}
-
         def make_magnet_proxy(devname):
             mock_proxy = make_proxy()
-            mock_proxy.get_property = partial(get_magnet_property, devname)
+            mock_proxy.get_property = partial(get_magnet_properties, cls, devname)
             return mock_proxy
 
         cls.magnet_proxies = dict((devname, make_magnet_proxy(devname))
@@ -196,6 +191,28 @@ class MagnetCircuitTestCase(DeviceTestCase):
         field = -1.0 * self.device.MainFieldComponent
     	self.assertTrue(field-0.01 < 0.5 < field+0.01)
 
+    def ps_current_reads(self):
+        return len([c for c in self.ps_proxy.read_attribute.call_args_list if c[0][0] == "Current"])
+
+    def test_one_ps_read_per_request(self):
+        self.ps_proxy.read_attribute("Current").value = 1.0
+        self.ps_proxy.read_attribute("Current").w_value = 1.0
+        self.ps_proxy.read_attribute.reset_mock()
+        self.device.read_attributes(["MainFieldComponent", "fieldA", "fieldB", "PowerSupplyReadValue"])
+        self.assertEqual(self.ps_current_reads(), 1)
+        self.device.read_attributes(["MainFieldComponent", "fieldB"])
+        self.assertEqual(self.ps_current_reads(), 2)
+
+    def test_ps_read_again_after_write(self):
+        self.ps_proxy.read_attribute("Current").value = 1.0
+        self.ps_proxy.read_attribute("Current").w_value = 1.0
+        value = self.device.MainFieldComponent
+        self.ps_proxy.read_attribute.reset_mock()
+        #the write needs a reading, then the read after it needs a new one
+        self.device.write_read_attribute("MainFieldComponent", value)
+        self.assertEqual(self.ps_current_reads(), 2)
+        self.assertEqual(self.ps_proxy.write_attribute.call_args[0][0], "Current")
+
     #@skip("requires properties to be changed, which is not supported for now")
     #def test_in_fault_if_calibration_data_inconsistent(self):
     #    self.device.put_property({"ExcitationCurveCurrents": ["[0, 0]","[2.83]"]})
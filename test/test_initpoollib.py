@@ -0,0 +1,42 @@
+"""Tests of the parallel device init pool, independent of the Tango devices."""
+
+import threading
+import unittest
+
+import initpoollib
+
+
+class InitPoolTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        initpoollib.join_init_pool()
+
+    def test_tasks_run_straight_away_without_pool(self):
+        done = []
+        initpoollib.run_init_task(done.append, 1)
+        self.assertEqual(done, [1])
+        self.assertEqual(initpoollib.join_init_pool(), [])
+
+    def test_tasks_done_after_join(self):
+        threads = set()
+        initpoollib.start_init_pool(4)
+        for i in range(20):
+            initpoollib.run_init_task(lambda: threads.add(threading.current_thread()))
+        self.assertEqual(initpoollib.join_init_pool(), [])
+        self.assertNotIn(threading.current_thread(), threads)
+        self.assertTrue(1 <= len(threads) <= 4)
+
+    def test_failed_tasks_reported(self):
+        def fail():
+            raise ValueError("no PS")
+        initpoollib.start_init_pool(2)
+        initpoollib.run_init_task(fail)
+        initpoollib.run_init_task(lambda: None)
+        failed = initpoollib.join_init_pool()
+        self.assertEqual(len(failed), 1)
+        self.assertIs(failed[0][0], fail)
+        self.assertIsInstance(failed[0][1], ValueError)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests of the interlock tag registry, with mock attribute proxies instead of PLC tags."""
+
+import unittest
+from mock import MagicMock, patch
+
+import PyTango
+
+from interlocklib import InterlockRegistry
+
+
+def read_error():
+    error = PyTango.DevError()
+    error.desc = "PLC not answering"
+    return PyTango.DevFailed(error)
+
+
+@patch("PyTango.AttributeProxy")
+class InterlockRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = InterlockRegistry()
+        #no polling thread, the tests poll themselves
+        self.registry.start = MagicMock()
+        self.listener = MagicMock()
+
+    def tearDown(self):
+        self.registry.stop()
+
+    def register(self, attribute_proxy, value):
+        proxy = attribute_proxy.return_value
+        proxy.read_reply.return_value.value = value
+        self.registry.register("plc/tags/1/T1", self.listener)
+        self.registry.poll()
+        return proxy
+
+    def test_tag_shared_between_magnets(self, attribute_proxy):
+        self.register(attribute_proxy, False)
+        self.registry.register("PLC/TAGS/1/t1", MagicMock())
+        self.assertEqual(attribute_proxy.call_count, 1)
+        self.assertEqual(self.registry.reading("plc/tags/1/T1")[0], False)
+
+    def test_poll_period_from_magnets(self, attribute_proxy):
+        #a period above the default is used, the shortest one wins, and it goes back when unregistered
+        slow = MagicMock()
+        self.registry.register("plc/tags/1/T1", slow, 5.0)
+        self.assertEqual(self.registry.period, 5.0)
+        self.registry.register("plc/tags/1/T2", self.listener, 2.0)
+        self.assertEqual(self.registry.period, 2.0)
+        self.registry.unregister("plc/tags/1/T2", self.listener)
+        self.assertEqual(self.registry.period, 5.0)
+        self.registry.unregister("plc/tags/1/T1", slow)
+        self.assertEqual(self.registry.period, 1.0)
+
+    def test_failed_read_keeps_interlock(self, attribute_proxy):
+        proxy = self.register(attribute_proxy, True)
+        (value, read_time, error) = self.registry.reading("plc/tags/1/T1")
+        proxy.read_reply.side_effect = read_error()
+        self.registry.poll()
+        self.assertEqual(self.registry.reading("plc/tags/1/T1"), (True, read_time, "PLC not answering"))
+
+    def test_subscribed_tags_not_polled(self, attribute_proxy):
+        proxy = self.register(attribute_proxy, False)
+        event = MagicMock(err=False)
+        event.attr_value.value = True
+        proxy.subscribe_event.call_args[0][1](event)
+        self.assertEqual(self.listener.call_args[0][1][0], True)
+        self.registry.poll()
+        self.assertEqual(proxy.read_asynch.call_count, 1)
+        self.assertEqual(self.registry.reading("plc/tags/1/T1")[0], True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""Tests of reading devices in the same server, with a mock device object."""
+
+import unittest
+from mock import MagicMock, patch
+
+import PyTango
+
+from localdevicelib import LocalDeviceProxy, hold_readings
+
+
+def make_device():
+    device = MagicMock()
+    device.get_name.return_value = "SECTION/MAG/CRQ-01"
+    device.read_fieldA.side_effect = lambda attr: attr.set_value(device.always_executed_hook.call_count)
+    return device
+
+
+@patch("PyTango.AutoTangoMonitor", MagicMock())
+class LocalDeviceProxyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.device = make_device()
+        self.proxy = LocalDeviceProxy(self.device)
+
+    def test_each_read_is_a_request(self):
+        self.assertEqual(self.proxy.read_attribute("fieldA").value, 1)
+        self.assertEqual(self.proxy.read_attribute("fieldA").value, 2)
+
+    def test_failed_read_raises(self):
+        self.device.is_fieldB_allowed.return_value = False
+        self.assertTrue(self.proxy.read_attributes(["fieldB"])[0].has_failed)
+        self.assertRaises(PyTango.DevFailed, self.proxy.read_attribute, "fieldB")
+
+    def test_device_errors_raised(self):
+        error = PyTango.DevFailed(PyTango.DevError())
+        self.device.dev_state.side_effect = error
+        with self.assertRaises(PyTango.DevFailed) as raised:
+            self.proxy.read_attribute("State")
+        self.assertIs(raised.exception, error)
+
+    def test_python_errors_as_devfailed(self):
+        self.device.read_fieldA.side_effect = ZeroDivisionError("no BRho")
+        self.assertTrue(self.proxy.read_attributes(["fieldA"])[0].has_failed)
+        with self.assertRaises(PyTango.DevFailed) as raised:
+            self.proxy.read_attribute("fieldA")
+        self.assertEqual(raised.exception.args[0].reason, "PyDs_PythonError")
+
+    def test_held_readings_reused(self):
+        with hold_readings():
+            self.proxy.read_attributes(["fieldA", "State"])
+            self.assertEqual(self.proxy.read_attribute("fieldA").value, 1)
+            #the magnet reading its circuit through a proxy of its own
+            self.assertEqual(LocalDeviceProxy(self.device).read_attributes(["State", "fieldA"])[1].value, 1)
+            self.assertEqual(self.device.always_executed_hook.call_count, 1)
+        self.assertEqual(self.proxy.read_attribute("fieldA").value, 2)
+
+    def test_not_all_held_is_a_request(self):
+        with hold_readings():
+            self.proxy.read_attribute("State")
+            self.assertEqual(self.proxy.read_attribute("fieldA").value, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,201 @@
+"""Tests of the field calculations, independent of the Tango devices."""
+
+import unittest
+
+import numpy as np
+
+from magnetcircuitlib import calculate_fields, calculate_fields_array, calculate_setpoint, ExcitationCurve, FieldSum
+from processcalibrationlib import process_calibration_data
+
+
+def assert_identical(testcase, a, b):
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    testcase.assertEqual(a.tobytes(), b.tobytes())
+
+
+class ExcitationCurveTestCase(unittest.TestCase):
+
+    setpoints = ["[0.0, 1.0, 2.5, 4.0]",
+                 "[0.0, 1.0, 2.5, 4.0]",
+                 "[0.0, 1.1, 2.4, 4.1]"]
+    fields = ["[0.0, 0.1, 0.2, -0.0]",
+              "[0.0, 1.0, 2.0, 2.5]",
+              "[0.0, 3.0, 6.5, 9.0]"]
+
+    def check(self, allowed_component, typ, tilt=0, poltimesorient=1, is_sole=False, setpoints=None, fields=None):
+        (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(setpoints or self.setpoints,
+                                                                            fields or self.fields,
+                                                                            allowed_component, invertible=False)
+        self.assertTrue(ok, msg)
+        curve = ExcitationCurve(allowed_component, setpointsmatrix, fieldsmatrix, poltimesorient, tilt, typ, 0.3,
+                                is_sole)
+        for find_limit in (False, True):
+            for read_value in (-5.0, -4.0, -1.7, -1.0, 0.0, 0.4, 1.0, 2.4, 2.5, 3.9, 4.0, 4.1, np.NAN):
+                for set_value in (None, read_value, 2.0):
+                    expected = calculate_fields(allowed_component, setpointsmatrix, fieldsmatrix, 1.7,
+                                                poltimesorient, tilt, typ, 0.3, read_value, set_value, is_sole,
+                                                find_limit)
+                    result = curve.calculate_fields(1.7, read_value, set_value, find_limit)
+                    self.assertEqual(expected[0], result[0])
+                    for e, r in zip(expected[1:], result[1:]):
+                        if e is None:
+                            self.assertTrue(r is None)
+                        else:
+                            assert_identical(self, e, r)
+
+    def test_sextupole(self):
+        self.check(2, "ksext")
+
+    def test_quadrupole(self):
+        self.check(1, "kquad", poltimesorient=-1)
+
+    def test_skew_quadrupole(self):
+        self.check(1, "SKEW_QUADRUPOLE")
+
+    def test_tilted(self):
+        self.check(1, "kquad", tilt=1)
+
+    def test_dipole(self):
+        self.check(0, "sbend")
+
+    def test_vertical_corrector(self):
+        self.check(0, "vkick")
+
+    def test_solenoid(self):
+        self.check(0, "sole", is_sole=True)
+
+    def test_repeated_set_points(self):
+        self.check(0, "hkick", setpoints=["[-2.0, 0.0, 0.0, 2.0]"], fields=["[-1.0, 0.0, 0.5, 1.0]"])
+
+    def test_skips_zero_multipole(self):
+        self.check(1, "kquad", setpoints=["[0.0, 0.0, 0.0]", "[0.0, 1.0, 2.0]"],
+                   fields=["[0.0, 0.0, 0.0]", "[0.0, 1.0, 3.0]"])
+
+    def test_buffers_are_reused(self):
+        (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(self.setpoints, self.fields, 2,
+                                                                            invertible=False)
+        curve = ExcitationCurve(2, setpointsmatrix, fieldsmatrix, 1, 0, "ksext", 0.3)
+        first = curve.calculate_fields(1.0, 1.0)[5]
+        second = curve.calculate_fields(1.0, 2.0)[5]
+        self.assertTrue(first is second)
+
+
+class CalculateFieldsArrayTestCase(unittest.TestCase):
+
+    setpoints = ExcitationCurveTestCase.setpoints
+    fields = ExcitationCurveTestCase.fields
+    values = np.array([-5.0, -4.0, -1.7, 0.0, 0.4, 1.0, 2.5, 4.0, 4.1, np.NAN])
+
+    def check(self, allowed_component, typ, tilt=0, is_sole=False, find_limit=False):
+        (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(self.setpoints, self.fields,
+                                                                            allowed_component, invertible=False)
+        (valid, component, fieldA, fieldANormalised, fieldB, fieldBNormalised) \
+            = calculate_fields_array(allowed_component, setpointsmatrix, fieldsmatrix, 1.7, -1, tilt, typ, 0.3,
+                                     self.values, is_sole, find_limit)
+        self.assertEqual(fieldA.shape, (len(self.values), 10))
+        for i, value in enumerate(self.values):
+            expected = calculate_fields(allowed_component, setpointsmatrix, fieldsmatrix, 1.7, -1, tilt, typ, 0.3,
+                                        value, None, is_sole, find_limit)
+            self.assertEqual(expected[0], valid[i])
+            if expected[0]:
+                assert_identical(self, expected[1], component[i])
+                assert_identical(self, expected[3], fieldA[i])
+                assert_identical(self, expected[4], fieldANormalised[i])
+                assert_identical(self, expected[5], fieldB[i])
+                assert_identical(self, expected[6], fieldBNormalised[i])
+            else:
+                self.assertTrue(np.isnan(component[i]))
+                self.assertTrue(np.isnan(fieldB[i]).all())
+
+    def test_sextupole(self):
+        self.check(2, "ksext")
+
+    def test_skew_quadrupole(self):
+        self.check(1, "SKEW_QUADRUPOLE")
+
+    def test_dipole_limits(self):
+        self.check(0, "sbend", find_limit=True)
+
+    def test_solenoid(self):
+        self.check(0, "sole", is_sole=True)
+
+
+class InverseExcitationCurveTestCase(unittest.TestCase):
+
+    def make_curve(self, allowed_component, typ, setpoints, fields, is_sole=False):
+        (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(setpoints, fields, allowed_component)
+        self.assertTrue(ok, msg)
+        curve = ExcitationCurve(allowed_component, setpointsmatrix, fieldsmatrix, -1, 0, typ, 0.3, is_sole)
+        return curve, fieldsmatrix, setpointsmatrix
+
+    def check(self, allowed_component, typ, setpoints, fields, is_sole=False):
+        curve, fieldsmatrix, setpointsmatrix = self.make_curve(allowed_component, typ, setpoints, fields, is_sole)
+        self.assertTrue(curve.invertible)
+        for value in (-100.0, -3.0, -2.5, -1.0, 0.0, 0.2, 1.0, 2.0, 2.5, 3.0, 100.0, np.NAN):
+            fieldB = np.zeros(10)
+            fieldB[allowed_component] = value
+            expected = calculate_setpoint(allowed_component, setpointsmatrix, fieldsmatrix, 1.7, -1, 0, typ, 0.3,
+                                          None, fieldB, is_sole)
+            assert_identical(self, expected, curve.calculate_setpoint(1.7, None, fieldB))
+
+    def test_increasing_fields(self):
+        self.check(1, "kquad", ["[0.0, 0.0, 0.0, 0.0]", "[0.0, 1.0, 2.0, 4.0]"], ["[0.0, 0.0, 0.0, 0.0]", "[0.0, 1.0, 2.5, 3.0]"])
+
+    def test_decreasing_fields(self):
+        self.check(1, "kquad", ["[0.0, 0.0, 0.0, 0.0]", "[0.0, 1.0, 2.0, 4.0]"], ["[0.0, 0.0, 0.0, 0.0]", "[0.0, -1.0, -2.5, -3.0]"])
+
+    def test_symmetric_data(self):
+        self.check(0, "sole", ["[-2.0, 0.0, 2.0]"], ["[3.0, 0.0, -3.0]"], is_sole=True)
+
+    def test_round_trip(self):
+        curve = self.make_curve(2, "ksext", ExcitationCurveTestCase.setpoints, ExcitationCurveTestCase.fields)[0]
+        fieldB = curve.calculate_fields(1.7, 2.0)[5].copy()
+        self.assertAlmostEqual(curve.calculate_setpoint(1.7, None, fieldB), 2.0)
+
+    def test_non_monotonic_rejected(self):
+        (ok, msg, fieldsmatrix, setpointsmatrix) \
+            = process_calibration_data(["[-2.0, 0.0, 2.0]"], ["[1.0, 0.0, 0.5]"], 0)
+        self.assertFalse(ok)
+        self.assertIn("not monotonic", msg)
+        (ok, msg, fieldsmatrix, setpointsmatrix) \
+            = process_calibration_data(["[-2.0, 0.0, 2.0]"], ["[1.0, 0.0, 0.5]"], 0, invertible=False)
+        self.assertTrue(ok)
+        curve = ExcitationCurve(0, setpointsmatrix, fieldsmatrix, 1, 0, "hkick", 1.0)
+        self.assertFalse(curve.invertible)
+        self.assertRaises(ValueError, curve.calculate_setpoint, 1.0, None, np.zeros(10))
+
+
+class FieldSumTestCase(unittest.TestCase):
+
+    def reference(self, main_field, trim_field):
+        flags = np.isnan(main_field) & np.isnan(trim_field)
+        fM = main_field.copy()
+        fT = trim_field.copy()
+        fM[np.isnan(fM)] = 0.0
+        fT[np.isnan(fT)] = 0.0
+        out = fM + fT
+        out[flags] = np.NaN
+        return out
+
+    def test_sum_matches_reference(self):
+        #same values and NaNs (a -0.0 next to a NaN is kept as -0.0)
+        values = [np.NAN, 0.0, -0.0, 1.5, -2.0]
+        field_sum = FieldSum(len(values) ** 2)
+        main_field = np.repeat(values, len(values))
+        trim_field = np.tile(values, len(values))
+        np.testing.assert_array_equal(field_sum(main_field, trim_field), self.reference(main_field, trim_field))
+
+    def test_result_not_shared(self):
+        field_sum = FieldSum(3)
+        main_field = np.array([1.0, np.NAN, np.NAN])
+        first = field_sum(main_field, np.array([1.0, 2.0, np.NAN]))
+        self.assertEqual(first[:2].tolist(), [2.0, 2.0])
+        self.assertTrue(np.isnan(first[2]))
+        field_sum(np.zeros(3), np.ones(3))
+        self.assertEqual(first[:2].tolist(), [2.0, 2.0])
+        self.assertTrue(np.isnan(main_field[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
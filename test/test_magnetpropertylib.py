@@ -0,0 +1,101 @@
+"""Tests of reading the magnet properties, with mock proxies and database instead of Tango."""
+
+import random
+import time
+import unittest
+from mock import MagicMock, patch
+
+import PyTango
+
+import magnetpropertylib
+from magnetpropertylib import get_device_properties, prefetch_server_properties, clear_snapshot
+
+PROPERTIES = ["Length", "Type"]
+
+
+def magnet_properties(device_name, property_names):
+    """ properties named after the device, returned after a random delay so replies come out of order """
+    time.sleep(random.uniform(0, 0.01))
+    if device_name.endswith("BAD"):
+        raise PyTango.DevFailed(PyTango.DevError())
+    return dict((prop, [device_name + "." + prop]) for prop in property_names)
+
+
+def make_proxy(device_name):
+    proxy = MagicMock()
+    proxy.get_property.side_effect = lambda property_names: magnet_properties(device_name, property_names)
+    return proxy
+
+
+@patch("PyTango.DeviceProxy", side_effect=make_proxy)
+class GetDevicePropertiesTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        clear_snapshot()
+
+    def test_results_in_device_order(self, device_proxy):
+        names = ["SECTION/MAG/MAG-%02d" % i for i in range(20)]
+        results = get_device_properties(names, PROPERTIES, max_threads=8)
+        self.assertEqual([result["Length"] for result in results], [[name + ".Length"] for name in names])
+
+    def test_failed_device_gives_devfailed(self, device_proxy):
+        results = get_device_properties(["SECTION/MAG/MAG-01", "SECTION/MAG/BAD", "SECTION/MAG/MAG-02"],
+                                        PROPERTIES)
+        self.assertEqual(results[0]["Type"], ["SECTION/MAG/MAG-01.Type"])
+        self.assertIsInstance(results[1], PyTango.DevFailed)
+        self.assertEqual(results[2]["Type"], ["SECTION/MAG/MAG-02.Type"])
+
+    def test_snapshot_used_until_cleared(self, device_proxy):
+        magnetpropertylib._snapshot["section/mag/mag-01"] = {"Length": ["2.0"], "Type": ["kquad"]}
+        self.assertEqual(get_device_properties(["SECTION/MAG/MAG-01"], PROPERTIES),
+                         [{"Length": ["2.0"], "Type": ["kquad"]}])
+        self.assertFalse(device_proxy.called)
+        #a property not in the snapshot is read from the device
+        get_device_properties(["SECTION/MAG/MAG-01"], PROPERTIES + ["Tilt"])
+        self.assertEqual(device_proxy.call_count, 1)
+        clear_snapshot()
+        self.assertEqual(get_device_properties(["SECTION/MAG/MAG-01"], PROPERTIES)[0]["Length"],
+                         ["SECTION/MAG/MAG-01.Length"])
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch("PyTango.Database")
+        self.db = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.db.get_device_class_list.return_value = ["DSERVER/MAGNET/1", "DServer",
+                                                      "SECTION/MAG/MAG-01", "Magnet",
+                                                      "SECTION/MAG/MAG-02", "Magnet",
+                                                      "SECTION/MAG/CRQ-01", "MagnetCircuit"]
+
+    def tearDown(self):
+        clear_snapshot()
+
+    def test_one_query_for_all_devices(self):
+        #rows of device, property, value line; MAG-02 has no properties defined
+        self.db.command_inout.return_value = [[0] * 9 + [3, 3], [
+            "SECTION/MAG/MAG-01", "length", "1.5",
+            "SECTION/MAG/MAG-01", "Type", "kquad",
+            "SECTION/MAG/MAG-01", "Type", "second line"]]
+        self.assertEqual(prefetch_server_properties("Magnet/1", "Magnet", PROPERTIES), 2)
+        (command, query) = self.db.command_inout.call_args[0]
+        self.assertEqual(command, "DbMySqlSelect")
+        self.assertIn("server = 'Magnet/1' AND class = 'Magnet'", query)
+        self.assertFalse(self.db.get_device_property.called)
+        self.assertEqual(magnetpropertylib._snapshot,
+                         {"section/mag/mag-01": {"Length": ["1.5"], "Type": ["kquad", "second line"]},
+                          "section/mag/mag-02": {"Length": [], "Type": []}})
+
+    def test_one_query_per_device_without_select(self):
+        self.db.command_inout.side_effect = PyTango.DevFailed(PyTango.DevError())
+        self.db.get_device_class_list.return_value[4] = "SECTION/MAG/BAD"
+        self.db.get_device_property.side_effect = magnet_properties
+        self.assertEqual(prefetch_server_properties("Magnet/1", "Magnet", PROPERTIES), 1)
+        self.assertEqual(magnetpropertylib._snapshot,
+                         {"section/mag/mag-01": {"Length": ["SECTION/MAG/MAG-01.Length"],
+                                                 "Type": ["SECTION/MAG/MAG-01.Type"]}})
+
+
+if __name__ == "__main__":
+    unittest.main()
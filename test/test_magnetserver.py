@@ -0,0 +1,170 @@
+"""Tests of the MagnetServer commands, with mock circuits instead of the devices of the server."""
+
+import json
+import unittest
+from mock import MagicMock, patch
+
+import PyTango
+
+import MagnetServer
+
+
+def ps_error():
+    error = PyTango.DevError()
+    error.desc = "PS not answering"
+    return PyTango.DevFailed(error)
+
+
+def make_circuit(name, set_point=1.0):
+    """ mock MagnetCircuit, whose set point is twice the main field component, within -10..10 A """
+    circuit = MagicMock()
+    circuit.get_name.return_value = name
+    circuit.get_device_class.return_value.get_name.return_value = "MagnetCircuit"
+    circuit.hasCalibData = True
+    circuit.calculate_main_field_setpoint.side_effect = lambda value: 2 * value
+    circuit.min_setpoint_value = -10.0
+    circuit.max_setpoint_value = 10.0
+    circuit.ps_limits_read = True
+    circuit.ps_attribute = "Current"
+    circuit.set_point = None
+    circuit.MainFieldComponent_w = None
+    circuit.ps_device.read_attribute_reply.return_value.w_value = set_point
+    return circuit
+
+
+class Server(object):
+    """ the MagnetServer methods, on a plain object instead of a Tango device """
+    RampStepRate = 100.0
+
+    def __init__(self):
+        self._ramper = None
+        self.state = None
+
+    def debug_stream(self, msg):
+        pass
+
+    def set_state(self, state):
+        self.state = state
+
+for (name, method) in vars(MagnetServer.MagnetServer).items():
+    if callable(method) and not name.startswith("__"):
+        setattr(Server, name, method)
+
+
+class MagnetServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.circuits = dict((name, make_circuit(name)) for name in ["SECTION/MAG/CRQ-01", "SECTION/MAG/CRQ-02"])
+        util = MagicMock()
+        util.get_device_by_name.side_effect = lambda name: self.circuits[name]
+        patches = [patch("PyTango.Util.instance", MagicMock(return_value=util)),
+                   patch("PyTango.AutoTangoMonitor", MagicMock())]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.server = Server()
+
+    def tearDown(self):
+        if self.server._ramper:
+            self.server._ramper.stop()
+
+    def ps(self, name):
+        return self.circuits[name].ps_device
+
+    def apply(self, values, names):
+        return json.loads(self.server.ApplyMainFieldComponents((values, names)))
+
+
+class ApplyMainFieldComponentsTestCase(MagnetServerTestCase):
+
+    def test_all_written(self):
+        result = self.apply([1.0, -2.0], ["SECTION/MAG/CRQ-01", "SECTION/MAG/CRQ-02"])
+        self.assertEqual(result, {"applied": True,
+                                  "results": {"SECTION/MAG/CRQ-01": "OK", "SECTION/MAG/CRQ-02": "OK"}})
+        self.ps("SECTION/MAG/CRQ-01").write_attribute_asynch.assert_called_once_with("Current", 2.0)
+        self.ps("SECTION/MAG/CRQ-02").write_attribute_asynch.assert_called_once_with("Current", -4.0)
+        self.assertEqual(self.circuits["SECTION/MAG/CRQ-02"].MainFieldComponent_w, -2.0)
+        #no PS reads before the writes
+        self.assertFalse(self.ps("SECTION/MAG/CRQ-01").read_attribute.called)
+
+    def test_nothing_written_if_one_fails(self):
+        result = self.apply([1.0, 6.0], ["SECTION/MAG/CRQ-01", "SECTION/MAG/CRQ-02"])
+        self.assertFalse(result["applied"])
+        self.assertEqual(result["results"]["SECTION/MAG/CRQ-01"], "Not applied, other circuits failed")
+        self.assertIn("outside PS limits", result["results"]["SECTION/MAG/CRQ-02"])
+        for name in self.circuits:
+            self.assertFalse(self.ps(name).write_attribute_asynch.called)
+
+    def test_failed_write_reported(self):
+        self.ps("SECTION/MAG/CRQ-02").write_attribute_reply.side_effect = ps_error()
+        result = self.apply([1.0, 2.0], ["SECTION/MAG/CRQ-01", "SECTION/MAG/CRQ-02"])
+        self.assertFalse(result["applied"])
+        self.assertEqual(result["results"], {"SECTION/MAG/CRQ-01": "OK",
+                                             "SECTION/MAG/CRQ-02": "Cannot set Current on PS: PS not answering"})
+        self.assertIsNone(self.circuits["SECTION/MAG/CRQ-02"].MainFieldComponent_w)
+
+    def test_limits_read_if_missing(self):
+        circuit = self.circuits["SECTION/MAG/CRQ-01"]
+        circuit.ps_limits_read = False
+        circuit.min_setpoint_value = circuit.max_setpoint_value = None
+        result = self.apply([1.0], ["SECTION/MAG/CRQ-01"])
+        circuit.set_point_limits.assert_called_once_with()
+        self.assertEqual(result["results"]["SECTION/MAG/CRQ-01"], "PS limits unknown")
+
+    def test_repeated_circuit_rejected(self):
+        self.assertRaises(PyTango.DevFailed, self.apply, [1.0, 2.0], ["SECTION/MAG/CRQ-01", "SECTION/MAG/CRQ-01"])
+        self.assertFalse(self.ps("SECTION/MAG/CRQ-01").write_attribute_asynch.called)
+
+
+class RampTestCase(MagnetServerTestCase):
+
+    def start(self, ramp_time, values, names=("SECTION/MAG/CRQ-01", "SECTION/MAG/CRQ-02")):
+        return json.loads(self.server.StartRamp(([ramp_time] + values, list(names))))
+
+    def test_ramp_to_targets(self):
+        result = self.start(0.05, [2.0, -1.0])
+        self.assertTrue(result["started"])
+        self.assertEqual(self.server.state, PyTango.DevState.MOVING)
+        self.server._ramper.ramp_thread.join()
+        self.assertEqual(self.server._ramper.phase, "RAMP DONE")
+        #from the PS set point (1 A) to 2 * value, the field only set at the end
+        ps = self.ps("SECTION/MAG/CRQ-02")
+        self.assertEqual(ps.write_attribute_asynch.call_args[0], ("Current", -2.0))
+        self.assertLess(ps.write_attribute_asynch.call_args_list[0][0][1], 1.0)
+        self.assertEqual(self.circuits["SECTION/MAG/CRQ-02"].MainFieldComponent_w, -1.0)
+        self.server.StopRamp()
+        self.assertEqual(self.server.state, PyTango.DevState.ON)
+
+    def test_stop(self):
+        self.start(10.0, [2.0, -1.0])
+        self.server.StopRamp()
+        self.assertEqual(self.server.state, PyTango.DevState.ON)
+        self.assertEqual(self.server._ramper.phase.split(" (")[0], "RAMP INTERRUPTED")
+        self.assertIsNone(self.circuits["SECTION/MAG/CRQ-01"].MainFieldComponent_w)
+
+    def test_rejected_ramp_leaves_running_one(self):
+        self.start(10.0, [2.0, -1.0])
+        ramper = self.server._ramper
+        result = self.start(1.0, [2.0, 6.0])
+        self.assertFalse(result["started"])
+        self.assertIs(self.server._ramper, ramper)
+        self.assertTrue(ramper.is_running())
+
+    def test_bad_ramp_time_and_rate(self):
+        for ramp_time in [float("nan"), float("inf"), -1.0]:
+            self.assertRaises(PyTango.DevFailed, self.start, ramp_time, [2.0, -1.0])
+        self.server.RampStepRate = 0.0
+        self.assertRaises(PyTango.DevFailed, self.start, 1.0, [2.0, -1.0])
+        self.assertIsNone(self.server._ramper)
+
+    def test_unreadable_ps_not_started(self):
+        self.ps("SECTION/MAG/CRQ-01").read_attribute_reply.side_effect = ps_error()
+        result = self.start(1.0, [2.0, -1.0])
+        self.assertEqual(result, {"started": False, "results": {
+            "SECTION/MAG/CRQ-01": "Cannot read Current from PS: PS not answering",
+            "SECTION/MAG/CRQ-02": "Not started, other circuits failed"}})
+        self.assertIsNone(self.server._ramper)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+"""Tests of the processing of calibration properties, independent of the Tango devices."""
+
+import unittest
+
+import numpy as np
+
+import processcalibrationlib
+from processcalibrationlib import process_calibration_data, parse_excitation_curve
+
+
+class CalibrationCacheTestCase(unittest.TestCase):
+
+    setpoints = ["[2.0, 1.0, 0.0]", "[2.0, 1.0, 0.0]"]
+    fields = ["[0.5, 0.2, 0.0]", "[1.0, 0.6, 0.0]"]
+
+    def setUp(self):
+        processcalibrationlib.clear_calibration_cache()
+
+    def test_same_content_is_shared(self):
+        first = process_calibration_data(list(self.setpoints), list(self.fields), 1)
+        second = process_calibration_data(list(self.setpoints), list(self.fields), 1)
+        self.assertTrue(first[0])
+        self.assertTrue(first[2] is second[2])
+        self.assertTrue(first[3] is second[3])
+
+    def test_key_includes_allowed_component(self):
+        first = process_calibration_data(self.setpoints, self.fields, 0)
+        second = process_calibration_data(self.setpoints, self.fields, 1)
+        self.assertFalse(first[2] is second[2])
+
+    def test_different_content_not_shared(self):
+        first = process_calibration_data(self.setpoints, self.fields, 1)
+        second = process_calibration_data(self.setpoints, ["[0.5, 0.2, 0.0]", "[1.0, 0.7, 0.0]"], 1)
+        self.assertEqual(first[2][1][-1], 1.0)
+        self.assertEqual(second[2][1][-1], 1.0)
+        self.assertEqual(second[2][1][-2], 0.7)
+        self.assertFalse(first[2] is second[2])
+
+    def test_matrices_are_read_only(self):
+        (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(self.setpoints, self.fields, 1)
+        self.assertRaises(ValueError, fieldsmatrix.__setitem__, (0, 0), 1.0)
+        self.assertRaises(ValueError, setpointsmatrix.__setitem__, (0, 0), 1.0)
+
+    def test_errors_are_cached(self):
+        first = process_calibration_data(self.setpoints, self.fields[:1], 1)
+        self.assertFalse(first[0])
+        self.assertTrue(first is process_calibration_data(self.setpoints, self.fields[:1], 1))
+
+
+class ParseExcitationCurveTestCase(unittest.TestCase):
+
+    def test_parse_matrix(self):
+        (ok, msg, data) = parse_excitation_curve(["[0.0, 1.5, -2e-3]", "[1,2,3]"])
+        self.assertTrue(ok)
+        self.assertEqual(data.shape, (2, 3))
+        self.assertEqual(data.tolist(), [[0.0, 1.5, -2e-3], [1.0, 2.0, 3.0]])
+
+    def test_parse_errors_name_multipole(self):
+        (ok, msg, data) = parse_excitation_curve(["[0.0, 1.0]", "[1.0]"])
+        self.assertFalse(ok)
+        self.assertEqual(msg, "Calibration data is missing for multipole 1")
+        (ok, msg, data) = parse_excitation_curve(["[0.0, 1.0]", "[1.0, 2.0, 3.0]"])
+        self.assertFalse(ok)
+        self.assertEqual(msg, "Calibration error: multipole 1 has different length data than the first")
+        (ok, msg, data) = parse_excitation_curve(["[0.0, 1.0]", "[1.0, 2.0]", "[1.0, x]"])
+        self.assertFalse(ok)
+        self.assertEqual(msg, "Calibration error: cannot convert data for multipole 2 to numbers")
+
+    def test_reflected_curve(self):
+        (ok, msg, fieldsmatrix, setpointsmatrix) = process_calibration_data(["[2.0, 0.0, 1.0]"], ["[0.4, 0.0, 0.2]"], 0)
+        self.assertTrue(ok)
+        self.assertEqual(setpointsmatrix[0].tolist(), [-2.0, -1.0, 0.0, 1.0, 2.0])
+        self.assertEqual(fieldsmatrix[0].tolist(), [-0.4, -0.2, 0.0, 0.2, 0.4])
+        self.assertTrue(np.isnan(fieldsmatrix[1:]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""Tests of the fail fast device proxies, with mock proxies instead of devices."""
+
+import time
+import unittest
+from mock import MagicMock
+
+import PyTango
+
+from proxymanagerlib import ManagedProxy, is_connection_error
+
+
+def connection_error():
+    error = PyTango.DevError()
+    error.reason = "API_DeviceNotExported"
+    error.desc = "device not exported"
+    return PyTango.DevFailed(error)
+
+
+def wait_for(condition, timeout=1.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.001)
+    return condition()
+
+
+class ManagedProxyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.device = MagicMock()
+        self.factory = MagicMock(return_value=self.device)
+        self.proxy = ManagedProxy("SECTION/MAG/PS-01", self.factory, min_retry=0.01, max_retry=0.04)
+
+    def tearDown(self):
+        self.proxy.stop()
+
+    def test_first_connect_in_calling_thread(self):
+        self.assertIs(self.proxy.get(), self.proxy)
+        self.factory.assert_called_once_with("SECTION/MAG/PS-01")
+        self.device.read_attribute.return_value = 1.5
+        self.assertEqual(self.proxy.get().read_attribute("Current"), 1.5)
+
+    def test_fast_fail_then_reconnect(self):
+        self.device.ping.side_effect = connection_error()
+        self.assertIsNone(self.proxy.get())
+        self.assertEqual(self.proxy.error, "device not exported")
+        calls = self.device.ping.call_count
+        self.assertIsNone(self.proxy.get())
+        self.assertLessEqual(self.device.ping.call_count, calls + 1)  # at most a background attempt
+        self.device.ping.side_effect = None
+        self.assertTrue(wait_for(lambda: self.proxy.get() is not None))
+
+    def test_connection_failure_on_call(self):
+        self.assertIsNotNone(self.proxy.get())
+        self.device.read_attribute.side_effect = connection_error()
+        self.device.ping.side_effect = connection_error()
+        self.assertRaises(PyTango.DevFailed, self.proxy.get().read_attribute, "Current")
+        self.assertIsNone(self.proxy.get())
+        self.device.ping.side_effect = None
+        self.assertTrue(wait_for(lambda: self.proxy.get() is not None))
+
+    def test_other_failure_on_call(self):
+        self.assertIsNotNone(self.proxy.get())
+        self.device.write_attribute.side_effect = PyTango.DevFailed()
+        self.assertRaises(PyTango.DevFailed, self.proxy.get().write_attribute, "Current", 100.0)
+        self.assertIsNotNone(self.proxy.get())
+
+    def test_is_connection_error(self):
+        self.assertTrue(is_connection_error(connection_error()))
+        self.assertFalse(is_connection_error(PyTango.DevFailed()))
+
+
+if __name__ == "__main__":
+    unittest.main()
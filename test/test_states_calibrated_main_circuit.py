@@ -12,6 +12,7 @@ import MagnetCircuit
 
 from unittest import skip
 from devicetest import DeviceTestCase
+from magnetmocks import get_magnet_properties
 
 # Device test case
 class MagnetCircuitTestCase(DeviceTestCase):
@@ -87,15 +88,9 @@ class MagnetCircuitTestCase(DeviceTestCase):
             mock_proxy.get_attribute_config = get_ps_attribute_config
             return mock_proxy
 
-        def get_magnet_property(devname, prop):
-            if not isinstance(getattr(cls.magnet_proxies[devname], prop), MagicMock):
-                return {prop: getattr(cls.magnet_proxies[devname], prop)}
-            if prop in cls.magnets[devname]:
-                return {prop: cls.magnets[devname][prop]}
-
         def make_magnet_proxy(devname):
             mock_proxy = make_proxy()
-            mock_proxy.get_property = partial(get_magnet_property, devname)
+            mock_proxy.get_property = partial(get_magnet_properties, cls, devname)
             return mock_proxy
 
         cls.magnet_proxies = dict((devname, make_magnet_proxy(devname))
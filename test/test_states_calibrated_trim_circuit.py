@@ -3,7 +3,7 @@
 # Imports
 from functools import partial
 from time import sleep
-from mock import MagicMock
+from mock import MagicMock, patch
 
 import PyTango
 
@@ -12,6 +12,7 @@ import TrimCircuit
 
 from unittest import skip
 from devicetest import DeviceTestCase
+from magnetmocks import get_magnet_properties
 
 # Device test case
 class TrimCircuitTestCase(DeviceTestCase):
@@ -113,24 +114,24 @@ class TrimCircuitTestCase(DeviceTestCase):
             config.max_value = 10
             return config
 
+        def read_ps_attribute(name):
+            if name == "Current":
+                return MagicMock(value=1.0, w_value=1.0)
+            return MagicMock(value=PyTango.DevState.ON)
+
         def make_ps_proxy():
             mock_proxy = make_proxy()
             mock_proxy.get_attribute_config = get_ps_attribute_config
+            mock_proxy.read_attribute.side_effect = read_ps_attribute
             return mock_proxy
 
         def make_swb_proxy():
             mock_proxy = make_proxy()
             return mock_proxy
 
-        def get_magnet_property(devname, prop):
-            if not isinstance(getattr(cls.magnet_proxies[devname], prop), MagicMock):
-                return {prop: getattr(cls.magnet_proxies[devname], prop)}
-            if prop in cls.magnets[devname]:
-                return {prop: cls.magnets[devname][prop]}
-
         def make_magnet_proxy(devname):
             mock_proxy = make_proxy()
-            mock_proxy.get_property = partial(get_magnet_property, devname)
+            mock_proxy.get_property = partial(get_magnet_properties, cls, devname)
             return mock_proxy
 
         cls.magnet_proxies = dict((devname, make_magnet_proxy(devname))
@@ -148,6 +149,16 @@ class TrimCircuitTestCase(DeviceTestCase):
 
         cls.device_proxy = TrimCircuit.PyTango.DeviceProxy = MagicMock(side_effect=proxy_result)
 
+    def setUp(self):
+        #the mocks and the device are shared by the tests, so start each from the same mode
+        self.swb_proxy.Mode = "NORMAL_QUADRUPOLE"
+        self.swb_proxy.subscribe_event.reset_mock()
+        self.device.Init()
+
+    def field_limits(self):
+        config = self.device.get_attribute_config("MainFieldComponent")
+        return (float(config.min_value), float(config.max_value))
+
     #Test 1
     #def test_trim_state_on_when_ps_and_swb_on(self):
     #    print "Test 1.1"
@@ -198,3 +209,87 @@ class TrimCircuitTestCase(DeviceTestCase):
         self.device.Mode
         #print "2", self.device.Status()
         self.assertIn("SWB Mode is invalid", self.device.Status())
+
+    def test_calibration_processed_per_mode(self):
+        #only the calibration of a mode in use is processed, once
+        process = patch.object(TrimCircuit, "process_calibration_data", wraps=TrimCircuit.process_calibration_data)
+        with process as process_calibration_data:
+            self.device.Init()
+            self.assertEqual(self.device.Mode, "NORMAL_QUADRUPOLE")
+            self.assertEqual(process_calibration_data.call_count, 1)
+            self.assertIn("Calibration available", self.device.Status())
+            self.swb_proxy.Mode = "X_CORRECTOR"
+            self.assertEqual(self.device.Mode, "X_CORRECTOR")
+            self.swb_proxy.Mode = "NORMAL_QUADRUPOLE"
+            self.assertEqual(self.device.Mode, "NORMAL_QUADRUPOLE")
+            self.assertEqual(process_calibration_data.call_count, 2)
+
+    def test_no_sextupole_mode_for_trim_type(self):
+        #the device name has no SX type
+        self.swb_proxy.Mode = "SEXTUPOLE"
+        self.assertEqual(self.device.Mode, "SEXTUPOLE")
+        self.assertIn("No sextupole mode for trim type", self.device.Status())
+
+    def test_mode_table_sets_attribute_config(self):
+        #units, labels and limits (PS limits of -10 and 10 A, at b.rho) of the mode
+        brho = self.device.BRho
+        config = self.device.get_attribute_config("MainFieldComponent")
+        self.assertEqual((config.unit, config.label), ("m ^-2", "k1"))
+        (lo, hi) = self.field_limits()
+        self.assertAlmostEqual(lo, -6.0 / brho, 4)
+        self.assertAlmostEqual(hi, 6.0 / brho, 4)
+        self.swb_proxy.Mode = "X_CORRECTOR"
+        self.assertEqual(self.device.Mode, "X_CORRECTOR")
+        config = self.device.get_attribute_config("MainFieldComponent")
+        self.assertEqual((config.unit, config.label), ("rad", "theta"))
+        self.assertAlmostEqual(float(config.max_value), 4.0 / brho, 4)
+        self.assertEqual(self.device.get_attribute_config("IntMainFieldComponent").unit, "rad m")
+        #back to the table made before
+        self.swb_proxy.Mode = "NORMAL_QUADRUPOLE"
+        self.assertEqual(self.device.Mode, "NORMAL_QUADRUPOLE")
+        self.assertEqual(self.field_limits(), (lo, hi))
+
+    def test_field_limits_follow_brho(self):
+        (lo, hi) = self.field_limits()
+        brho = self.device.BRho
+        self.device.energy = self.device.energy / 4
+        new_brho = self.device.BRho
+        self.assertLess(new_brho, brho)
+        (new_lo, new_hi) = self.field_limits()
+        self.assertAlmostEqual(new_lo, lo * brho / new_brho, 4)
+        self.assertAlmostEqual(new_hi, hi * brho / new_brho, 4)
+
+
+class TrimCircuitSwitchBoardEventsTestCase(TrimCircuitTestCase):
+
+    properties = dict(TrimCircuitTestCase.properties, UseSwitchBoardEvents=["True"])
+
+    def swb_event(self, mode=None):
+        #send a mode change event, or an error event if no mode
+        event = MagicMock(err=mode is None)
+        event.attr_value.value = mode
+        self.swb_proxy.subscribe_event.call_args[0][2](event)
+
+    def test_mode_from_events(self):
+        (attribute, event_type) = self.swb_proxy.subscribe_event.call_args[0][:2]
+        self.assertEqual((attribute, event_type), ("Mode", PyTango.EventType.CHANGE_EVENT))
+        self.swb_event("SKEW_QUADRUPOLE")
+        #the mode of the event is used, not read from the SWB
+        self.assertEqual(self.device.Mode, "SKEW_QUADRUPOLE")
+        self.assertEqual(self.device.get_attribute_config("MainFieldComponent").label, "k1")
+        self.swb_event("X_CORRECTOR")
+        self.assertEqual(self.device.Mode, "X_CORRECTOR")
+
+    def test_mode_read_after_error_event(self):
+        self.swb_event("SKEW_QUADRUPOLE")
+        self.assertEqual(self.device.Mode, "SKEW_QUADRUPOLE")
+        #no events (e.g. SWB down), so the mode is read from the SWB again
+        self.swb_event()
+        self.assertEqual(self.device.Mode, "NORMAL_QUADRUPOLE")
+        self.swb_proxy.Mode = "X_CORRECTOR"
+        self.assertEqual(self.device.Mode, "X_CORRECTOR")
+
+    def test_unsubscribed_on_init(self):
+        event_id = self.swb_proxy.subscribe_event.return_value
+        self.device.Init()
+        self.swb_proxy.unsubscribe_event.assert_called_with(event_id)